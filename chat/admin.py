@@ -1,29 +1,162 @@
+from datetime import timedelta
+
+from django import forms
 from django.contrib import admin
-from .models import Message, Room
+from django.contrib.admin import helpers
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.db.models.functions import Substr
+from django.utils import timezone
+from django.utils.html import format_html
+from django.utils.text import Truncator
+from django.utils.translation import gettext
+
+from . import search
+from .changelist import EstimatedCountPaginator, KeysetChangeList
+from .constants import MESSAGE_CONTENT_PREVIEW_LENGTH
+from .models import Message, ReadCursor, Room
+from .pagination import decode_id
 
 """Admin configurations for the chat application models."""
 
 
+class RoomAutocompleteFilter(admin.SimpleListFilter):
+    """Filter by room with the room autocomplete, instead of one link per room."""
+
+    title = "room"
+    parameter_name = "room__id__exact"
+    template = "admin/chat/autocomplete_filter.html"
+
+    def __init__(self, request, params, model, model_admin):
+        super().__init__(request, params, model, model_admin)
+        self.field = model._meta.get_field("room")
+        self.admin_site = model_admin.admin_site
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            try:
+                room_id = decode_id(self.value())
+            except ValueError:
+                raise IncorrectLookupParameters
+            return queryset.filter(room_id=room_id)
+        return queryset
+
+    def choices(self, changelist):
+        yield {
+            "selected": self.value() is None,
+            "query_string": changelist.get_query_string(remove=[self.parameter_name]),
+            "display": "All",
+        }
+
+    def widget(self):
+        """The autocomplete select, showing only the selected room until the user types."""
+        form_field = self.field.formfield(widget=AutocompleteSelect(self.field, self.admin_site), required=False)
+        return form_field.widget.render(self.parameter_name, self.value(), attrs={"id": "id_room_filter"})
+
+
+class ActivityFilter(admin.SimpleListFilter):
+    """Rooms by the time of their last message (served from ``room_activity_idx``)."""
+
+    title = "last message"
+    parameter_name = "active"
+    periods = {"day": 1, "week": 7, "month": 30}
+
+    def lookups(self, request, model_admin):
+        return (
+            ("day", "Past 24 hours"),
+            ("week", "Past 7 days"),
+            ("month", "Past 30 days"),
+            ("never", "No messages"),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == "never":
+            return queryset.filter(last_message_at__isnull=True)
+        if self.value() in self.periods:
+            since = timezone.now() - timedelta(days=self.periods[self.value()])
+            return queryset.filter(last_message_at__gte=since)
+        return queryset
+
+
+class MessageChangeList(KeysetChangeList):
+    def get_queryset(self, request, exclude_parameters=None):
+        # One character more than the preview shows, so Truncator knows when to add the ellipsis
+        return super().get_queryset(request, exclude_parameters).defer("content").annotate(
+            content_head=Substr("content", 1, MESSAGE_CONTENT_PREVIEW_LENGTH + 1)
+        )
+
+
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    date_hierarchy = "timestamp"
-    list_display = ("id", "content", "room", "timestamp")
-    search_fields = ("content", "room__name")
-    list_filter = ("room",)
+    list_display = ("id", "preview", "room", "user", "timestamp")
+    list_select_related = ("room", "user")
+    sortable_by = ("id", "timestamp")
+    search_fields = ("content",)
+    search_help_text = "Messages containing every word, e.g. 'deploy friday'."
+    list_filter = (RoomAutocompleteFilter, ("timestamp", admin.DateFieldListFilter))
     ordering = ("-timestamp",)
     list_per_page = 50
+    # Exact counts and facet counts would scan the whole table
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
     autocomplete_fields = ("room",)
     readonly_fields = ("timestamp",)
 
-    def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        return qs.select_related("room")
+    @property
+    def media(self):
+        return super().media + AutocompleteSelect(Message._meta.get_field("room"), self.admin_site).media
+
+    def get_changelist(self, request, **kwargs):
+        return MessageChangeList
+
+    @admin.display(description="Content")
+    def preview(self, message):
+        head = getattr(message, "content_head", None)
+        if head is None:
+            return message._get_content_preview()
+        return Truncator(head).chars(MESSAGE_CONTENT_PREVIEW_LENGTH, truncate="...")
+
+    def action_checkbox(self, message):
+        # The default labels the checkbox with str(message), which would load every row's deferred content
+        attrs = {
+            "class": "action-select",
+            "aria-label": format_html(gettext("Select this object for an action - {}"), self.preview(message)),
+        }
+        return forms.CheckboxInput(attrs, lambda value: False).render(helpers.ACTION_CHECKBOX_NAME, str(message.pk))
+
+    def get_search_results(self, request, queryset, search_term):
+        # Served by the full-text index instead of LIKE '%term%' over every row
+        if not search.terms(search_term):
+            return super().get_search_results(request, queryset, search_term)
+        return search.matching(queryset, search_term), False
+
+    def get_ordering(self, request):
+        # Matches come out of the index in id order; sorting them by timestamp would read them all
+        if search.terms(request.GET.get("q", "")):
+            return ("-pk",)
+        return super().get_ordering(request)
 
 
 @admin.register(Room)
 class RoomAdmin(admin.ModelAdmin):
-    list_display = ("name", "description")
+    list_display = ("name", "description", "message_count", "last_message_at")
     search_fields = ("name", "description")
-    list_filter = ("name",)
+    list_filter = (ActivityFilter,)
     ordering = ("name",)
     list_per_page = 50
+    readonly_fields = ("message_count", "last_message_at", "last_message_id")
+
+
+@admin.register(ReadCursor)
+class ReadCursorAdmin(admin.ModelAdmin):
+    list_display = ("user", "room", "last_read_id", "updated_at")
+    list_select_related = ("user", "room")
+    autocomplete_fields = ("room",)
+    raw_id_fields = ("user",)
@@ -0,0 +1,357 @@
+"""
+Archival of messages older than their room's retention period.
+
+``archive_room`` moves a room's old messages, oldest first and
+``ARCHIVE_BATCH_SIZE`` at a time, to append-only gzipped JSONL files at
+``CHAT_ARCHIVE_DIR/<room id>/<YYYY-MM>.jsonl.gz`` (by the UTC month of
+each message), then deletes them in a short transaction per batch. Each
+batch is appended as its own gzip member and synced before the delete,
+so a crash in between only leaves rows that are both archived and live;
+the next run archives them again and readers skip the duplicate. A
+``<YYYY-MM>.index.jsonl`` next to each file records the offset, length
+and key range of its members, and a ``.updated`` stamp at the top of the
+directory is touched after every batch.
+
+``page_before`` reads the archives with the same contract as
+``chat.pagination.page_before``, and ``extend_page`` continues a page of
+live history into them, so history cursors move past the oldest live
+message without the client noticing. Pages only decompress the members
+that can hold their rows, and the directory listing is cached until the
+stamp changes. Archived messages are no longer found by search or
+counted in their room.
+"""
+
+import gzip
+import heapq
+import json
+import os
+import time
+from datetime import timezone as dt_timezone
+from pathlib import Path
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, router, transaction
+from django.utils.dateparse import parse_datetime
+
+from .constants import ARCHIVE_BATCH_SIZE, MESSAGE_PAGE_SIZE, RETENTION_DAYS
+from .cluster import cluster
+from .models import Message, Room
+from .pagination import _key, encode_cursor
+
+SUFFIX = ".jsonl.gz"
+INDEX_SUFFIX = ".index.jsonl"
+STAMP = ".updated"
+
+
+def archive_dir():
+    return Path(getattr(settings, "CHAT_ARCHIVE_DIR", None) or Path(settings.BASE_DIR) / "archive")
+
+
+def retention_days(room):
+    """Days ``room`` keeps its messages, or None to keep them forever."""
+    if room.retention_days is not None:
+        return room.retention_days
+    return getattr(settings, "CHAT_RETENTION_DAYS", RETENTION_DAYS)
+
+
+def message_row(message):
+    """The archived form of a message; the username is kept so reads need no query."""
+    return {
+        "id": message.pk,
+        "room": message.room_id,
+        "user": message.user_id,
+        "username": message.user.username,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+        "read_at": message.read_at.isoformat() if message.read_at else None,
+    }
+
+
+def message_from_row(row):
+    message = Message(
+        pk=row["id"],
+        room_id=row["room"],
+        content=row["content"],
+        timestamp=parse_datetime(row["timestamp"]),
+        read_at=parse_datetime(row["read_at"]) if row["read_at"] else None,
+    )
+    message.user = User(pk=row["user"], username=row["username"])
+    return message
+
+
+def _month(timestamp):
+    timestamp = timestamp.astimezone(dt_timezone.utc)
+    return timestamp.year, timestamp.month
+
+
+def _month_name(month):
+    return f"{month[0]:04d}-{month[1]:02d}"
+
+
+def _index_path(path):
+    return path.with_name(path.name[: -len(SUFFIX)] + INDEX_SUFFIX)
+
+
+def _row_key(row):
+    return parse_datetime(row["timestamp"]), row["id"]
+
+
+# Writing
+
+def _append_line(path, line):
+    """Append ``line`` to ``path`` and sync it, first ending a line that a crash left unfinished."""
+    with open(path, "a+b") as fh:
+        if fh.tell():
+            fh.seek(-1, os.SEEK_END)
+            if fh.read(1) != b"\n":
+                line = b"\n" + line
+        fh.write(line)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def _append(path, rows):
+    """Append ``rows`` to ``path`` as one gzip member, then record the member in the file's index."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "ab") as raw:
+        offset = raw.tell()
+        with gzip.GzipFile(fileobj=raw, mode="ab") as fh:
+            for row in rows:
+                fh.write(json.dumps(row, ensure_ascii=False).encode() + b"\n")
+        raw.flush()
+        os.fsync(raw.fileno())
+        length = raw.tell() - offset
+    first, last = min(rows, key=_row_key), max(rows, key=_row_key)
+    # A crash before this line leaves a member no reader finds, and its rows live to be archived again
+    entry = {
+        "offset": offset,
+        "length": length,
+        "first": [first["timestamp"], first["id"]],
+        "last": [last["timestamp"], last["id"]],
+    }
+    _append_line(_index_path(path), json.dumps(entry).encode() + b"\n")
+
+
+def _delete(messages):
+    """Delete ``messages`` and take them out of their room in one transaction."""
+    using = router.db_for_write(Message)
+    connection = connections[using]
+    table = connection.ops.quote_name(Message._meta.db_table)
+    ids = [message.pk for message in messages]
+    with transaction.atomic(using=using):
+        # A plain DELETE rather than one post_delete signal, and one room UPDATE, per message
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+        Room.objects.using(using).forget_messages(messages)
+
+
+def expired(room, cutoff):
+    """``room``'s messages older than ``cutoff``, oldest first (served from ``room_timestamp_id_idx``)."""
+    return Message.objects.filter(room=room, timestamp__lt=cutoff).order_by("timestamp", "pk")
+
+
+def archive_room(room, cutoff, batch_size=None, pause=0):
+    """
+    Move ``room``'s messages older than ``cutoff`` to its archive files;
+    returns the number of messages archived. ``pause`` seconds between
+    batches leave the database to other writers.
+    """
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    archived = 0
+    while True:
+        batch = list(expired(room, cutoff).select_related("user")[:batch_size])
+        if not batch:
+            break
+        by_month = {}
+        for message in batch:
+            by_month.setdefault(_month(message.timestamp), []).append(message_row(message))
+        for month, rows in by_month.items():
+            _append(archive_dir() / str(room.pk) / f"{_month_name(month)}{SUFFIX}", rows)
+        # Readers see the new members before the rows leave the database
+        (archive_dir() / STAMP).touch()
+        _delete(batch)
+        archived += len(batch)
+        if len(batch) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    if archived:
+        async_to_sync(cluster.discard_history)([room.pk])
+    return archived
+
+
+# Reading
+
+def _list(room_id):
+    """Archive files by month, newest month first; all rooms' files when ``room_id`` is None."""
+    root = archive_dir()
+    if room_id is not None:
+        directories = [root / str(room_id)]
+    elif root.is_dir():
+        directories = [path for path in root.iterdir() if path.is_dir()]
+    else:
+        directories = []
+    by_month = {}
+    for directory in directories:
+        if not directory.is_dir():
+            continue
+        for path in directory.iterdir():
+            if path.name.endswith(SUFFIX):
+                by_month.setdefault(path.name[: -len(SUFFIX)], []).append(path)
+    return [by_month[month] for month in sorted(by_month, reverse=True)]
+
+
+def _load_index(path):
+    """``(first key, last key, offset, length)`` of each member of ``path``, or None for a file without an index."""
+    try:
+        with open(_index_path(path), "rb") as fh:
+            lines = fh.read().splitlines()
+    except FileNotFoundError:
+        return None
+    members = []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # Cut short by a crash; its member's rows were archived again
+            continue
+        first, last = entry["first"], entry["last"]
+        members.append(
+            ((parse_datetime(first[0]), first[1]), (parse_datetime(last[0]), last[1]), entry["offset"], entry["length"])
+        )
+    return members
+
+
+class ArchiveIndex:
+    """
+    The archive directory listing and the parsed indexes of its files,
+    kept until ``archive_room`` touches the stamp, so a history page that
+    reaches the archives costs one ``stat`` instead of a listing of every
+    room's directory.
+    """
+
+    def __init__(self):
+        self._stamp = None
+        self._files = {}
+        self._members = {}
+
+    def _check(self):
+        root = archive_dir()
+        try:
+            modified = (root / STAMP).stat().st_mtime_ns
+        except FileNotFoundError:
+            modified = None
+        if (str(root), modified) != self._stamp:
+            self._stamp = (str(root), modified)
+            self._files = {}
+            self._members = {}
+
+    def files(self, room_id):
+        self._check()
+        if room_id not in self._files:
+            self._files[room_id] = _list(room_id)
+        return self._files[room_id]
+
+    def members(self, path):
+        """The index of ``path``, as of the last ``files`` call."""
+        if path not in self._members:
+            self._members[path] = _load_index(path)
+        return self._members[path]
+
+    def clear(self):
+        self._stamp = None
+        self._files = {}
+        self._members = {}
+
+
+archive_index = ArchiveIndex()
+
+
+def has_archive(room_id=None):
+    return bool(archive_index.files(room_id))
+
+
+def _read(path, offset=0, length=None):
+    """The rows of ``path``, or of its gzip member at ``offset``."""
+    with open(path, "rb") as fh:
+        fh.seek(offset)
+        data = gzip.decompress(fh.read(length) if length is not None else fh.read())
+    for line in data.splitlines():
+        yield json.loads(line)
+
+
+def _newest(paths, before, count):
+    """
+    The ``count`` newest ``((timestamp, id), row)`` of ``paths`` older than
+    the key ``before``, newest first, each id once. Indexed members are read
+    newest first, stopping once the rest can only hold older rows.
+    """
+    seen = set()
+    found = []
+
+    def collect(rows):
+        for row in rows:
+            if row["id"] in seen:
+                continue
+            seen.add(row["id"])
+            key = _row_key(row)
+            if before is None or key < before:
+                found.append((key, row))
+
+    members = []
+    for path in paths:
+        index = archive_index.members(path)
+        if index is None:
+            collect(_read(path))
+        else:
+            members.extend((last, first, path, offset, length) for first, last, offset, length in index)
+    found = heapq.nlargest(count, found, key=lambda item: item[0])
+    for last, first, path, offset, length in sorted(members, key=lambda member: member[0], reverse=True):
+        if len(found) >= count and last < found[-1][0]:
+            break
+        if before is not None and first >= before:
+            continue
+        collect(_read(path, offset, length))
+        found = heapq.nlargest(count, found, key=lambda item: item[0])
+    return found
+
+
+def page_before(room_id=None, cursor=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Same contract as ``chat.pagination.page_before``, over the archived
+    messages of ``room_id`` (or of every room). Only the months at or
+    before the cursor are read, one month at a time, and only the rows
+    on the page are turned into messages.
+    """
+    before = _key(cursor) if cursor else None
+    found = []
+    for paths in archive_index.files(room_id):
+        if before is not None and paths[0].name[: -len(SUFFIX)] > _month_name(_month(before[0])):
+            continue
+        found.extend(_newest(paths, before, limit + 1 - len(found)))
+        if len(found) > limit:
+            break
+    has_older = len(found) > limit
+    window = [message_from_row(row) for _, row in reversed(found[:limit])]
+    next_cursor = encode_cursor(window[0]) if has_older else None
+    return window, next_cursor
+
+
+def extend_page(page, room_id=None, cursor=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Continue ``page``, the result of ``page_before`` over live messages
+    older than ``cursor``, into the archives once it reaches the oldest
+    live message.
+    """
+    window, next_cursor = page
+    if next_cursor is not None or not has_archive(room_id):
+        return page
+    boundary = window[0] if window else cursor
+    if len(window) == limit:
+        # Full page: only whether anything older is archived matters
+        older, _ = page_before(room_id, cursor=boundary, limit=1)
+        return window, encode_cursor(window[0]) if older else None
+    older, next_cursor = page_before(room_id, cursor=boundary, limit=limit - len(window))
+    return older + list(window), next_cursor
@@ -0,0 +1,102 @@
+"""Helpers shared by the ``bench*`` management commands."""
+
+import json
+import subprocess
+import time
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .models import Message, Room
+
+
+class Rollback(Exception):
+    """Raised to discard the rows a benchmark created."""
+
+
+@contextmanager
+def throwaway_data(keep=False):
+    """Run the block in a transaction that is rolled back unless ``keep`` is set."""
+    try:
+        with transaction.atomic():
+            yield
+            if not keep:
+                raise Rollback
+    except Rollback:
+        pass
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of ``samples``."""
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    """p50/p95/p99/mean of ``samples`` (seconds) in milliseconds."""
+    if not samples:
+        return {"count": 0, "p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "mean_ms": 0.0}
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+    }
+
+
+def timed(func, repeat):
+    """Call ``func`` ``repeat`` times and return the individual durations."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_rooms(count):
+    """Create (or reuse) ``count`` rooms named ``bench-<n>``."""
+    existing = {room.name: room for room in Room.objects.filter(name__startswith="bench-")}
+    rooms = []
+    for i in range(count):
+        name = f"bench-{i}"
+        rooms.append(existing.get(name) or Room.objects.create(name=name))
+    return rooms
+
+
+def seed_messages(rooms, count, batch_size=5000, user=None, content=None):
+    """Insert ``count`` messages spread round-robin over ``rooms``; ``content(i)`` sets the text of the i-th."""
+    if user is None:
+        user, _ = User.objects.get_or_create(username="bench_user")
+    for offset in range(0, count, batch_size):
+        Message.objects.bulk_create(
+            [
+                Message(
+                    room=rooms[i % len(rooms)], user=user,
+                    content=content(i) if content else f"Benchmark message {i}",
+                )
+                for i in range(offset, min(offset + batch_size, count))
+            ],
+            batch_size=batch_size,
+        )
+    return user
+
+
+def git_revision():
+    """The current commit, so saved results can be compared across commits."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path, results):
+    with open(path, "w") as fh:
+        json.dump({"commit": git_revision(), "results": results}, fh, indent=2, default=str)
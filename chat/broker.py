@@ -0,0 +1,86 @@
+"""
+A small pub/sub broker linking the nodes of a deployment.
+
+It stands in for Redis pub/sub when running several workers on one
+machine (``manage.py runbroker``; see ``chat.layers.BrokerChannelLayer``).
+Clients subscribe to topics and publish opaque payloads; the broker
+forwards each payload once to every other connection subscribed to the
+topic, without decoding it. Frames are a 4-byte big-endian length
+followed by a msgpack array. A subscriber that stops reading has
+payloads dropped once ``max_buffer`` bytes are waiting for it, so one
+stalled node cannot grow the broker's memory.
+"""
+
+import asyncio
+import struct
+from collections import Counter, defaultdict
+
+import msgpack
+
+HEADER = struct.Struct(">I")
+
+# Bytes queued for one subscriber before its payloads are dropped
+MAX_BUFFER = 16 * 1024 * 1024
+
+
+def pack_frame(*fields):
+    body = msgpack.packb(fields, use_bin_type=True)
+    return HEADER.pack(len(body)) + body
+
+
+async def read_frame(reader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return msgpack.unpackb(await reader.readexactly(length), raw=False)
+
+
+class Broker:
+    def __init__(self, max_buffer=MAX_BUFFER):
+        self.max_buffer = max_buffer
+        self.topics = defaultdict(set)
+        self.stats = Counter()
+
+    async def handle(self, reader, writer):
+        subscriptions = set()
+        try:
+            while True:
+                op, topic, *payload = await read_frame(reader)
+                if op == "sub":
+                    self.topics[topic].add(writer)
+                    subscriptions.add(topic)
+                elif op == "unsub":
+                    self._unsubscribe(topic, writer)
+                    subscriptions.discard(topic)
+                elif op == "pub":
+                    self.publish(topic, payload[0], writer)
+                    # Push back on a publisher that outruns its own socket
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            for topic in subscriptions:
+                self._unsubscribe(topic, writer)
+            writer.close()
+
+    def publish(self, topic, payload, sender=None):
+        frame = pack_frame("msg", topic, payload)
+        self.stats["published"] += 1
+        for subscriber in self.topics.get(topic, ()):
+            if subscriber is sender:
+                # Publishers deliver to their own node directly
+                continue
+            if subscriber.transport.get_write_buffer_size() > self.max_buffer:
+                self.stats["dropped"] += 1
+                continue
+            subscriber.write(frame)
+            self.stats["forwarded"] += 1
+
+    def _unsubscribe(self, topic, writer):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.topics[topic]
+
+    async def serve(self, host="127.0.0.1", port=0):
+        """Start listening and return the ``asyncio.Server``; ``port=0`` picks a free port."""
+        return await asyncio.start_server(self.handle, host, port)
@@ -0,0 +1,82 @@
+"""Process-wide cache of Room rows used by the WebSocket consumers."""
+
+import time
+
+from django.conf import settings
+
+from .constants import ROOM_CACHE_TTL
+from .models import Room
+
+
+class RoomCache:
+    """
+    Async cache of Room instances keyed by slug and by name.
+    Entries expire after ``ttl`` seconds and are dropped whenever a room
+    is saved or deleted (see ``chat.signals``).
+    """
+
+    def __init__(self, ttl=None):
+        self._ttl = ttl
+        self._by_slug = {}
+        self._by_name = {}
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, "CHAT_ROOM_CACHE_TTL", ROOM_CACHE_TTL)
+
+    def _lookup(self, index, key):
+        entry = index.get(key)
+        if entry is None:
+            return None
+        room, expires_at = entry
+        if expires_at <= time.monotonic():
+            self.invalidate(room)
+            return None
+        return room
+
+    def _store(self, room):
+        expires_at = time.monotonic() + self.ttl
+        self._by_slug[room.slug] = (room, expires_at)
+        self._by_name[room.name] = (room, expires_at)
+        return room
+
+    def get(self, slug):
+        """Return the room with the given slug, hitting the database on a miss."""
+        room = self._lookup(self._by_slug, slug)
+        if room is None:
+            room = self._store(Room.objects.get(slug=slug))
+        return room
+
+    async def aget(self, slug):
+        """Return the room with the given slug, hitting the database on a miss."""
+        room = self._lookup(self._by_slug, slug)
+        if room is None:
+            room = self._store(await Room.objects.aget(slug=slug))
+        return room
+
+    async def aget_or_create(self, name, defaults=None):
+        """Return the room with the given name, creating it if needed."""
+        room = self._lookup(self._by_name, name)
+        if room is None:
+            room, _ = await Room.objects.aget_or_create(name=name, defaults=defaults)
+            self._store(room)
+        return room
+
+    def invalidate(self, room):
+        """Drop every entry pointing at ``room``."""
+        for index in (self._by_slug, self._by_name):
+            for key, (cached, _) in list(index.items()):
+                if cached.pk == room.pk:
+                    del index[key]
+
+    def clear(self):
+        self._by_slug.clear()
+        self._by_name.clear()
+
+    def __len__(self):
+        return len(self._by_slug)
+
+
+room_cache = RoomCache()
@@ -0,0 +1,116 @@
+"""
+Admin changelist pieces for tables too large to count or page by offset.
+
+``EstimatedCountPaginator`` reads the row count of an unfiltered table
+from the database's statistics and stops counting a filtered one at
+``ADMIN_COUNT_LIMIT``. ``KeysetChangeList`` pages through messages with
+an opaque ``cursor`` parameter instead of ``?p=<n>``, so a deep page
+costs the same as the first. It applies to the message admin's default
+``(-timestamp, -id)`` order and to search results in id order; other
+orderings fall back to numbered pages.
+"""
+
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import PAGE_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .constants import ADMIN_COUNT_LIMIT
+from .pagination import decode_id, encode_cursor, older_than
+
+CURSOR_VAR = "cursor"
+
+
+def estimated_count(model, using="default"):
+    """A cheap estimate of the number of rows in ``model``'s table, or None if the database has none."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            # Kept up to date by autovacuum; -1 until the table is first analyzed
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+            row = cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+        if connection.vendor == "sqlite":
+            # Both ends of the rowid b-tree, so only deleted rows make this an overestimate
+            cursor.execute(f'SELECT MAX(rowid) - MIN(rowid) + 1 FROM "{table}"')
+            row = cursor.fetchone()
+            return row[0] or 0
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """A paginator whose ``count`` never scans a whole table; ``estimated`` tells whether it is exact."""
+
+    estimated = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model, queryset.db)
+            if estimate is not None:
+                self.estimated = True
+                return estimate
+        count = queryset[:ADMIN_COUNT_LIMIT].count()
+        self.estimated = count >= ADMIN_COUNT_LIMIT
+        return count
+
+
+class KeysetChangeList(ChangeList):
+    """A changelist that pages through messages by cursor when its ordering allows it."""
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Filter, sort and search links start again from the newest rows
+        return super().get_query_string(new_params, [*(remove or ()), CURSOR_VAR])
+
+    def _keyset(self):
+        """``"timestamp"`` or ``"id"`` when the rows are ordered by a key the cursor can follow, else None."""
+        # The model admin's ordering can appear twice; only the distinct keys matter
+        ordering = tuple(dict.fromkeys(self.queryset.query.order_by))
+        if ordering == ("-timestamp", "-pk"):
+            return "timestamp"
+        if ordering == ("-pk",):
+            return "id"
+        return None
+
+    def get_results(self, request):
+        self.keyset = self._keyset()
+        if self.keyset is None or self.show_all:
+            super().get_results(request)
+            self.count_estimated = getattr(self.paginator, "estimated", False)
+            return
+
+        self.cursor = request.GET.get(CURSOR_VAR)
+        queryset = self.queryset
+        if self.cursor:
+            try:
+                if self.keyset == "timestamp":
+                    queryset = queryset.filter(older_than(self.cursor))
+                else:
+                    queryset = queryset.filter(pk__lt=decode_id(self.cursor))
+            except ValueError:
+                raise IncorrectLookupParameters
+        window = list(queryset[: self.list_per_page + 1])
+        self.result_list = window[: self.list_per_page]
+        last = self.result_list[-1] if len(window) > self.list_per_page else None
+        next_cursor = None
+        if last is not None:
+            next_cursor = encode_cursor(last) if self.keyset == "timestamp" else str(last.pk)
+
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.count_estimated = getattr(self.paginator, "estimated", False)
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = bool(self.cursor or next_cursor)
+        self.newest_url = self.get_query_string(remove=[PAGE_VAR]) if self.cursor else None
+        self.older_url = self.get_query_string({CURSOR_VAR: next_cursor}, [PAGE_VAR]) if next_cursor else None
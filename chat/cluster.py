@@ -0,0 +1,170 @@
+"""
+Coordination between the nodes of a multi-node deployment.
+
+A socket may be served by any node, but each room's presence set and
+history buffer live on the room's owner (``chat.sharding.owner``).
+Consumers report joins and leaves through ``cluster``, which records them
+locally for rooms this node owns and otherwise sends them to the owner's
+service channel. The service on the owner keeps the presence set,
+announces users coming and going, answers "who is online" requests from
+other nodes, drops history buffers that management commands made stale,
+and adds itself to the groups of the rooms it owns so their
+buffers see every broadcast even when no local socket is in the room.
+
+With an in-process channel layer there is one node and no service.
+"""
+
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .constants import CLUSTER_RPC_TIMEOUT
+from .frames import signal_event
+from .history import room_history
+from .presence import presence
+from . import sharding
+
+logger = logging.getLogger(__name__)
+
+
+class Cluster:
+    def __init__(self):
+        self._service = None
+        self._watched = set()
+
+    @property
+    def rpc_timeout(self):
+        return getattr(settings, "CHAT_CLUSTER_RPC_TIMEOUT", CLUSTER_RPC_TIMEOUT)
+
+    async def join(self, consumer):
+        """Register an accepted socket with the heartbeat and its room's presence set."""
+        self.start()
+        presence.register(consumer)
+        await self._member("presence.join", consumer.room.pk, consumer.user.pk, consumer.channel_name,
+                           consumer.user.username)
+
+    async def leave(self, consumer):
+        """Undo ``join``; safe to call more than once."""
+        if presence.unregister(consumer):
+            await self._member("presence.leave", consumer.room.pk, consumer.user.pk, consumer.channel_name)
+
+    async def _member(self, event_type, room_id, user_id, channel_name, username=None):
+        event = {"type": event_type, "room": room_id, "user": user_id, "channel": channel_name,
+                 "username": username}
+        if sharding.is_owner(room_id):
+            await self.handle(event)
+        else:
+            await get_channel_layer().send(sharding.node_channel(sharding.owner(room_id)), event)
+
+    async def online(self, room_id):
+        """``{user id: username}`` of everyone in the room, asking its owner when that is another node."""
+        if sharding.is_owner(room_id):
+            return presence.online(room_id)
+        layer = get_channel_layer()
+        reply = await layer.new_channel()
+        await layer.send(sharding.node_channel(sharding.owner(room_id)),
+                         {"type": "presence.online", "room": room_id, "reply": reply})
+        try:
+            response = await asyncio.wait_for(layer.receive(reply), self.rpc_timeout)
+        except asyncio.TimeoutError:
+            # The owner is down or busy: this node's own sockets are better than nothing
+            return presence.local_online(room_id)
+        return {user_id: username for user_id, username in response["users"]}
+
+    # Owner side
+
+    async def handle(self, event):
+        room_id = event.get("room")
+        if event["type"] == "chat.message":
+            room_history.record(room_id, event)
+        elif event["type"] == "history.discard":
+            room_history.discard(room_id)
+        elif event["type"] == "presence.join":
+            first = presence.add_member(room_id, event["user"], event["username"], event["channel"])
+            await self.watch(room_id)
+            if first:
+                await self._announce(room_id, event, True)
+        elif event["type"] == "presence.leave":
+            if presence.remove_member(room_id, event["user"], event["channel"]):
+                await self._announce(room_id, event, False)
+            if not presence.online(room_id):
+                await self.unwatch(room_id)
+        elif event["type"] == "presence.online":
+            users = [[user_id, username] for user_id, username in presence.online(room_id).items()]
+            await get_channel_layer().send(event["reply"], {"type": "presence.members", "users": users})
+
+    async def discard_history(self, room_ids):
+        """
+        Drop the history buffers of ``room_ids`` in every process that may
+        trust one, after their messages were changed outside the consumers.
+        Those processes are the ones in the rooms' groups: the owner's
+        service and the nodes with a local socket in the room.
+        """
+        layer = get_channel_layer()
+        for room_id in room_ids:
+            room_history.discard(room_id)
+            await layer.group_send(sharding.room_group(room_id), {"type": "history.discard", "room": room_id})
+
+    async def _announce(self, room_id, event, online):
+        payload = {"type": "presence", "user": event["user"], "online": online}
+        await get_channel_layer().group_send(sharding.room_group(room_id), signal_event(payload, event["channel"]))
+
+    async def watch(self, room_id):
+        """Have the service receive an owned room's broadcasts, keeping its history buffer current."""
+        if sharding.local_layer() or room_id in self._watched:
+            return
+        self._watched.add(room_id)
+        self.start()
+        await get_channel_layer().group_add(sharding.room_group(room_id), sharding.node_channel(sharding.node_id()))
+        room_history.watch(room_id)
+
+    async def unwatch(self, room_id):
+        if room_id not in self._watched:
+            return
+        self._watched.discard(room_id)
+        room_history.unwatch(room_id)
+        await get_channel_layer().group_discard(sharding.room_group(room_id), sharding.node_channel(sharding.node_id()))
+
+    def start(self):
+        """Run the service on the current event loop, unless it already runs there."""
+        if sharding.local_layer():
+            return
+        loop = asyncio.get_running_loop()
+        if self._service is None or self._service.done() or self._service.get_loop() is not loop:
+            # Resolved here so a misconfigured node fails its first request, not a background task
+            channel = sharding.node_channel(sharding.node_id())
+            self._service = loop.create_task(self._serve(channel))
+
+    async def _serve(self, channel):
+        layer = get_channel_layer()
+        while True:
+            event = await layer.receive(channel)
+            if event["type"] == "chat.signal":
+                continue
+            try:
+                await self.handle(event)
+            except Exception:
+                logger.exception("Cluster event %s failed", event.get("type"))
+
+    def clear(self):
+        self._watched.clear()
+
+
+cluster = Cluster()
+
+
+class ClusterMiddleware:
+    """
+    Starts the node service on the first request of any kind, so a node
+    answers its owned rooms as soon as it takes traffic (daphne sends no
+    ASGI lifespan events to start it earlier).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        cluster.start()
+        return await self.app(scope, receive, send)
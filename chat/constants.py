@@ -4,17 +4,93 @@ ROOM_VERBOSE_NAME = "Room"
 ROOM_VERBOSE_NAME_PLURAL = "Rooms"
 ROOM_ORDERING = ["name"]
 ROOM_DESCRIPTION_PREVIEW_LENGTH = 30
+ROOM_SLUG_SAVE_ATTEMPTS = 3  # retries when a concurrent save takes the same slug
+ROOM_SLUG_FALLBACK = "room"  # slug base of names with nothing to slugify, e.g. "聊天" or "!!!"
+ROOM_LIST_SIZE = 50  # rooms in the activity-ordered room list
 
 # Message constants
 MESSAGE_ORDERING = ["-timestamp"]
 MESSAGE_CONTENT_PREVIEW_LENGTH = 50
 MESSAGE_VERBOSE_NAME = "Message"
 MESSAGE_VERBOSE_NAME_PLURAL = "Messages"
+MESSAGE_PAGE_SIZE = 50  # messages per history page
 
-# Bot responses
+# Read cursor constants
+READ_CURSOR_VERBOSE_NAME = "Read Cursor"
+READ_CURSOR_VERBOSE_NAME_PLURAL = "Read Cursors"
+
+# Bot responses (defaults for chat.responders.RandomResponder)
+BOT_RESPONDER = "chat.responders.RandomResponder"
+BOT_REPLY_DELAY = 1.5  # seconds of simulated typing
+BOT_MAX_CONCURRENT_REPLIES = 2  # per connection
+BOT_MAX_PENDING_REPLIES = 10  # per connection, further replies are dropped
 BOT_RESPONSE = [
     "Hi there! How can I help you today?",
     "I'm here to assist you. What do you need help with?",
     "That's intriguing! Could you elaborate more?",
     "Great point! Let me know if there's anything you'd like to discuss further.",
 ]
+
+# Consumer defaults
+DEFAULT_ROOM_NAME = "General Chat"
+DEFAULT_ROOM_DESCRIPTION = "General discussion room"
+ROOM_CACHE_TTL = 300  # seconds
+
+# Write-behind persistence (chat.persistence)
+WRITE_BEHIND_BATCH_SIZE = 200
+WRITE_BEHIND_FLUSH_INTERVAL = 0.01  # seconds
+WRITE_BEHIND_MAX_PENDING = 2000
+
+# Encoded frame cache (chat.frames)
+FRAME_CACHE_SIZE = 1024
+FRAME_FORMAT = "json"  # or "html" for htmx hx-swap-oob fragments
+
+# Rate limiting and flow control (chat.throttle)
+CONNECTION_RATE_LIMIT = (5, 10)  # frames per second, burst
+USER_RATE_LIMIT = (10, 20)  # frames per second, burst, across all of a user's sockets
+USER_BUCKETS_MAX = 10000
+SEND_QUEUE_SIZE = 256  # frames buffered per socket before the policy kicks in
+SEND_QUEUE_POLICY = "drop"  # or "coalesce"
+
+# Metrics (chat.metrics)
+METRICS_MAX_SERIES = 100  # label combinations per metric before folding into "other"
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# In-memory room history (chat.history) and reconnect with resume
+HISTORY_ROOM_SIZE = 200  # newest messages kept per room
+HISTORY_CACHE_BYTES = 16 * 1024 * 1024  # estimated size across rooms before idle rooms are evicted
+HISTORY_TTL = 60  # seconds before a buffer is warmed again, to pick up writes made by other processes
+RESUME_CHUNK_SIZE = 100  # messages read and queued at a time
+RESUME_MAX_MESSAGES = 1000  # larger gaps tell the client to reload history instead
+
+# Typing indicators (chat.typing_status)
+TYPING_INTERVAL = 1.0  # seconds between typing state broadcasts per user per room
+TYPING_TIMEOUT = 5.0  # seconds after the last typing frame before a user is shown idle
+TYPING_TICK = 0.1  # timer wheel resolution, in seconds
+
+# Presence and heartbeat (chat.presence)
+HEARTBEAT_INTERVAL = 25.0  # seconds a socket may stay silent before it is pinged
+IDLE_TIMEOUT = 60.0  # seconds a socket may stay silent before it is closed
+IDLE_CLOSE_CODE = 4008  # close code sent to reaped sockets
+PRESENCE_TICK = 1.0  # timer wheel resolution, in seconds
+
+# Multi-node deployments (chat.sharding, chat.layers, chat.cluster)
+SHARD_REPLICAS = 256  # virtual points per node on the consistent hash ring
+BROKER_PORT = 6390  # default port of `manage.py runbroker`
+CLUSTER_RPC_TIMEOUT = 1.0  # seconds to wait for a room owner before answering locally
+
+# Full-text message search (chat.search)
+SEARCH_CONFIG = "english"  # Postgres text search configuration of the GIN index
+SEARCH_MAX_TERMS = 8
+SEARCH_PAGE_SIZE = 20
+
+# Admin changelists of large tables (chat.changelist)
+ADMIN_COUNT_LIMIT = 10000  # filtered changelists count at most this many rows
+
+# Retention and archival of old messages (chat.archive)
+RETENTION_DAYS = None  # site default for rooms without their own; None keeps messages forever
+ARCHIVE_BATCH_SIZE = 1000  # messages archived and deleted per transaction
+
+# Export and import of chat history (chat.transfer)
+TRANSFER_CHUNK_SIZE = 2000  # messages fetched per query when exporting
+IMPORT_BATCH_SIZE = 5000  # messages per bulk_create and room counter update when importing
@@ -1,65 +1,357 @@
-import json
-import random
 import asyncio
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.utils import timezone
-from .models import Message, Room
+from . import metrics, protocol
+from .cache import room_cache
+from .cluster import cluster
+from .constants import (
+    DEFAULT_ROOM_NAME,
+    DEFAULT_ROOM_DESCRIPTION,
+    FRAME_FORMAT,
+    IDLE_CLOSE_CODE,
+    BOT_MAX_CONCURRENT_REPLIES,
+    BOT_MAX_PENDING_REPLIES,
+    RESUME_CHUNK_SIZE,
+    RESUME_MAX_MESSAGES,
+)
+from .frames import TYPED_FORMATS, encode_message, message_fragment, message_frame, signal_event, typed_frame
+from .history import room_history
+from .models import Message, ReadCursor, Room
+from .persistence import write_buffer
+from .presence import presence
+from .sharding import room_group
+from .responders import get_responder
+from .throttle import OutboundQueue, connection_bucket, counters, user_buckets
+from .typing_status import typing_tracker
+
+logger = logging.getLogger(__name__)
+
+
+# Message ids are BIGINTs; larger client-supplied ids would fail in the query
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+
+def is_message_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= MAX_MESSAGE_ID
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    @metrics.instrument(metrics.consumer_seconds, method="connect")
     async def connect(self):
-        await self.accept()
+        # Resolve the user and room once for the lifetime of the socket
+        self.user, _ = await self.get_or_create_user()
+        room_slug = self.scope["url_route"]["kwargs"].get("room_slug")
+        if room_slug is None:
+            self.room = await self.get_or_create_room()
+        else:
+            try:
+                self.room = await room_cache.aget(room_slug)
+            except Room.DoesNotExist:
+                await self.close()
+                return
+
+        # Clients pick a frame format with a subprotocol or ?format= (see chat.protocol)
+        self.frame_format, subprotocol = protocol.negotiate(
+            self.scope, getattr(settings, "CHAT_FRAME_FORMAT", FRAME_FORMAT)
+        )
+        self.typed = self.frame_format in TYPED_FORMATS
+        # Typed clients and the htmx page answer pings; plain JSON clients
+        # are left to the server's WebSocket-level pings
+        self.heartbeat = self.typed or self.frame_format == "html"
+
+        # Everyone connected to the room receives its messages through the channel layer
+        self.group_name = room_group(self.room.pk)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        # Warm the room's history now so live broadcasts are buffered with their frames
+        room_history.join(self.room)
+        await room_history.aget(self.room)
+
+        # Live messages are held back while a resume replay is being sent
+        self.held = None
+
+        self.rate_limit = connection_bucket()
+
+        # Bot replies run in the background so the receive loop never waits on them
+        self.responder = get_responder()
+        self.bot_replies = set()
+        self.bot_slots = asyncio.Semaphore(
+            getattr(settings, "CHAT_BOT_MAX_CONCURRENT_REPLIES", BOT_MAX_CONCURRENT_REPLIES)
+        )
+        await self.accept(subprotocol)
+
+        # Outgoing frames are buffered up to a limit so a slow reader cannot grow memory without bound
+        self.outbound = OutboundQueue(self.send_frame)
+
+        # Joins the heartbeat and the room's presence set, on whichever node owns the room
+        await cluster.join(self)
+
+        if metrics.enabled():
+            metrics.connections.inc(room=self.room.slug)
+            metrics.active_sockets.inc(room=self.room.slug)
+
+    @metrics.instrument(metrics.consumer_seconds, method="disconnect")
+    async def disconnect(self, close_code):
+        # Cancel bot replies that have not been delivered yet
+        pending = getattr(self, "bot_replies", ())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        if hasattr(self, "group_name"):
+            await typing_tracker.leave(self.group_name, self.user.pk, self.channel_name)
+            await cluster.leave(self)
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            room_history.leave(self.room)
+        if hasattr(self, "outbound"):
+            await self.outbound.close()
+            if metrics.enabled():
+                metrics.disconnections.inc(room=self.room.slug)
+                metrics.active_sockets.dec(room=self.room.slug)
+
+        # Make sure everything this socket produced reaches the database
+        await write_buffer.drain()
+
+    @metrics.instrument(metrics.consumer_seconds, method="receive")
+    async def receive(self, text_data=None, bytes_data=None):
+        # Any frame, even a throttled one, shows the client is still there
+        presence.seen(self.channel_name)
+        if not self.allow_frame():
+            return
+
+        try:
+            data = protocol.decode(text_data, bytes_data)
+        except protocol.ProtocolError as error:
+            self.outbound.put(self.control_frame({"type": "error", "code": error.code}))
+            return
+
+        if data["type"] == "resume":
+            await self.resume(data.get("last_id"))
+        elif data["type"] == "typing":
+            await self.typing(bool(data.get("active", True)))
+        elif data["type"] == "read":
+            await self.read(data.get("last_id"))
+        elif data["type"] == "ping":
+            self.outbound.put(self.control_frame({"type": "pong"}))
+        elif data["type"] == "pong":
+            pass
+        else:
+            await self.chat(data)
+
+    async def send_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    def control_frame(self, payload):
+        return protocol.control_frame(payload, self.frame_format)
+
+    def ping(self):
+        """Ask a silent client to answer; called by ``presence``."""
+        self.outbound.put(self.control_frame({"type": "ping"}), key="ping")
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_content = data.get("message", "").strip()
+    async def reap(self):
+        """Close a socket that stayed silent past ``CHAT_IDLE_TIMEOUT``; called by ``presence``."""
+        await cluster.leave(self)
+        await self.close(code=IDLE_CLOSE_CODE)
 
-        if not message_content:
+    async def chat(self, data):
+        message_content = data.get("message")
+        if not isinstance(message_content, str) or not message_content.strip():
             return
+        message_content = message_content.strip()
 
-        # For demo purposes, create/use a default user and room
-        user, _ = await self.get_or_create_user()
-        room, _ = await self.get_or_create_room()
+        user, room = self.user, self.room
+        if metrics.enabled():
+            metrics.messages_received.inc(room=room.slug)
 
-        # Save user message to database
-        user_message = await self.save_message(room, user, message_content)
+        # Save user message to database. It is sent to the client as soon as it
+        # is stored, so the read receipt is written with the insert.
+        user_message = await self.save_message(room, user, message_content, read=True)
+        if self.typed:
+            self.outbound.put(self.control_frame({"type": "ack", "ref": data.get("ref"), "id": user_message.pk}))
+        # Sending a message ends the sender's typing state
+        await typing_tracker.update(self.group_name, user.pk, self.channel_name, False)
 
-        # Echo user's message back with read status
-        await self.send(json.dumps({
-            "type": "user",
-            "message": message_content,
-            "id": user_message.id,
-            "timestamp": user_message.timestamp.isoformat()
+        # Broadcast user's message to the room, including this socket
+        await self.broadcast(user_message, "user")
+
+        self.schedule_bot_reply(user_message)
+
+    def allow_frame(self):
+        """Charge the connection and user token buckets, answering with an error frame when empty."""
+        user_bucket = user_buckets.get(self.user.pk)
+        if self.rate_limit.consume():
+            if user_bucket.consume():
+                return True
+            bucket = user_bucket
+        else:
+            bucket = self.rate_limit
+        counters["throttled"] += 1
+        self.outbound.put(self.control_frame({
+            "type": "error",
+            "code": "rate_limited",
+            "retry_after": round(bucket.retry_after(), 3),
         }))
+        return False
+
+    async def resume(self, last_id):
+        """
+        Replay the room's messages newer than ``last_id`` to a reconnecting
+        client, then send a ``resumed`` frame. Small gaps are served from
+        ``room_history``; larger ones are read from the database in chunks
+        of ``CHAT_RESUME_CHUNK_SIZE``, up to ``CHAT_RESUME_MAX_MESSAGES``,
+        past which the frame says ``complete: false`` and the client should
+        reload its history instead.
+        """
+        if not is_message_id(last_id) or self.held is not None:
+            return
+        self.held = []
+        try:
+            entries = await room_history.asince(self.room, last_id)
+            if entries is not None:
+                source, complete = "memory", True
+                replayed_id = await self.replay_frames(
+                    [(entry.message.pk, entry.text(self.frame_format)) for entry in entries]
+                )
+            else:
+                source = "database"
+                replayed_id, complete = await self.replay_rows(last_id)
+        finally:
+            held, self.held = self.held, None
 
-        # Mark message as read (since it's being sent to the client)
-        await self.mark_as_read(user_message)
-
-        # Bot responses
-        bot_responses = [
-            "Hi there! How can I help you today?",
-            "I'm here to assist you. What do you need help with?",
-            "That's intriguing! Could you elaborate more?",
-            "Great point! Let me know if there's anything you'd like to discuss further.",
-        ]
-        bot_message_content = random.choice(bot_responses)
-
-        # Save bot message to database
-        bot_message = await self.save_message(room, user, bot_message_content, is_bot=True)
-
-        # Simulate bot typing delay
-        await asyncio.sleep(1.5)
-        await self.send(json.dumps({
-            "type": "bot",
-            "message": bot_message_content,
-            "id": bot_message.id,
-            "timestamp": bot_message.timestamp.isoformat()
+        replayed = replayed_id if replayed_id is not None else last_id
+        for event in held:
+            if event["id"] > replayed:
+                self.deliver(event)
+        self.outbound.put(self.control_frame({
+            "type": "resumed",
+            "last_id": max([replayed] + [event["id"] for event in held]),
+            "source": source,
+            "complete": complete,
         }))
 
-        # Mark bot message as read
-        await self.mark_as_read(bot_message)
+    async def replay_frames(self, entries):
+        chunk_size = getattr(settings, "CHAT_RESUME_CHUNK_SIZE", RESUME_CHUNK_SIZE)
+        for start in range(0, len(entries), chunk_size):
+            for message_id, text in entries[start:start + chunk_size]:
+                self.outbound.put(text)
+            # Queue one chunk at a time so the send queue never overflows
+            await self.outbound.join()
+        return entries[-1][0] if entries else None
+
+    @metrics.instrument(metrics.db_seconds, operation="resume")
+    async def replay_rows(self, last_id):
+        chunk_size = getattr(settings, "CHAT_RESUME_CHUNK_SIZE", RESUME_CHUNK_SIZE)
+        limit = getattr(settings, "CHAT_RESUME_MAX_MESSAGES", RESUME_MAX_MESSAGES)
+        cursor, replayed_id, sent = last_id, None, 0
+        while sent < limit:
+            rows = [
+                message async for message in
+                Message.objects.filter(room=self.room, pk__gt=cursor).order_by("pk")[:min(chunk_size, limit - sent)]
+            ]
+            if not rows:
+                return replayed_id, True
+            await self.replay_frames([
+                (message.pk, encode_message(message, "history", self.frame_format)) for message in rows
+            ])
+            cursor = replayed_id = rows[-1].pk
+            sent += len(rows)
+        more = await Message.objects.filter(room=self.room, pk__gt=cursor).aexists()
+        return replayed_id, not more
+
+    def schedule_bot_reply(self, user_message):
+        max_pending = getattr(settings, "CHAT_BOT_MAX_PENDING_REPLIES", BOT_MAX_PENDING_REPLIES)
+        if len(self.bot_replies) >= max_pending:
+            # The bot is too far behind this client, skip the reply
+            return
+        task = asyncio.create_task(self.bot_reply(user_message))
+        self.bot_replies.add(task)
+        task.add_done_callback(self.bot_reply_done)
+
+    def bot_reply_done(self, task):
+        self.bot_replies.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            # The user's message is already saved and echoed, only the reply is lost
+            logger.error("Bot reply failed in room %s", self.room.slug, exc_info=exc)
+
+    async def bot_reply(self, user_message):
+        async with self.bot_slots:
+            bot_message_content = await self.responder.respond(user_message)
+
+        # Save bot message to database, already read since it is delivered right away
+        bot_message = await self.save_message(
+            self.room, self.user, bot_message_content, is_bot=True, read=True
+        )
+
+        await self.broadcast(bot_message, "bot")
 
+    async def broadcast(self, message, kind):
+        # Every frame format is encoded once here, not once per recipient
+        frames = {"json": message_frame(message, kind), "html": message_fragment(message, kind)}
+        for frame_format in TYPED_FORMATS:
+            frames[frame_format] = typed_frame(message, kind, frame_format)
+        await self.channel_layer.group_send(self.group_name, {
+            "type": "chat.message",
+            "room": self.room.pk,
+            "id": message.pk,
+            "kind": kind,
+            # Enough of the row for other processes to add it to their room history
+            "row": {
+                "user_id": message.user_id,
+                "content": message.content,
+                "timestamp": message.timestamp.isoformat(),
+            },
+            "frames": frames,
+        })
+
+    async def chat_message(self, event):
+        room_history.record(self.room.pk, event)
+        if self.held is not None:
+            self.held.append(event)
+            return
+        self.deliver(event)
+
+    async def history_discard(self, event):
+        room_history.discard(event["room"])
+
+    def deliver(self, event):
+        # The frame arrives already serialized, so fan-out costs no encoding or rendering
+        self.outbound.put(event["frames"][self.frame_format])
+
+    async def typing(self, active):
+        """Report a typing frame; ``typing_tracker`` coalesces them and broadcasts state changes."""
+        await typing_tracker.update(self.group_name, self.user.pk, self.channel_name, active)
+
+    async def read(self, last_id):
+        """Advance this user's read cursor and tell the room."""
+        if not is_message_id(last_id):
+            return
+        # A cursor past the room's messages would hide every later one as read
+        if not await Message.objects.filter(room=self.room, pk=last_id).aexists():
+            return
+        await ReadCursor.objects.aadvance(self.user, self.room, last_id)
+        await self.signal({"type": "read", "user": self.user.pk, "last_id": last_id})
+
+    async def signal(self, payload):
+        """Send a typed-protocol frame about this socket's user to the rest of the room."""
+        await self.channel_layer.group_send(self.group_name, signal_event(payload, self.channel_name))
+
+    async def chat_signal(self, event):
+        # Typing and read frames exist in the typed protocol, and typing also
+        # as an htmx fragment; plain JSON clients would render them as messages
+        frame = event["frames"].get(self.frame_format)
+        if frame is not None and event["sender"] != self.channel_name:
+            # A newer typing state of the same user replaces one still queued
+            key = event.get("key")
+            self.outbound.put(frame, key=tuple(key) if key else None)
+
+    @metrics.instrument(metrics.db_seconds, operation="get_or_create_user")
     async def get_or_create_user(self):
         # For demo purposes, create a default user
         user, created = await User.objects.aget_or_create(
@@ -68,26 +360,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         return user, created
 
+    @metrics.instrument(metrics.db_seconds, operation="get_or_create_room")
     async def get_or_create_room(self):
-        # For demo purposes, create a default room
-        room, created = await Room.objects.aget_or_create(
-            name="General Chat",
-            defaults={"description": "General discussion room"}
+        # For demo purposes, use a default room shared through the process-wide cache
+        return await room_cache.aget_or_create(
+            DEFAULT_ROOM_NAME,
+            defaults={"description": DEFAULT_ROOM_DESCRIPTION}
         )
-        return room, created
 
-    async def save_message(self, room, user, content, is_bot=False):
+    @metrics.instrument(metrics.db_seconds, operation="save_message")
+    async def save_message(self, room, user, content, is_bot=False, read=False):
         # For bot messages, we could create a bot user, but for simplicity we'll use the same user
-        message = await Message.objects.acreate(
-            room=room,
-            user=user,
-            content=content
-        )
-        return message
-
-    async def mark_as_read(self, message):
-        message.read_at = timezone.now()
-        await message.asave()
+        message = Message(room=room, user=user, content=content)
+        if read:
+            await write_buffer.mark_read(message)
+        # Inserts are batched with those of other consumers by the write-behind buffer
+        return await write_buffer.save(message)
 
 
 """
@@ -95,7 +383,8 @@ TODO: Future Steps to Implement OpenAI Integration:
 1. Install the OpenAI Python SDK: `pip install openai`
 2. Import the `openai` library.
 3. Set up your OpenAI API key securely.
-4. Replace the random bot responses with an OpenAI API call, passing the user_message as input.
-5. Parse the OpenAI API response and send it back to the client.
+4. Subclass `chat.responders.BaseResponder` and make an async OpenAI API call in `respond()`,
+   passing the user message as input, then point the `CHAT_BOT_RESPONDER` setting at it.
+5. Return the parsed OpenAI API response; the consumer saves it and sends it to the client.
 6. Test the integration to ensure proper error handling and response generation.
 """
@@ -0,0 +1,175 @@
+"""Wire frames for chat messages, encoded once and reused."""
+
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.template.loader import get_template
+
+from .constants import FRAME_CACHE_SIZE
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speed-up
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional binary frames
+    msgpack = None
+
+# Version of the typed frame protocol (see chat.protocol)
+PROTOCOL_VERSION = 1
+
+# Formats of the typed protocol, as opposed to the original "json" and "html"
+TYPED_FORMATS = ("v1", "msgpack") if msgpack is not None else ("v1",)
+
+
+def dumps(payload):
+    """Encode ``payload`` as compact JSON text, using orjson when it is installed."""
+    if orjson is not None and getattr(settings, "CHAT_FAST_JSON", True):
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+def encode(payload, frame_format):
+    """Encode a typed protocol ``payload`` as text (``"v1"``) or msgpack bytes (``"msgpack"``)."""
+    payload = {"v": PROTOCOL_VERSION, **payload}
+    if frame_format == "msgpack":
+        return msgpack.packb(payload)
+    return dumps(payload)
+
+
+def signal_event(payload, sender):
+    """
+    A ``chat.signal`` channel event relaying a typed frame about
+    ``payload["user"]`` to the room's other sockets. Consumers' send queues
+    coalesce frames of the same type and user.
+    """
+    return {
+        "type": "chat.signal",
+        "sender": sender,
+        "key": (payload["type"], payload["user"]),
+        "frames": {frame_format: encode(payload, frame_format) for frame_format in TYPED_FORMATS},
+    }
+
+
+class FrameCache:
+    """Small LRU of encoded frames keyed by ``(message id, timestamp, kind)``."""
+
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self._frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        if self._maxsize is not None:
+            return self._maxsize
+        return getattr(settings, "CHAT_FRAME_CACHE_SIZE", FRAME_CACHE_SIZE)
+
+    def get(self, key):
+        frame = self._frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame):
+        self._frames[key] = frame
+        self._frames.move_to_end(key)
+        while len(self._frames) > self.maxsize:
+            self._frames.popitem(last=False)
+
+    def clear(self):
+        self._frames.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+
+frame_cache = FrameCache()
+
+
+def message_payload(message, kind):
+    return {
+        "type": kind,
+        "message": message.content,
+        "id": message.id,
+        "timestamp": message.timestamp.isoformat(),
+    }
+
+
+def message_frame(message, kind):
+    """
+    Return the wire text for ``message``. The frame is built once per
+    message and kept in ``frame_cache`` so broadcasts, reconnects and history
+    replays reuse the same string.
+    """
+    if message.pk is None:
+        return dumps(message_payload(message, kind))
+    # The timestamp guards against ids being reused after a rolled back insert
+    key = (message.pk, message.timestamp, kind)
+    frame = frame_cache.get(key)
+    if frame is None:
+        frame = dumps(message_payload(message, kind))
+        frame_cache.put(key, frame)
+    return frame
+
+
+def typed_payload(message, kind):
+    return {
+        "type": "chat",
+        "id": message.id,
+        "kind": kind,
+        "user": message.user_id,
+        "message": message.content,
+        # Milliseconds since the epoch are shorter than ISO 8601 in every encoding
+        "ts": int(message.timestamp.timestamp() * 1000),
+    }
+
+
+def typed_frame(message, kind, frame_format):
+    """Return ``message`` as a typed protocol frame in ``frame_format``, memoized like ``message_frame``."""
+    if message.pk is None:
+        return encode(typed_payload(message, kind), frame_format)
+    key = (message.pk, message.timestamp, kind, frame_format)
+    frame = frame_cache.get(key)
+    if frame is None:
+        frame = encode(typed_payload(message, kind), frame_format)
+        frame_cache.put(key, frame)
+    return frame
+
+
+def render_fragment(message, kind):
+    # Compiled templates are kept by the cached template loader
+    return get_template("chat/partials/message_oob.html").render({"message": message, "kind": kind})
+
+
+def message_fragment(message, kind):
+    """
+    Return an ``hx-swap-oob`` HTML fragment for ``message``, which the htmx
+    ``ws`` extension appends to ``#chat-messages``. Like ``message_frame``
+    it is rendered once per message and memoized in ``frame_cache``.
+    """
+    if message.pk is None:
+        return render_fragment(message, kind)
+    key = (message.pk, message.timestamp, kind, "html")
+    fragment = frame_cache.get(key)
+    if fragment is None:
+        fragment = render_fragment(message, kind)
+        frame_cache.put(key, fragment)
+    return fragment
+
+
+def encode_message(message, kind, frame_format):
+    """Return the frame for ``message`` in any of the socket frame formats."""
+    if frame_format == "html":
+        return message_fragment(message, kind)
+    if frame_format in TYPED_FORMATS:
+        return typed_frame(message, kind, frame_format)
+    return message_frame(message, kind)
@@ -0,0 +1,393 @@
+"""
+Process-wide ring buffers of each room's newest messages.
+
+A room's buffer is warmed from the database on first access, then kept
+current by every write this process makes and every broadcast it receives,
+so history pages and reconnect replays that fall inside the window are
+served without a query. Buffers are dropped least recently used first once
+their estimated size passes ``CHAT_HISTORY_CACHE_BYTES``. In a multi-node
+deployment only a room's owner (see ``chat.sharding``) keeps its buffer.
+
+Writes made outside the consumers, by management commands, another
+server or raw SQL, never reach the buffers on their own. Commands drop the
+buffers they make stale with ``cluster.discard_history``, and every buffer
+is warmed again ``CHAT_HISTORY_TTL`` seconds after it was filled, which
+bounds how long any other write goes unseen.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .constants import HISTORY_CACHE_BYTES, HISTORY_ROOM_SIZE, HISTORY_TTL, MESSAGE_PAGE_SIZE
+from .frames import encode_message
+from .models import Message
+from .pagination import _key, encode_cursor
+from . import metrics, sharding
+
+# Rough per-entry cost of a Message instance and its bookkeeping
+ENTRY_OVERHEAD = 600
+
+
+class HistoryEntry:
+    """A message with the frames it was broadcast as, when this process saw the broadcast."""
+
+    __slots__ = ("message", "kind", "frames")
+
+    def __init__(self, message, kind=None, frames=None):
+        self.message = message
+        self.kind = kind
+        # Encoded frames by frame format, as carried by the broadcast
+        self.frames = frames
+
+    @property
+    def size(self):
+        frames = self.frames or {}
+        return ENTRY_OVERHEAD + len(self.message.content or "") + sum(len(frame) for frame in frames.values())
+
+    def text(self, frame_format):
+        """The frame to replay to a socket using ``frame_format``."""
+        frame = self.frames.get(frame_format) if self.frames else None
+        if frame is None:
+            # Messages loaded from the database were never broadcast; their
+            # frames are encoded on demand and memoized by ``frame_cache``
+            frame = encode_message(self.message, self.kind or "history", frame_format)
+        return frame
+
+
+class RoomHistory:
+    """
+    The newest messages of one room, in the ``(timestamp, id)`` order that
+    history pages are cut in. The buffer holds every message of the room
+    from ``floor``, the key of its oldest entry, on (all of them when
+    ``floor`` is None), and every message with an id above ``id_floor``,
+    which reconnect replays go by. The two differ when ids and timestamps
+    disagree, e.g. after importing old messages. When the buffer
+    overflows, its oldest entry is dropped and both floors move up.
+    """
+
+    def __init__(self, floor, maxlen, id_floor=0):
+        self.floor = floor
+        self.id_floor = id_floor
+        self.maxlen = maxlen
+        self.size = 0
+        self.warmed_at = time.monotonic()
+        self._keys = []
+        self._entries = []
+        self._by_id = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, message_id):
+        return self._by_id.get(message_id)
+
+    def add(self, entry):
+        message = entry.message
+        if message.pk in self._by_id:
+            return
+        key = (message.timestamp, message.pk)
+        if self.floor is not None and key < self.floor:
+            # Older than the window, so replays past it must read the database
+            self.id_floor = max(self.id_floor, message.pk)
+            return
+        # Broadcasts from other processes may arrive slightly out of order
+        index = bisect_left(self._keys, key)
+        self._keys.insert(index, key)
+        self._entries.insert(index, entry)
+        self._by_id[message.pk] = entry
+        self.size += entry.size
+        if len(self._entries) > self.maxlen:
+            self._keys.pop(0)
+            dropped = self._entries.pop(0)
+            del self._by_id[dropped.message.pk]
+            self.size -= dropped.size
+            self.floor = self._keys[0]
+            self.id_floor = max(self.id_floor, dropped.message.pk)
+
+    def attach(self, entry, kind, frames):
+        """Record the frames ``entry`` was broadcast as."""
+        if entry.kind is None:
+            self.size -= entry.size
+            entry.kind, entry.frames = kind, frames
+            self.size += entry.size
+
+    def since(self, message_id):
+        """Return the entries newer than ``message_id`` by id, or None when the gap reaches past ``id_floor``."""
+        if message_id < self.id_floor:
+            return None
+        return sorted(
+            (entry for entry in self._entries if entry.message.pk > message_id), key=lambda entry: entry.message.pk
+        )
+
+    def page(self, cursor=None, limit=MESSAGE_PAGE_SIZE):
+        """
+        Same contract as ``chat.pagination.page_before``, or None when the
+        page reaches older messages than the buffer holds.
+        """
+        end = bisect_left(self._keys, _key(cursor)) if cursor else len(self._keys)
+        start = max(0, end - limit)
+        if start == 0 and self.floor is not None:
+            # Older messages may exist that only the database knows about
+            return None
+        window = [entry.message for entry in self._entries[start:end]]
+        next_cursor = encode_cursor(window[0]) if start > 0 else None
+        return window, next_cursor
+
+
+def message_from_event(room_id, event):
+    """The Message a ``chat.message`` broadcast carries, without a query."""
+    row = event["row"]
+    return Message(
+        pk=event["id"],
+        room_id=room_id,
+        user_id=row["user_id"],
+        content=row["content"],
+        timestamp=parse_datetime(row["timestamp"]),
+    )
+
+
+class HistoryCache:
+    """
+    ``RoomHistory`` buffers for the rooms this process owns. A buffer is
+    only trusted while the process is guaranteed to see every new message
+    of its room: while one of its sockets is in the room or the node
+    service watches it (so it receives the room's broadcasts), or always
+    with an in-process channel layer.
+    """
+
+    def __init__(self, max_bytes=None, room_size=None):
+        self._max_bytes = max_bytes
+        self._room_size = room_size
+        self._rooms = OrderedDict()
+        self._members = Counter()
+        self._watched = set()
+        self._lock = threading.Lock()
+        # Running total of the buffers' sizes, so eviction checks need no pass over every room
+        self._bytes = 0
+        self.stats = Counter()
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return getattr(settings, "CHAT_HISTORY_CACHE_BYTES", HISTORY_CACHE_BYTES)
+
+    @property
+    def room_size(self):
+        if self._room_size is not None:
+            return self._room_size
+        return getattr(settings, "CHAT_HISTORY_ROOM_SIZE", HISTORY_ROOM_SIZE)
+
+    @property
+    def ttl(self):
+        return getattr(settings, "CHAT_HISTORY_TTL", HISTORY_TTL)
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def _trusted(self, room_id):
+        if sharding.local_layer():
+            return True
+        return sharding.is_owner(room_id) and (self._members[room_id] > 0 or room_id in self._watched)
+
+    def join(self, room):
+        """Note that a local socket receives ``room``'s broadcasts (call after joining its group)."""
+        self._members[room.pk] += 1
+
+    def leave(self, room):
+        self._members[room.pk] -= 1
+        if self._members[room.pk] <= 0:
+            del self._members[room.pk]
+            if not self._trusted(room.pk):
+                # New messages from other processes would be missed from now on
+                self.discard(room.pk)
+
+    def watch(self, room_id):
+        """Note that the node service receives ``room_id``'s broadcasts."""
+        self._watched.add(room_id)
+
+    def unwatch(self, room_id):
+        self._watched.discard(room_id)
+        if not self._trusted(room_id):
+            self.discard(room_id)
+
+    def discard(self, room_id):
+        """Forget a room's buffer; it is warmed again on next access."""
+        with self._lock:
+            buffer = self._rooms.pop(room_id, None)
+            if buffer is not None:
+                self._bytes -= buffer.size
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+            self._bytes = 0
+        self._members.clear()
+        self._watched.clear()
+        self.stats.clear()
+
+    # Lookups
+
+    def _lookup(self, room):
+        with self._lock:
+            buffer = self._rooms.get(room.pk)
+            if buffer is None:
+                return None
+            if time.monotonic() - buffer.warmed_at >= self.ttl:
+                # Let writes this process never saw show up
+                del self._rooms[room.pk]
+                self._bytes -= buffer.size
+                self.stats["expired"] += 1
+                return None
+            self._rooms.move_to_end(room.pk)
+            return buffer
+
+    def _warm_query(self, room):
+        return (
+            Message.objects.filter(room=room).select_related("user")
+            .order_by("-timestamp", "-pk")[: self.room_size]
+        )
+
+    def _older_ids(self, room, oldest):
+        """Ids of ``room``'s messages before ``oldest`` in page order, highest first."""
+        older = Q(timestamp__lt=oldest.timestamp) | Q(timestamp=oldest.timestamp, pk__lt=oldest.pk)
+        return Message.objects.filter(older, room=room).order_by("-pk").values_list("pk", flat=True)
+
+    def _store(self, room, rows, id_floor):
+        if not self._trusted(room.pk):
+            return None
+        # Fewer rows than the buffer holds means this is the whole room
+        floor = (rows[-1].timestamp, rows[-1].pk) if len(rows) >= self.room_size else None
+        buffer = RoomHistory(floor, self.room_size, id_floor)
+        for message in reversed(rows):
+            message.room = room
+            buffer.add(HistoryEntry(message))
+        with self._lock:
+            # Keep a buffer filled by a concurrent write rather than replacing it
+            if room.pk in self._rooms:
+                buffer = self._rooms[room.pk]
+            else:
+                self._rooms[room.pk] = buffer
+                self._bytes += buffer.size
+            self._rooms.move_to_end(room.pk)
+            self.stats["warmed"] += 1
+        self._evict()
+        return buffer
+
+    def get(self, room):
+        """Return ``room``'s buffer, warming it from the database if needed (None if untrusted)."""
+        buffer = self._lookup(room)
+        if buffer is None and self._trusted(room.pk):
+            rows = list(self._warm_query(room))
+            id_floor = 0
+            if len(rows) >= self.room_size:
+                id_floor = self._older_ids(room, rows[-1]).first() or 0
+            buffer = self._store(room, rows, id_floor)
+        return buffer
+
+    async def aget(self, room):
+        buffer = self._lookup(room)
+        if buffer is None and self._trusted(room.pk):
+            rows = [message async for message in self._warm_query(room)]
+            id_floor = 0
+            if len(rows) >= self.room_size:
+                id_floor = await self._older_ids(room, rows[-1]).afirst() or 0
+            buffer = self._store(room, rows, id_floor)
+        return buffer
+
+    def _count(self, result):
+        self.stats["hits" if result is not None else "misses"] += 1
+        return result
+
+    def page(self, room, cursor=None, limit=MESSAGE_PAGE_SIZE):
+        """A page of ``room``'s history as ``page_before`` returns it, or None on a miss."""
+        buffer = self.get(room)
+        if buffer is None:
+            return self._count(None)
+        with self._lock:
+            return self._count(buffer.page(cursor, limit))
+
+    def recent(self, room, limit=MESSAGE_PAGE_SIZE):
+        """The newest ``limit`` messages of ``room``, newest first, or None on a miss."""
+        page = self.page(room, limit=limit)
+        return page[0][::-1] if page is not None else None
+
+    async def asince(self, room, message_id):
+        """Entries of ``room`` newer than ``message_id``, or None when the gap is not held."""
+        buffer = await self.aget(room)
+        if buffer is None:
+            return self._count(None)
+        with self._lock:
+            return self._count(buffer.since(message_id))
+
+    # Writes
+
+    def add(self, room_id, message, kind=None, frames=None):
+        """Append a newly stored message to its room's buffer, if the room is buffered."""
+        with self._lock:
+            buffer = self._rooms.get(room_id)
+            if buffer is not None:
+                before = buffer.size
+                buffer.add(HistoryEntry(message, kind, frames))
+                self._bytes += buffer.size - before
+        if buffer is not None:
+            self._evict()
+
+    def attach(self, room_id, message_id, kind, frames):
+        """
+        Record the frames a message was broadcast as. Returns False when the
+        room is buffered but the message is not, i.e. it was written by
+        another process and should be added with ``add``.
+        """
+        with self._lock:
+            buffer = self._rooms.get(room_id)
+            if buffer is None:
+                return True
+            entry = buffer.get(message_id)
+            if entry is None:
+                return False
+            before = buffer.size
+            buffer.attach(entry, kind, frames)
+            self._bytes += buffer.size - before
+            return True
+
+    def record(self, room_id, event):
+        """Keep a ``chat.message`` broadcast of ``room_id``, with its frames."""
+        if not self.attach(room_id, event["id"], event["kind"], event["frames"]):
+            self.add(room_id, message_from_event(room_id, event), event["kind"], event["frames"])
+
+    def _evict(self):
+        with self._lock:
+            # The most recently used room is kept even if it alone exceeds the cap
+            while self._bytes > self.max_bytes and len(self._rooms) > 1:
+                _, buffer = self._rooms.popitem(last=False)
+                self._bytes -= buffer.size
+                self.stats["evicted"] += 1
+
+
+room_history = HistoryCache()
+
+metrics.registry.register(metrics.Counter(
+    "chat_history_cache_total",
+    "Room history lookups served from memory or the database, and buffers warmed, expired or evicted.",
+    ["outcome"],
+    function=lambda: {(outcome,): count for outcome, count in room_history.stats.items()},
+))
+metrics.registry.register(metrics.Gauge(
+    "chat_history_cache_bytes", "Estimated size of the in-memory room history buffers.",
+    function=lambda: room_history.size,
+))
+metrics.registry.register(metrics.Gauge(
+    "chat_history_cache_rooms", "Rooms with an in-memory history buffer.",
+    function=lambda: len(room_history),
+))
@@ -0,0 +1,177 @@
+"""
+Channel layer that spans processes through ``chat.broker``.
+
+Each node keeps its channels and group memberships in memory, like
+``InMemoryChannelLayer``, and subscribes to a broker topic per group it
+has members in. ``group_send`` delivers to the local members directly
+and publishes the message once; the broker forwards it once per other
+node with members, and each node fans it out to its own sockets. The
+cost of a broadcast is therefore one message per node rather than per
+socket, and any node can serve any room.
+
+Specific channels (``new_channel``) carry their node's name, so ``send``
+routes them to that node. Normal channel names are delivered to every
+node that receives on them, so each should have a single receiver, such
+as a node's ``chat.cluster`` service channel.
+"""
+
+import asyncio
+import random
+import string
+import weakref
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+from .broker import pack_frame, read_frame
+from .constants import BROKER_PORT
+
+
+class BrokerChannelLayer(InMemoryChannelLayer):
+    """Configured with the broker's ``host`` and ``port`` and this node's name (``CHAT_NODE_ID`` by default)."""
+
+    def __init__(self, host="127.0.0.1", port=BROKER_PORT, node=None, **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self._node = node
+        # Topics this node needs, restored on every new broker connection
+        self._topics = set()
+        # One broker connection per event loop (tests run several loops)
+        self._connections = weakref.WeakKeyDictionary()
+
+    @property
+    def node(self):
+        if self._node is None:
+            from .sharding import process_name
+
+            # Not ``node_id``: management commands publish without being one of CHAT_NODES
+            self._node = process_name()
+        return self._node
+
+    # Broker connection
+
+    async def _connection(self):
+        """The ``(writer, reader task)`` of this loop's broker connection, opened on first use."""
+        loop = asyncio.get_running_loop()
+        connecting = self._connections.get(loop)
+        if connecting is None:
+            connecting = self._connections[loop] = loop.create_task(self._connect())
+        try:
+            return await asyncio.shield(connecting)
+        except OSError:
+            self._connections.pop(loop, None)
+            raise
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        # Messages for this node's specific channels may arrive before anything receives on them
+        self._topics.add(f"n:{self.node}")
+        for topic in self._topics:
+            writer.write(pack_frame("sub", topic))
+        await writer.drain()
+        return writer, asyncio.create_task(self._read(reader))
+
+    async def _read(self, reader):
+        try:
+            while True:
+                _, topic, payload = await read_frame(reader)
+                await self._dispatch(topic, msgpack.unpackb(payload, raw=False))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self._connections.pop(asyncio.get_running_loop(), None)
+
+    async def _dispatch(self, topic, data):
+        kind, _, name = topic.partition(":")
+        if kind == "g":
+            await self._deliver_group(name, data)
+        else:
+            channel, message = data
+            try:
+                await super().send(channel, message)
+            except ChannelFull:
+                pass
+
+    async def _command(self, *fields):
+        writer, _ = await self._connection()
+        writer.write(pack_frame(*fields))
+        await writer.drain()
+
+    async def _subscribe(self, topic):
+        if topic not in self._topics:
+            self._topics.add(topic)
+            await self._command("sub", topic)
+
+    async def _unsubscribe(self, topic):
+        if topic in self._topics:
+            self._topics.discard(topic)
+            await self._command("unsub", topic)
+
+    async def _publish(self, topic, data):
+        await self._command("pub", topic, msgpack.packb(data, use_bin_type=True))
+
+    # Channel layer API
+
+    def _channel_node(self, channel):
+        if "!" not in channel:
+            return None
+        return channel.partition("!")[2].rpartition(".")[0]
+
+    async def new_channel(self, prefix="specific."):
+        suffix = "".join(random.choice(string.ascii_letters) for _ in range(12))
+        return f"{prefix}.broker!{self.node}.{suffix}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        node = self._channel_node(channel)
+        if node == self.node:
+            await super().send(channel, message)
+        elif node is not None:
+            await self._publish(f"n:{node}", [channel, message])
+        else:
+            if f"c:{channel}" in self._topics:
+                await super().send(channel, message)
+            await self._publish(f"c:{channel}", [channel, message])
+
+    async def receive(self, channel):
+        if "!" not in channel:
+            await self._subscribe(f"c:{channel}")
+        else:
+            await self._connection()
+        return await super().receive(channel)
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        await self._subscribe(f"g:{group}")
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        if group not in self.groups:
+            await self._unsubscribe(f"g:{group}")
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        await self._deliver_group(group, message)
+        await self._publish(f"g:{group}", message)
+
+    async def _deliver_group(self, group, message):
+        for channel in list(self.groups.get(group, ())):
+            try:
+                await super().send(channel, message)
+            except ChannelFull:
+                pass
+
+    async def flush(self):
+        await super().flush()
+        self._topics.clear()
+        await self.close()
+
+    async def close(self):
+        for connecting in list(self._connections.values()):
+            if connecting.done() and not connecting.cancelled() and connecting.exception() is None:
+                writer, reader_task = connecting.result()
+                reader_task.cancel()
+                writer.close()
+        self._connections.clear()
@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from chat import archive
+from chat.constants import ARCHIVE_BATCH_SIZE
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than their room's retention period to gzipped JSONL "
+        "files in CHAT_ARCHIVE_DIR, one per room and month, deleting them from the "
+        "database in small batches. History pages keep reading them from there."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("rooms", nargs="*", metavar="slug", help="Only these rooms (default: every room).")
+        parser.add_argument("--older-than", type=int, metavar="DAYS",
+                            help="Archive messages older than this many days, whatever the rooms' retention.")
+        parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE,
+                            help="Messages archived and deleted per transaction.")
+        parser.add_argument("--pause", type=float, default=0, help="Seconds to sleep between batches.")
+        parser.add_argument("--dry-run", action="store_true", help="Only report how many messages would be archived.")
+
+    def handle(self, *args, **options):
+        if options["older_than"] is not None and options["older_than"] < 0:
+            raise CommandError("--older-than must not be negative.")
+        rooms = Room.objects.order_by("slug")
+        if options["rooms"]:
+            rooms = rooms.filter(slug__in=options["rooms"])
+        now = timezone.now()
+        total = 0
+        for room in rooms:
+            days = options["older_than"] if options["older_than"] is not None else archive.retention_days(room)
+            if days is None:
+                continue
+            cutoff = now - timedelta(days=days)
+            if options["dry_run"]:
+                count = archive.expired(room, cutoff).count()
+            else:
+                count = archive.archive_room(room, cutoff, batch_size=options["batch_size"], pause=options["pause"])
+            if count:
+                self.stdout.write(f"  {room.slug}: {count}")
+            total += count
+        if options["dry_run"]:
+            self.stdout.write(f"{total} message(s) to archive.")
+            return
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} message(s) to {archive.archive_dir()}."))
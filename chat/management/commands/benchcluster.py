@@ -0,0 +1,159 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmarks import write_results
+from chat.layers import BrokerChannelLayer
+from chat.sharding import HashRing, room_group
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure room fan-out throughput across worker processes linked by the "
+        "local broker (manage.py runbroker). Each worker holds --subscribers "
+        "channels spread over --rooms rooms and broadcasts --messages messages; "
+        "every broadcast must reach the room's members on every worker."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to run.")
+        parser.add_argument("--rooms", type=int, default=50)
+        parser.add_argument("--subscribers", type=int, default=500, help="Channels per worker.")
+        parser.add_argument("--messages", type=int, default=2000, help="Broadcasts per worker.")
+        parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for deliveries.")
+        parser.add_argument("--json", dest="json_path", help="Write results to this file.")
+        # Internal: run one worker process
+        parser.add_argument("--worker", action="store_true", help="(internal) Run as one worker.")
+        parser.add_argument("--node", help="(internal) This worker's node name.")
+        parser.add_argument("--nodes", help="(internal) Every worker's node name, comma-separated.")
+        parser.add_argument("--port", type=int, help="(internal) Broker port.")
+
+    def handle(self, *args, **options):
+        if options["worker"]:
+            result = asyncio.run(self._work(options))
+            self.stdout.write(json.dumps(result))
+            return
+
+        results = {"cpus": os.cpu_count(), "runs": []}
+        for count in [int(value) for value in options["workers"].split(",")]:
+            results["runs"].append(self._run(count, options))
+
+        base = results["runs"][0]
+        self.stdout.write(f"{os.cpu_count()} CPUs, {options['rooms']} rooms, {options['subscribers']} "
+                          f"subscribers and {options['messages']} broadcasts per worker")
+        for run in results["runs"]:
+            run["speedup"] = round(
+                run["deliveries_per_s"] / base["deliveries_per_s"] * base["workers"], 2
+            ) if base["deliveries_per_s"] else None
+            self.stdout.write(
+                f"{run['workers']:>3} workers: {run['deliveries_per_s']:>10} deliveries/s "
+                f"(x{run['speedup']} vs {base['workers']}), {run['lost']} lost, rooms owned {run['owned']}"
+            )
+        if options["json_path"]:
+            write_results(options["json_path"], results)
+
+    def _run(self, count, options):
+        port = self._free_port()
+        env = {**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "websocket_demo.settings")}
+        manage = [sys.executable, "-m", "django"]
+        broker = subprocess.Popen(manage + ["runbroker", "--port", str(port)], env=env,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        workers = []
+        try:
+            if not broker.stdout.readline():
+                raise CommandError("The broker did not start")
+            nodes = [f"worker-{i}" for i in range(count)]
+            for node in nodes:
+                workers.append(subprocess.Popen(
+                    manage + [
+                        "benchcluster", "--worker", "--node", node, "--nodes", ",".join(nodes),
+                        "--port", str(port), "--rooms", str(options["rooms"]),
+                        "--subscribers", str(options["subscribers"]), "--messages", str(options["messages"]),
+                        "--timeout", str(options["timeout"]),
+                    ],
+                    env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                ))
+            for worker in workers:
+                if worker.stdout.readline().strip() != "ready":
+                    raise CommandError("A worker failed to start")
+            # Let the broker apply every subscription before anyone publishes
+            time.sleep(0.2)
+            for worker in workers:
+                worker.stdin.write("go\n")
+                worker.stdin.flush()
+            reports = [json.loads(worker.stdout.readline()) for worker in workers]
+        finally:
+            for process in workers + [broker]:
+                process.terminate()
+                process.wait()
+
+        delivered = sum(report["delivered"] for report in reports)
+        elapsed = max(report["elapsed_s"] for report in reports)
+        return {
+            "workers": count,
+            "published": sum(report["published"] for report in reports),
+            "delivered": delivered,
+            "lost": sum(report["expected"] - report["delivered"] for report in reports),
+            "elapsed_s": round(elapsed, 3),
+            "deliveries_per_s": round(delivered / elapsed, 1) if elapsed else 0.0,
+            "owned": [report["owned"] for report in reports],
+        }
+
+    def _free_port(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    async def _work(self, options):
+        nodes = options["nodes"].split(",")
+        rooms, messages = options["rooms"], options["messages"]
+        layer = BrokerChannelLayer(port=options["port"], node=options["node"], capacity=len(nodes) * messages + 1)
+        channels = [await layer.new_channel() for _ in range(options["subscribers"])]
+        for index, channel in enumerate(channels):
+            await layer.group_add(room_group(index % rooms), channel)
+
+        # Every worker broadcasts round-robin over the rooms
+        per_room = [len(nodes) * (messages // rooms + (room < messages % rooms)) for room in range(rooms)]
+        expected = [per_room[index % rooms] for index in range(len(channels))]
+        delivered = 0
+
+        async def drain(channel, count):
+            nonlocal delivered
+            for _ in range(count):
+                await layer.receive(channel)
+                delivered += 1
+
+        loop = asyncio.get_running_loop()
+        self.stdout.write("ready")
+        self.stdout.flush()
+        await loop.run_in_executor(None, sys.stdin.readline)
+
+        start = time.perf_counter()
+        receivers = [asyncio.create_task(drain(channel, count)) for channel, count in zip(channels, expected)]
+        for sequence in range(messages):
+            await layer.group_send(room_group(sequence % rooms), {
+                "type": "chat.message",
+                "id": sequence,
+                "frames": {"json": f'{{"type":"user","message":"bench {options["node"]} {sequence}"}}'},
+            })
+        await asyncio.wait(receivers, timeout=options["timeout"])
+        elapsed = time.perf_counter() - start
+        for receiver in receivers:
+            receiver.cancel()
+        await layer.close()
+
+        ring = HashRing(nodes)
+        return {
+            "node": options["node"],
+            "published": messages,
+            "expected": sum(expected),
+            "delivered": delivered,
+            "elapsed_s": elapsed,
+            "owned": sum(ring.node_for(room) == options["node"] for room in range(rooms)),
+        }
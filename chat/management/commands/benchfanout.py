@@ -0,0 +1,82 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.benchmarks import summarize, write_results
+from chat.frames import frame_cache, message_frame, message_payload
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare per-recipient JSON encoding with encode-once fan-out for one "
+        "room with many subscribers, in memory and through an in-memory channel layer."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subscribers", type=int, default=1000)
+        parser.add_argument("--messages", type=int, default=200)
+        parser.add_argument("--json", dest="json_path", help="Write results to this file.")
+
+    def handle(self, *args, **options):
+        subscribers = options["subscribers"]
+        messages = [
+            Message(id=i, content=f"Benchmark message number {i} " * 4, timestamp=timezone.now())
+            for i in range(1, options["messages"] + 1)
+        ]
+        frame_cache.clear()
+
+        results = {
+            "subscribers": subscribers,
+            "messages": len(messages),
+            "per_recipient": self._fanout(messages, subscribers, encode_once=False),
+            "encode_once": self._fanout(messages, subscribers, encode_once=True),
+            "layer_per_recipient": asyncio.run(self._layer(messages, subscribers, encode_once=False)),
+            "layer_encode_once": asyncio.run(self._layer(messages, subscribers, encode_once=True)),
+        }
+        for name in ("per_recipient", "encode_once", "layer_per_recipient", "layer_encode_once"):
+            row = results[name]
+            self.stdout.write(f"{name:>20}: p50={row['p50_ms']}ms p95={row['p95_ms']}ms per broadcast")
+
+        if options["json_path"]:
+            write_results(options["json_path"], results)
+
+    def _fanout(self, messages, subscribers, encode_once):
+        sent = []
+        samples = []
+        for message in messages:
+            start = time.perf_counter()
+            if encode_once:
+                frame = message_frame(message, "user")
+                for _ in range(subscribers):
+                    sent.append(frame)
+            else:
+                for _ in range(subscribers):
+                    sent.append(json.dumps(message_payload(message, "user")))
+            samples.append(time.perf_counter() - start)
+            sent.clear()
+        return summarize(samples)
+
+    async def _layer(self, messages, subscribers, encode_once):
+        layer = InMemoryChannelLayer()
+        channels = [await layer.new_channel() for _ in range(subscribers)]
+        for channel in channels:
+            await layer.group_add("bench", channel)
+
+        samples = []
+        for message in messages:
+            start = time.perf_counter()
+            if encode_once:
+                await layer.group_send("bench", {"type": "chat.message", "frame": message_frame(message, "user")})
+            else:
+                await layer.group_send("bench", {"type": "chat.message", "payload": message_payload(message, "user")})
+            for channel in channels:
+                event = await layer.receive(channel)
+                if not encode_once:
+                    json.dumps(event["payload"])
+            samples.append(time.perf_counter() - start)
+        return summarize(samples)
@@ -0,0 +1,63 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from chat.benchmarks import bench_rooms, seed_messages, summarize, throwaway_data, timed, write_results
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure per-room history latency (recent/before) as the total number "
+        "of messages grows. Data is rolled back afterwards unless --keep is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="10000,100000,1000000",
+                            help="Comma-separated total message counts to measure at.")
+        parser.add_argument("--rooms", type=int, default=100)
+        parser.add_argument("--samples", type=int, default=200)
+        parser.add_argument("--limit", type=int, default=50)
+        parser.add_argument("--json", dest="json_path", help="Write results to this file.")
+        parser.add_argument("--keep", action="store_true", help="Keep the generated rows.")
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options["sizes"].split(","))
+        limit = options["limit"]
+        results = []
+
+        with throwaway_data(keep=options["keep"]):
+            rooms = bench_rooms(options["rooms"])
+            user = None
+            total = 0
+            for size in sizes:
+                user = seed_messages(rooms, size - total, user=user)
+                total = size
+
+                def recent():
+                    list(Message.objects.recent(random.choice(rooms), limit=limit))
+
+                def before():
+                    room = random.choice(rooms)
+                    page = list(Message.objects.recent(room, limit=limit))
+                    if page:
+                        list(Message.objects.before(room, page[-1], limit=limit))
+
+                row = {
+                    "messages": size,
+                    "rooms": len(rooms),
+                    "recent": summarize(timed(recent, options["samples"])),
+                    "before": summarize(timed(before, options["samples"])),
+                }
+                results.append(row)
+                self.stdout.write(
+                    f"{size:>10} messages  recent p50={row['recent']['p50_ms']}ms "
+                    f"p95={row['recent']['p95_ms']}ms  before p50={row['before']['p50_ms']}ms "
+                    f"p95={row['before']['p95_ms']}ms"
+                )
+
+            plan = Message.objects.before(rooms[0], Message.objects.recent(rooms[0])[0]).explain()
+            self.stdout.write(f"Query plan for before():\n{plan}")
+
+        if options["json_path"]:
+            write_results(options["json_path"], results)
@@ -0,0 +1,105 @@
+import json
+import time
+import zlib
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.benchmarks import write_results
+from chat.frames import TYPED_FORMATS, encode_message, frame_cache, msgpack
+from chat.models import Message
+
+DECODERS = {
+    "json": json.loads,
+    "v1": json.loads,
+    "msgpack": msgpack.unpackb if msgpack is not None else None,
+}
+
+
+class Deflater:
+    """One socket's permessage-deflate compressor, with context takeover as browsers negotiate it."""
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+            -(getattr(settings, "WEBSOCKET_DEFLATE_WINDOW_BITS", None) or zlib.MAX_WBITS),
+            getattr(settings, "WEBSOCKET_DEFLATE_MEM_LEVEL", None) or zlib.DEF_MEM_LEVEL,
+        )
+
+    def compress(self, data):
+        # RFC 7692: sync flush, then drop the trailing 0x00 0x00 0xff 0xff
+        return (self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+
+class Command(BaseCommand):
+    help = (
+        "Report bytes on the wire per chat message and encode/decode CPU for each "
+        "frame format (original JSON, typed v1 JSON, msgpack, htmx HTML), raw and "
+        "with permessage-deflate, and the outbound bytes of one broadcast to a room."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000)
+        parser.add_argument("--subscribers", type=int, default=1000,
+                            help="Room size used for the per-broadcast byte totals.")
+        parser.add_argument("--json", dest="json_path", help="Write results to this file.")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        messages = [
+            Message(id=100000 + i, user_id=1 + i % 7, content=self._content(i), timestamp=now)
+            for i in range(options["messages"])
+        ]
+        results = {"messages": len(messages), "subscribers": options["subscribers"]}
+        for frame_format in ("json", "html") + TYPED_FORMATS:
+            results[frame_format] = self._measure(messages, frame_format, options["subscribers"])
+
+        self.stdout.write(f"{'format':>8} {'bytes':>7} {'deflated':>9} {'encode_us':>10} {'decode_us':>10} "
+                          f"{'broadcast_kb':>13}")
+        for frame_format in ("json", "html") + TYPED_FORMATS:
+            row = results[frame_format]
+            self.stdout.write(
+                f"{frame_format:>8} {row['bytes']:>7} {row['deflated_bytes']:>9} {row['encode_us']:>10} "
+                f"{row['decode_us'] if row['decode_us'] is not None else '-':>10} {row['broadcast_kb']:>13}"
+            )
+        if options["json_path"]:
+            write_results(options["json_path"], results)
+
+    def _content(self, i):
+        # Chat-like lengths: mostly short lines, some longer ones
+        words = ["sure", "sounds good", "what time works for you?", "I pushed the fix to the branch",
+                 "can you take a look at the deploy logs when you get a chance"]
+        return f"{words[i % len(words)]} #{i}"
+
+    def _measure(self, messages, frame_format, subscribers):
+        frame_cache.clear()
+        start = time.perf_counter()
+        frames = [encode_message(message, "user", frame_format) for message in messages]
+        encode_s = time.perf_counter() - start
+
+        raw = [frame if isinstance(frame, bytes) else frame.encode() for frame in frames]
+        deflater = Deflater()
+        start = time.perf_counter()
+        deflated = [deflater.compress(data) for data in raw]
+        deflate_s = time.perf_counter() - start
+
+        decode = DECODERS.get(frame_format)
+        decode_us = None
+        if decode is not None:
+            start = time.perf_counter()
+            for frame in frames:
+                decode(frame)
+            decode_us = round((time.perf_counter() - start) / len(frames) * 1e6, 2)
+
+        count = len(messages)
+        deflated_bytes = sum(len(data) for data in deflated) / count
+        return {
+            "bytes": round(sum(len(data) for data in raw) / count, 1),
+            "deflated_bytes": round(deflated_bytes, 1),
+            "encode_us": round(encode_s / count * 1e6, 2),
+            "deflate_us": round(deflate_s / count * 1e6, 2),
+            "decode_us": decode_us,
+            # Each socket compresses with its own context, so deflate runs once per recipient
+            "broadcast_kb": round(deflated_bytes * subscribers / 1024, 1),
+        }
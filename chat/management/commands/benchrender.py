@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.template import engines
+from django.template.loader import get_template
+from django.utils import timezone
+
+from chat.benchmarks import summarize, write_results
+from chat.frames import frame_cache, message_fragment, message_frame, render_fragment
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the cost of delivering a message to N sockets as JSON frames, "
+        "as HTML fragments rendered per socket, and as HTML fragments rendered once."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subscribers", type=int, default=100)
+        parser.add_argument("--messages", type=int, default=200)
+        parser.add_argument("--json", dest="json_path", help="Write results to this file.")
+
+    def handle(self, *args, **options):
+        subscribers = options["subscribers"]
+        messages = [
+            Message(id=i, content=f"Benchmark message number {i}", timestamp=timezone.now())
+            for i in range(1, options["messages"] + 1)
+        ]
+        # Uncached compile of the same partial, as a loader without caching would do
+        source = get_template("chat/partials/message_oob.html").template.source
+
+        def uncompiled(message, kind):
+            return engines["django"].from_string(source).render({"message": message, "kind": kind})
+
+        strategies = {
+            "json_once": lambda message: [message_frame(message, "user")] * subscribers,
+            "html_compile_per_socket": lambda message: [uncompiled(message, "user") for _ in range(subscribers)],
+            "html_render_per_socket": lambda message: [render_fragment(message, "user") for _ in range(subscribers)],
+            "html_once": lambda message: [message_fragment(message, "user")] * subscribers,
+        }
+        results = {"subscribers": subscribers, "messages": len(messages)}
+        for name, deliver in strategies.items():
+            frame_cache.clear()
+            samples = []
+            for message in messages:
+                start = time.perf_counter()
+                deliver(message)
+                samples.append(time.perf_counter() - start)
+            results[name] = summarize(samples)
+            self.stdout.write(
+                f"{name:>24}: p50={results[name]['p50_ms']}ms p95={results[name]['p95_ms']}ms per message"
+            )
+
+        if options["json_path"]:
+            write_results(options["json_path"], results)
@@ -0,0 +1,99 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat import search
+from chat.benchmarks import bench_rooms, seed_messages, summarize, throwaway_data, timed, write_results
+from chat.models import Message
+
+VOCABULARY = 5000
+
+
+def word(rank):
+    # Distinct tokens that are never substrings of one another, so both paths find the same rows
+    return f"w{rank}x"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare message search through the full-text index with the icontains "
+        "scan it replaced, for a common and a rare word, per room and across all "
+        "rooms, as the message table grows. Data is rolled back unless --keep is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="100000,1000000",
+                            help="Comma-separated total message counts to measure at.")
+        parser.add_argument("--rooms", type=int, default=100)
+        parser.add_argument("--samples", type=int, default=20)
+        parser.add_argument("--json", dest="json_path", help="Write results to this file.")
+        parser.add_argument("--keep", action="store_true", help="Keep the generated rows.")
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options["sizes"].split(","))
+        ranks = range(1, VOCABULARY + 1)
+        # Zipf-distributed words, like natural text
+        weights = [1 / rank for rank in ranks]
+        rng = random.Random(0)
+
+        def content(i):
+            return " ".join(word(rank) for rank in rng.choices(ranks, weights, k=8))
+
+        self.stdout.write(f"Search backend: {search.backend() or 'unindexed'} ({connection.vendor})")
+        results = []
+        with throwaway_data(keep=options["keep"]):
+            rooms = bench_rooms(options["rooms"])
+            user = None
+            total = 0
+            for size in sizes:
+                user = seed_messages(rooms, size - total, user=user, content=content)
+                total = size
+                row = {"messages": size, "rooms": len(rooms)}
+                for label, term in (("common", word(1)), ("rare", word(VOCABULARY // 2))):
+                    row[label] = self._measure(term, rooms, options["samples"])
+                results.append(row)
+                for label in ("common", "rare"):
+                    for scope in ("room", "admin"):
+                        timings = row[label][scope]
+                        self.stdout.write(
+                            f"{size:>10} messages  {label:<6} {scope:<5}  "
+                            f"icontains p50={timings['icontains']['p50_ms']}ms  "
+                            f"index p50={timings['index']['p50_ms']}ms  (x{timings['speedup']})"
+                        )
+
+        if options["json_path"]:
+            write_results(options["json_path"], {"backend": search.backend(), "vendor": connection.vendor,
+                                                 "runs": results})
+
+    def _measure(self, term, rooms, samples):
+        base = Message.objects.select_related("user", "room")
+
+        def room_icontains():
+            list(base.filter(room=random.choice(rooms), content__icontains=term).order_by("-pk")[:20])
+
+        def room_index():
+            search.search(term, room=random.choice(rooms))
+
+        # The admin changelist counts the matches and fetches the first page, newest first
+        def admin_icontains():
+            matches = base.filter(content__icontains=term)
+            matches.count()
+            list(matches.order_by("-timestamp")[:50])
+
+        def admin_index():
+            matches = search.matching(base, term)
+            matches.count()
+            list(matches.order_by("-pk")[:50])
+
+        measured = {}
+        for scope, scan, indexed in (("room", room_icontains, room_index), ("admin", admin_icontains, admin_index)):
+            scan_timings = summarize(timed(scan, samples))
+            index_timings = summarize(timed(indexed, samples))
+            measured[scope] = {
+                "icontains": scan_timings,
+                "index": index_timings,
+                "speedup": round(scan_timings["p50_ms"] / index_timings["p50_ms"], 1)
+                if index_timings["p50_ms"] else None,
+            }
+        return measured
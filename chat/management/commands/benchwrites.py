@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections, connection
+
+from chat.benchmarks import summarize, write_results
+from chat.models import Message, Room
+from chat.persistence import write_buffer
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure message write throughput from many concurrent consumers under "
+        "the configured database profile (see DATABASE_URL), through the "
+        "write-behind buffer and with one connection per writer thread."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--consumers", type=int, default=50)
+        parser.add_argument("--messages", type=int, default=20, help="Messages per consumer.")
+        parser.add_argument("--mode", choices=["buffered", "direct", "both"], default="both",
+                            help="buffered: the consumers' write-behind path; direct: one INSERT per "
+                                 "message from a thread pool, so writers contend for the database.")
+        parser.add_argument("--json", dest="json_path", help="Write results to this file.")
+        parser.add_argument("--keep", action="store_true", help="Keep the messages written by the run.")
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(username="bench_user")
+        room, _ = Room.objects.get_or_create(name="bench-writes")
+        # Writer threads commit on their own connections, so the rows are
+        # deleted afterwards rather than rolled back
+        high_water = Message.objects.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+        results = {"profile": self._profile()}
+        modes = ["buffered", "direct"] if options["mode"] == "both" else [options["mode"]]
+        try:
+            for mode in modes:
+                results[mode] = async_to_sync(self._drive)(mode, room, user, options)
+        finally:
+            if not options["keep"]:
+                Message.objects.filter(room=room, pk__gt=high_water).delete()
+
+        profile = results["profile"]
+        self.stdout.write(
+            f"{profile['vendor']} (conn_max_age={profile['conn_max_age']}, pool={profile['pool']}"
+            + (f", journal_mode={profile['journal_mode']}, synchronous={profile['synchronous']}"
+               if profile["vendor"] == "sqlite" else "") + ")"
+        )
+        for mode in modes:
+            row = results[mode]
+            self.stdout.write(
+                f"{mode:>9}: {row['messages_per_s']} msg/s, p50={row['latency']['p50_ms']}ms "
+                f"p99={row['latency']['p99_ms']}ms, {row['errors']} errors"
+            )
+        if options["json_path"]:
+            write_results(options["json_path"], results)
+
+    def _profile(self):
+        settings_dict = connection.settings_dict
+        profile = {
+            "vendor": connection.vendor,
+            "conn_max_age": settings_dict.get("CONN_MAX_AGE"),
+            "pool": bool(settings_dict.get("OPTIONS", {}).get("pool")),
+        }
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                profile["journal_mode"] = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+                profile["synchronous"] = cursor.execute("PRAGMA synchronous").fetchone()[0]
+        return profile
+
+    async def _drive(self, mode, room, user, options):
+        latencies = []
+        errors = 0
+
+        if mode == "buffered":
+            async def write(text):
+                await write_buffer.save(Message(room=room, user=user, content=text))
+        else:
+            insert = sync_to_async(self._insert, thread_sensitive=False)
+
+            async def write(text):
+                await insert(room, user, text)
+
+        async def consumer(index):
+            nonlocal errors
+            for sequence in range(options["messages"]):
+                start = time.perf_counter()
+                try:
+                    await write(f"bench {mode} {index}-{sequence}")
+                except DatabaseError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(consumer(i) for i in range(options["consumers"])))
+        if mode == "buffered":
+            await write_buffer.drain()
+        elapsed = time.perf_counter() - start
+
+        return {
+            "consumers": options["consumers"],
+            "messages": len(latencies),
+            "errors": errors,
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(len(latencies) / elapsed, 1),
+            "latency": summarize(latencies),
+        }
+
+    def _insert(self, room, user, text):
+        Message.objects.create(room=room, user=user, content=text)
+        # What the end of a request does: keep or close the connection per CONN_MAX_AGE
+        close_old_connections()
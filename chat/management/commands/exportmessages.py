@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import transfer
+from chat.constants import TRANSFER_CHUNK_SIZE
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream rooms and their messages to a JSON Lines file (gzipped if it ends in .gz) "
+        "that importmessages reads back, without loading them into memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("rooms", nargs="*", metavar="slug", help="Only these rooms (default: every room).")
+        parser.add_argument("-o", "--output", default="-", help="File to write (default: standard output).")
+        parser.add_argument("--chunk-size", type=int, default=TRANSFER_CHUNK_SIZE,
+                            help="Messages fetched per query.")
+
+    def handle(self, *args, **options):
+        rooms = None
+        if options["rooms"]:
+            rooms = Room.objects.filter(slug__in=options["rooms"])
+            unknown = set(options["rooms"]) - set(rooms.values_list("slug", flat=True))
+            if unknown:
+                raise CommandError(f"No such room(s): {', '.join(sorted(unknown))}")
+        with transfer.open_dump(options["output"], "w") as fh:
+            room_count, message_count = transfer.export_messages(fh, rooms, options["chunk_size"])
+        if options["output"] != "-":
+            self.stdout.write(self.style.SUCCESS(
+                f"Exported {room_count} room(s) and {message_count} message(s) to {options['output']}."
+            ))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import transfer
+from chat.constants import IMPORT_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "Load a JSON Lines file written by exportmessages (gzipped if it ends in .gz) in "
+        "batches. Rooms are matched by slug or name and users by username; missing ones "
+        "are created. Messages get new ids unless --keep-ids is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", nargs="?", default="-", help="File to read (default: standard input).")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE,
+                            help="Messages inserted per bulk_create.")
+        parser.add_argument("--keep-ids", action="store_true",
+                            help="Keep the exported message ids, skipping messages whose id already exists, "
+                                 "e.g. to restore a backup or resume an interrupted import.")
+
+    def handle(self, *args, **options):
+        importer = transfer.Importer(batch_size=options["batch_size"], keep_ids=options["keep_ids"])
+        try:
+            with transfer.open_dump(options["input"], "r") as fh:
+                counts = importer.run(fh)
+        except transfer.TransferError as exc:
+            raise CommandError(f"{exc} ({importer.counts['messages']} message(s) imported before it)")
+        except OSError as exc:
+            # A missing file, or one that is not gzipped despite its name
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['messages']} message(s), created {counts['rooms']} room(s) "
+            f"and {counts['users']} user(s)."
+        ))
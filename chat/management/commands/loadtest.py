@@ -0,0 +1,258 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from chat.benchmarks import summarize, throwaway_data, write_results
+from chat.persistence import write_buffer
+
+try:
+    import websockets
+except ImportError:  # pragma: no cover - only needed for --daphne
+    websockets = None
+
+
+class InProcessClient:
+    """A socket driven straight through the ASGI application."""
+
+    def __init__(self, application, path):
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=10)
+        if not connected:
+            raise CommandError("The consumer rejected the connection.")
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self, timeout):
+        return await self.communicator.receive_from(timeout=timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class NetworkClient:
+    """A real WebSocket connection to a running server."""
+
+    def __init__(self, url):
+        self.url = url
+
+    async def connect(self):
+        self.socket = await websockets.connect(self.url)
+
+    async def send(self, text):
+        await self.socket.send(text)
+
+    async def receive(self, timeout):
+        return await asyncio.wait_for(self.socket.recv(), timeout)
+
+    async def close(self):
+        await self.socket.close()
+
+
+class Traffic:
+    """The messages of one run in flight between its writers and readers, and the echo latencies measured."""
+
+    def __init__(self, options, count):
+        self.options = options
+        self.count = count
+        self.interval = 1 / options["rate"]
+        self.pending = {}
+        self.latencies = []
+        self.received = 0
+        self.sent = 0
+        self.sending = True
+
+    async def run(self, clients):
+        """Send from every client for the configured duration, then drain; returns the elapsed seconds."""
+        start = time.perf_counter()
+        readers = [asyncio.ensure_future(self.read(client)) for client in clients]
+        await asyncio.gather(*(self.write(index, client) for index, client in enumerate(clients)))
+        self.sending = False
+        await asyncio.gather(*readers, return_exceptions=True)
+        return time.perf_counter() - start
+
+    async def read(self, client):
+        while self.sending or self.pending:
+            try:
+                frame = json.loads(await client.receive(timeout=self.options["drain_timeout"]))
+            except asyncio.TimeoutError:
+                if not self.sending:
+                    return
+                continue
+            self.received += 1
+            started = self.pending.pop(frame.get("message"), None)
+            if started is not None:
+                self.latencies.append(time.perf_counter() - started)
+
+    async def write(self, index, client):
+        deadline = time.perf_counter() + self.options["duration"]
+        # Spread the first sends so connections do not fire in lockstep
+        await asyncio.sleep(self.interval * index / self.count)
+        sequence = 0
+        while time.perf_counter() < deadline:
+            text = f"load {index}-{sequence}"
+            self.pending[text] = time.perf_counter()
+            await client.send(json.dumps({"message": text}))
+            self.sent += 1
+            sequence += 1
+            await asyncio.sleep(self.interval)
+
+
+class Command(BaseCommand):
+    help = (
+        "Open many chat sockets, send messages at a fixed rate and report echo "
+        "latency percentiles, throughput, DB queries and memory per connection."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=50)
+        parser.add_argument("--rate", type=float, default=1.0, help="Messages per second per connection.")
+        parser.add_argument("--duration", type=float, default=10.0, help="Seconds to send for.")
+        parser.add_argument("--room", default="", help="Room slug; the default room when empty.")
+        parser.add_argument("--bot-delay", type=float, default=0.0, help="CHAT_BOT_REPLY_DELAY for in-process runs.")
+        parser.add_argument("--respect-limits", action="store_true",
+                            help="Keep the configured rate limits instead of lifting them.")
+        parser.add_argument("--daphne", action="store_true",
+                            help="Start a daphne server (with permessage-deflate) on localhost "
+                                 "and connect over the network.")
+        parser.add_argument("--port", type=int, default=0, help="Port for --daphne (a free one by default).")
+        parser.add_argument("--drain-timeout", type=float, default=2.0,
+                            help="Seconds to keep reading after the last send.")
+        parser.add_argument("--json", dest="json_path", help="Write results to this file.")
+        parser.add_argument("--keep", action="store_true",
+                            help="Keep the messages written by an in-process run "
+                                 "(a --daphne server always keeps its own).")
+
+    def handle(self, *args, **options):
+        if options["connections"] < 1:
+            raise CommandError("--connections must be at least 1.")
+        if options["rate"] <= 0:
+            raise CommandError("--rate must be greater than 0.")
+        path = f"/ws/chat/{options['room']}/" if options["room"] else "/ws/chat/"
+        if options["daphne"]:
+            results = self._run_daphne(path, options)
+        else:
+            results = self._run_in_process(path, options)
+
+        self.stdout.write(
+            f"{results['connections']} connections, {results['sent']} sent, "
+            f"{results['received']} frames received in {results['elapsed_s']}s\n"
+            f"throughput: {results['messages_per_s']} msg/s sent, {results['frames_per_s']} frames/s delivered\n"
+            f"echo latency: p50={results['latency']['p50_ms']}ms p95={results['latency']['p95_ms']}ms "
+            f"p99={results['latency']['p99_ms']}ms\n"
+            f"db queries: {results['db_queries']}  memory/connection: {results['memory_per_connection_kb']} KiB"
+        )
+        if options["json_path"]:
+            write_results(options["json_path"], results)
+
+    def _run_in_process(self, path, options):
+        from websocket_demo.asgi import application
+
+        overrides = {"CHAT_BOT_REPLY_DELAY": options["bot_delay"]}
+        if not options["respect_limits"]:
+            overrides.update(CHAT_CONNECTION_RATE_LIMIT=(1e9, 1e9), CHAT_USER_RATE_LIMIT=(1e9, 1e9))
+
+        with override_settings(**overrides), throwaway_data(keep=options["keep"]):
+            with CaptureQueriesContext(connection) as queries:
+                results = async_to_sync(self._drive)(
+                    lambda: InProcessClient(application, path), options, self._traced_memory
+                )
+            results["db_queries"] = len(queries.captured_queries)
+        return results
+
+    def _traced_memory(self, phase):
+        # Tracing slows everything down, so it only covers opening the sockets
+        if phase == "before":
+            tracemalloc.start()
+            return 0
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return current
+
+    def _run_daphne(self, path, options):
+        if websockets is None:
+            raise CommandError("--daphne needs the 'websockets' package: pip install websockets")
+        port = options["port"] or self._free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "websocket_demo.server", "-p", str(port), "websocket_demo.asgi:application"],
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "websocket_demo.settings")},
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            self._wait_for_port(port)
+            results = asyncio.run(self._drive(
+                lambda: NetworkClient(f"ws://127.0.0.1:{port}{path}"), options, lambda phase: self._rss(server.pid)
+            ))
+        finally:
+            server.terminate()
+            server.wait()
+        results["db_queries"] = None
+        return results
+
+    def _free_port(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            return sock.getsockname()[1]
+
+    def _wait_for_port(self, port, timeout=15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise CommandError(f"daphne did not start listening on port {port}")
+
+    def _rss(self, pid):
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    async def _drive(self, make_client, options, memory):
+        clients, memory_per_connection = await self._connect(make_client, options["connections"], memory)
+        traffic = Traffic(options, len(clients))
+        elapsed = await traffic.run(clients)
+        for client in clients:
+            await client.close()
+        await write_buffer.drain()
+        return self._results(options, traffic, elapsed, memory_per_connection)
+
+    async def _connect(self, make_client, count, memory):
+        """Open ``count`` clients; returns them and the memory each one took."""
+        memory_before = memory("before")
+        clients = [make_client() for _ in range(count)]
+        for client in clients:
+            await client.connect()
+        return clients, (memory("after") - memory_before) / count
+
+    def _results(self, options, traffic, elapsed, memory_per_connection):
+        return {
+            "connections": options["connections"],
+            "rate_per_connection": options["rate"],
+            "duration_s": options["duration"],
+            "elapsed_s": round(elapsed, 3),
+            "sent": traffic.sent,
+            "received": traffic.received,
+            "lost": len(traffic.pending),
+            "messages_per_s": round(traffic.sent / elapsed, 1),
+            "frames_per_s": round(traffic.received / elapsed, 1),
+            "latency": summarize(traffic.latencies),
+            "memory_per_connection_kb": round(memory_per_connection / 1024, 1),
+        }
@@ -0,0 +1,40 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+
+from chat.cluster import cluster
+from chat.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute each room's message count and last message from its messages, "
+        "e.g. after raw SQL writes or a restore. Only rooms that disagree are updated "
+        "unless --all is given. The running servers drop their in-memory history of "
+        "the repaired rooms."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("rooms", nargs="*", metavar="slug", help="Only these rooms (default: every room).")
+        parser.add_argument("--all", action="store_true", help="Rewrite every selected room, stale or not.")
+        parser.add_argument("--dry-run", action="store_true", help="Only report the stale rooms.")
+
+    def handle(self, *args, **options):
+        rooms = Room.objects.all()
+        if options["rooms"]:
+            rooms = rooms.filter(slug__in=options["rooms"])
+        if options["all"] and not options["dry_run"]:
+            ids = list(rooms.values_list("pk", flat=True))
+            repaired = rooms.rebuild_activity()
+        else:
+            stale = rooms if options["all"] else rooms.stale_activity()
+            rows = list(stale.order_by("slug").values_list("pk", "slug"))
+            for _, slug in rows:
+                self.stdout.write(f"  {slug}")
+            if options["dry_run"]:
+                self.stdout.write(f"{len(rows)} room(s) to repair.")
+                return
+            ids = [pk for pk, _ in rows]
+            repaired = Room.objects.filter(pk__in=ids).rebuild_activity()
+        # Whatever made the rooms stale may have changed messages the servers hold in memory
+        async_to_sync(cluster.discard_history)(ids)
+        self.stdout.write(self.style.SUCCESS(f"Repaired {repaired} room(s)."))
@@ -0,0 +1,30 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from chat.broker import Broker
+from chat.constants import BROKER_PORT
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the pub/sub broker that links chat worker processes started with "
+        "CHANNEL_LAYER_URL=broker://<host>:<port>, as a local stand-in for Redis."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=BROKER_PORT)
+
+    def handle(self, *args, **options):
+        try:
+            asyncio.run(self._serve(options["host"], options["port"]))
+        except KeyboardInterrupt:
+            pass
+
+    async def _serve(self, host, port):
+        server = await Broker().serve(host, port)
+        self.stdout.write(f"Broker listening on {host}:{server.sockets[0].getsockname()[1]}")
+        self.stdout.flush()
+        async with server:
+            await server.serve_forever()
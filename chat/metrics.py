@@ -0,0 +1,206 @@
+"""
+Minimal Prometheus-style metrics for the chat consumers.
+
+Metrics live in a process-wide registry and are rendered in the Prometheus
+text exposition format by ``chat.views.metrics``. When
+``CHAT_METRICS_ENABLED`` is off, ``instrument`` returns the wrapped
+function untouched, so disabled metrics cost nothing on the hot path.
+The endpoint only answers staff users, ``CHAT_METRICS_TOKEN`` bearers
+and ``CHAT_METRICS_ALLOWED_IPS``.
+"""
+
+import hmac
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from django.conf import settings
+
+from .constants import METRICS_MAX_SERIES, METRICS_LATENCY_BUCKETS
+
+OVERFLOW_LABEL = "other"
+
+
+def enabled():
+    return getattr(settings, "CHAT_METRICS_ENABLED", True)
+
+
+def may_scrape(request):
+    """Whether ``request`` may read the registry: a staff user, the bearer token or an allowed address."""
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    token = getattr(settings, "CHAT_METRICS_TOKEN", None)
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    if token and scheme.lower() == "bearer" and hmac.compare_digest(credentials.encode(), token.encode()):
+        return True
+    return request.META.get("REMOTE_ADDR") in getattr(settings, "CHAT_METRICS_ALLOWED_IPS", ())
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """
+    Base class for labelled metrics. Once a metric holds ``max_series``
+    label combinations, new combinations are folded into a single series
+    whose labels are all ``"other"``, which bounds per-room cardinality.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), max_series=None, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series or METRICS_MAX_SERIES
+        # Optional callable read at scrape time, returning a value or a
+        # mapping of label value tuples to values
+        self.function = function
+        self._series = {}
+
+    def _key(self, labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        if key not in self._series and len(self._series) >= self.max_series:
+            key = (OVERFLOW_LABEL,) * len(self.labelnames)
+        return key
+
+    def samples(self):
+        """Yield ``(suffix, label values, extra labels, value)`` tuples."""
+        series = self._series
+        if self.function is not None:
+            value = self.function()
+            series = value if isinstance(value, dict) else {(): value}
+        for key, value in series.items():
+            yield "", key, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+    def clear(self):
+        self._series.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._series[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets=METRICS_LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", key, (("le", _format_value(bound)),), cumulative
+            yield "_sum", key, (), total
+            yield "_count", key, (), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+    def clear(self):
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+registry = Registry()
+
+connections = registry.register(
+    Counter("chat_connections_total", "WebSocket connections accepted.", ["room"])
+)
+disconnections = registry.register(
+    Counter("chat_disconnections_total", "WebSocket connections closed.", ["room"])
+)
+active_sockets = registry.register(
+    Gauge("chat_active_sockets", "Currently open WebSocket connections.", ["room"])
+)
+messages_received = registry.register(
+    Counter("chat_messages_received_total", "Chat messages received from clients.", ["room"])
+)
+consumer_seconds = registry.register(
+    Histogram("chat_consumer_seconds", "Time spent in ChatConsumer methods.", ["method"])
+)
+db_seconds = registry.register(
+    Histogram("chat_db_seconds", "Time spent in database calls made for the consumers.", ["operation"])
+)
+db_batch_size = registry.register(
+    Histogram("chat_db_batch_size", "Rows written per write-behind flush.", buckets=(1, 5, 10, 25, 50, 100, 250, 500))
+)
+
+
+def instrument(histogram, **labels):
+    """Time an async callable into ``histogram``; a no-op when metrics are disabled."""
+
+    def decorator(func):
+        if not enabled():
+            return func
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.3 on 2026-10-18 07:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_add_read_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_id', models.BigIntegerField(default=0, help_text='ID of the newest message the user has read in the room.', verbose_name='Last Read Message')),
+                ('updated_at', models.DateTimeField(auto_now=True, help_text='The time this cursor last moved.', verbose_name='Last Updated')),
+                ('room', models.ForeignKey(help_text='The room this cursor tracks.', on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat.room', verbose_name='Room')),
+                ('user', models.ForeignKey(help_text='The user this cursor belongs to.', on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'verbose_name': 'Read Cursor',
+                'verbose_name_plural': 'Read Cursors',
+                'constraints': [models.UniqueConstraint(fields=('user', 'room'), name='unique_read_cursor')],
+            },
+        ),
+    ]
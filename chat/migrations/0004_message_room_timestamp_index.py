@@ -0,0 +1,17 @@
+# Generated by Django 5.1.3 on 2026-10-18 07:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_read_cursor'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', '-timestamp', '-id'], name='room_timestamp_id_idx'),
+        ),
+    ]
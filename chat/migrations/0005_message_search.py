@@ -0,0 +1,81 @@
+from django.db import migrations
+
+# Kept in step with chat_message by triggers; see chat.search
+SQLITE_FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE chat_message_fts USING fts5(
+        content, room_id, content='chat_message', content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts (rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts (chat_message_fts, rowid, content, room_id)
+        VALUES ('delete', old.id, old.content, old.room_id);
+    END
+    """,
+    """
+    CREATE TRIGGER chat_message_fts_update AFTER UPDATE OF content, room_id ON chat_message BEGIN
+        INSERT INTO chat_message_fts (chat_message_fts, rowid, content, room_id)
+        VALUES ('delete', old.id, old.content, old.room_id);
+        INSERT INTO chat_message_fts (rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END
+    """,
+    "INSERT INTO chat_message_fts (chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_fts_update",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+# The configuration must match chat.constants.SEARCH_CONFIG
+POSTGRES_FORWARDS = [
+    "CREATE INDEX chat_message_search_idx ON chat_message USING GIN (to_tsvector('english', content))",
+]
+
+POSTGRES_BACKWARDS = [
+    "DROP INDEX IF EXISTS chat_message_search_idx",
+]
+
+
+def _statements(schema_editor, forwards):
+    connection = schema_editor.connection
+    if connection.vendor == "postgresql":
+        return POSTGRES_FORWARDS if forwards else POSTGRES_BACKWARDS
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                # chat.search falls back to unindexed matching
+                return []
+        return SQLITE_FORWARDS if forwards else SQLITE_BACKWARDS
+    return []
+
+
+def create_search_index(apps, schema_editor):
+    for statement in _statements(schema_editor, True):
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    for statement in _statements(schema_editor, False):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_room_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.1.3 on 2026-10-18 08:28
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_messages(apps, schema_editor):
+    Message = apps.get_model("chat", "Message")
+    Room = apps.get_model("chat", "Room")
+    messages = Message.objects.filter(room=OuterRef("pk")).order_by()
+    latest = messages.order_by("-timestamp", "-pk")
+    Room.objects.update(
+        message_count=Coalesce(Subquery(messages.values("room").annotate(count=Count("pk")).values("count")), 0),
+        last_message_at=Subquery(latest.values("timestamp")[:1]),
+        last_message_id=Subquery(latest.values("pk")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, help_text='The time of the newest message in the room.', null=True, verbose_name='Last Message'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, editable=False, help_text='ID of the newest message in the room.', null=True, verbose_name='Last Message ID'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of messages in the room.', verbose_name='Messages'),
+        ),
+        migrations.AddIndex(
+            model_name='room',
+            index=models.Index(fields=['-last_message_at', '-id'], name='room_activity_idx'),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_room_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Archive messages older than this many days (leave empty for the site default).', null=True, verbose_name='Retention (days)'),
+        ),
+    ]
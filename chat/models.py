@@ -1,4 +1,9 @@
-from django.db import models
+from collections import Counter
+
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
 from django.utils.text import slugify, Truncator
 from django.contrib.auth.models import User
 from django.core.validators import MinLengthValidator, MaxLengthValidator
@@ -13,30 +18,127 @@ from .constants import (
     MESSAGE_VERBOSE_NAME,
     MESSAGE_VERBOSE_NAME_PLURAL,
     ROOM_DESCRIPTION_PREVIEW_LENGTH,
+    ROOM_SLUG_FALLBACK,
+    ROOM_SLUG_SAVE_ATTEMPTS,
+    READ_CURSOR_VERBOSE_NAME,
+    READ_CURSOR_VERBOSE_NAME_PLURAL,
+    MESSAGE_PAGE_SIZE,
 )
+from .pagination import newer_than, older_than
 
 
 def generate_unique_slug(instance):
     """
     Generates a unique slug for the given model instance based on its name.
     In case a slug already exists, appends a counter to the slug.
+    The slugs that could collide are fetched in a single query.
     """
     max_len = instance._meta.get_field("slug").max_length
     base = slugify(instance.name.strip().replace("–", "-").replace("—", "-")).lower()[
         :max_len
-    ]
-    slug = base
-    counter = 1
-    qs = instance.__class__.objects.filter(slug__startswith=base)
+    ] or ROOM_SLUG_FALLBACK
+    # Long bases are truncated to make room for the suffix, so match on a
+    # prefix short enough to cover suffixes of up to nine digits
+    prefix = base[: max(1, max_len - 10)]
+    qs = instance.__class__.objects.filter(slug__startswith=prefix)
     if instance.pk:
         qs = qs.exclude(pk=instance.pk)
-    while qs.filter(slug=slug).exists():
+    taken = set(qs.values_list("slug", flat=True))
+    slug = base
+    counter = 1
+    while slug in taken:
         suffix = f"-{counter}"
         slug = f"{base[: max_len - len(suffix)]}{suffix}"
         counter += 1
     return slug
 
 
+# Maintained with F() expressions by ``RoomQuerySet``, never saved from an instance
+ROOM_ACTIVITY_FIELDS = ("message_count", "last_message_at", "last_message_id")
+
+
+def _activity_expressions():
+    """Subqueries computing a room's activity fields from its messages."""
+    messages = Message.objects.filter(room=OuterRef("pk")).order_by()
+    latest = messages.order_by("-timestamp", "-pk")
+    return {
+        "message_count": Coalesce(Subquery(messages.values("room").annotate(count=Count("pk")).values("count")), 0),
+        "last_message_at": Subquery(latest.values("timestamp")[:1]),
+        "last_message_id": Subquery(latest.values("pk")[:1]),
+    }
+
+
+class RoomQuerySet(models.QuerySet):
+    def by_activity(self):
+        """Rooms with messages, most recently active first (served from ``room_activity_idx``)."""
+        return self.filter(last_message_at__isnull=False).order_by("-last_message_at", "-pk")
+
+    def record_messages(self, messages):
+        """
+        Count newly inserted ``messages`` in their rooms' activity fields
+        with one UPDATE per room. The increments are F() expressions, so
+        concurrent writers never lose each other's counts, and the last
+        message only moves forward in ``(timestamp, id)`` order.
+        """
+        by_room = {}
+        for message in messages:
+            count, last = by_room.get(message.room_id, (0, None))
+            if last is None or (message.timestamp, message.pk) > (last.timestamp, last.pk):
+                last = message
+            by_room[message.room_id] = (count + 1, last)
+        for room_id, (count, last) in by_room.items():
+            newer = (
+                Q(last_message_at__isnull=True)
+                | Q(last_message_at__lt=last.timestamp)
+                | Q(last_message_at=last.timestamp, last_message_id__lt=last.pk)
+            )
+            self.filter(pk=room_id).update(
+                message_count=F("message_count") + count,
+                last_message_at=Case(
+                    When(newer, then=Value(last.timestamp)), default=F("last_message_at"),
+                    output_field=models.DateTimeField(),
+                ),
+                last_message_id=Case(
+                    When(newer, then=Value(last.pk)), default=F("last_message_id"),
+                    output_field=models.BigIntegerField(),
+                ),
+            )
+
+    def forget_messages(self, messages):
+        """Take deleted ``messages`` out of their rooms' activity fields; call it after the delete."""
+        self.forget_counts(Counter(message.room_id for message in messages))
+
+    def forget_counts(self, counts):
+        """
+        Take ``counts[room id]`` deleted messages out of each room's activity
+        fields with one UPDATE per room, after the delete. The last message
+        is only looked up again when it no longer exists.
+        """
+        expected = _activity_expressions()
+        was_last = ~Exists(Message.objects.filter(pk=OuterRef("last_message_id")))
+        for room_id, count in counts.items():
+            self.filter(pk=room_id).update(
+                message_count=Greatest(
+                    F("message_count") - count, Value(0), output_field=models.PositiveIntegerField()
+                ),
+                last_message_at=Case(When(was_last, then=expected["last_message_at"]), default=F("last_message_at")),
+                last_message_id=Case(When(was_last, then=expected["last_message_id"]), default=F("last_message_id")),
+            )
+
+    def stale_activity(self):
+        """Rooms whose message count or last message disagree with their messages."""
+        expected = _activity_expressions()
+        return self.alias(
+            expected_count=expected["message_count"],
+            expected_last=Coalesce(expected["last_message_id"], 0),
+            recorded_last=Coalesce("last_message_id", 0),
+        ).exclude(message_count=F("expected_count"), recorded_last=F("expected_last"))
+
+    def rebuild_activity(self):
+        """Recompute the activity fields of every room in the queryset; returns the number of rooms."""
+        return self.update(**_activity_expressions())
+
+
 class Room(models.Model):
     """A chat room where users can send messages."""
 
@@ -64,16 +166,73 @@ class Room(models.Model):
         verbose_name="Last Updated",
         help_text="The time this room was last updated.",
     )
+    message_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name="Messages",
+        help_text="Number of messages in the room.",
+    )
+    last_message_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Last Message",
+        help_text="The time of the newest message in the room.",
+    )
+    last_message_id = models.BigIntegerField(
+        null=True,
+        blank=True,
+        editable=False,
+        verbose_name="Last Message ID",
+        help_text="ID of the newest message in the room.",
+    )
+    retention_days = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name="Retention (days)",
+        help_text="Archive messages older than this many days (leave empty for the site default).",
+    )
+
+    objects = RoomQuerySet.as_manager()
 
     class Meta:
         verbose_name = ROOM_VERBOSE_NAME
         verbose_name_plural = ROOM_VERBOSE_NAME_PLURAL
         ordering = ROOM_ORDERING
+        indexes = [
+            # Activity-ordered room lists
+            models.Index(fields=["-last_message_at", "-id"], name="room_activity_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "name" in field_names:
+            # Loaded rooms keep their slug until they are renamed
+            instance._original_name = instance.name
+        return instance
 
     def save(self, *args, **kwargs):
-        if not self.slug or getattr(self, "_original_name", None) != self.name:
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            # Never overwrite the activity fields with what may be a stale copy
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ROOM_ACTIVITY_FIELDS
+            ]
+        if self.slug and getattr(self, "_original_name", None) == self.name:
+            super().save(*args, **kwargs)
+            return
+        for attempt in range(ROOM_SLUG_SAVE_ATTEMPTS):
             self.slug = generate_unique_slug(self)
-        super().save(*args, **kwargs)
+            try:
+                with transaction.atomic():
+                    super().save(*args, **kwargs)
+                break
+            except IntegrityError:
+                # Retry only if a concurrent save took the slug in the meantime
+                taken = Room.objects.filter(slug=self.slug).exclude(pk=self.pk).exists()
+                if not taken or attempt == ROOM_SLUG_SAVE_ATTEMPTS - 1:
+                    raise
         self._original_name = self.name
 
     def __str__(self):
@@ -89,8 +248,76 @@ class Room(models.Model):
         )
 
     def get_recent_messages(self, limit=10):
-        """Get the most recent messages in this room."""
-        return self.messages.order_by('-timestamp')[:limit]
+        """The most recent messages in this room as a list, newest first."""
+        from .history import room_history
+
+        recent = room_history.recent(self, limit=limit)
+        return recent if recent is not None else list(Message.objects.recent(self, limit=limit))
+
+
+class MessageQuerySet(models.QuerySet):
+    """Query helpers for messages, including read receipts."""
+
+    def unread(self):
+        """Messages without a read receipt (served from ``read_at_idx``)."""
+        return self.filter(read_at__isnull=True)
+
+    def unread_count(self, room=None):
+        qs = self.unread()
+        if room is not None:
+            qs = qs.filter(room=room)
+        return qs.count()
+
+    async def aunread_count(self, room=None):
+        qs = self.unread()
+        if room is not None:
+            qs = qs.filter(room=room)
+        return await qs.acount()
+
+    def delete(self):
+        """
+        Delete the messages, then take them out of their rooms with one
+        UPDATE per room. Without per-row signals Django deletes them in
+        one statement instead of loading each row first. Messages removed
+        by a cascade from their user are left to ``repairroomactivity``;
+        those of a deleted room go with it.
+        """
+        from .history import room_history
+
+        with transaction.atomic(using=self.db):
+            counts = dict(self.order_by().values_list("room").annotate(count=Count("pk")))
+            deleted = super().delete()
+            Room.objects.using(self.db).forget_counts(counts)
+        for room_id in counts:
+            room_history.discard(room_id)
+        return deleted
+
+    def mark_read(self, read_at=None):
+        """Set ``read_at`` on every unread message in the queryset with a single UPDATE."""
+        return self.unread().update(read_at=read_at or timezone.now())
+
+    async def amark_read(self, read_at=None):
+        return await self.unread().aupdate(read_at=read_at or timezone.now())
+
+    def up_to(self, room, message_id):
+        """Messages in ``room`` up to and including ``message_id``."""
+        return self.filter(room=room, pk__lte=message_id)
+
+    # Room-scoped history. These filter on the room and order by
+    # (timestamp, id), so they are served by ``room_timestamp_id_idx``
+    # regardless of how many messages other rooms hold.
+
+    def recent(self, room, limit=MESSAGE_PAGE_SIZE):
+        """The newest ``limit`` messages in ``room``, newest first."""
+        return self.filter(room=room).order_by("-timestamp", "-pk")[:limit]
+
+    def before(self, room, cursor, limit=MESSAGE_PAGE_SIZE):
+        """Up to ``limit`` messages in ``room`` older than ``cursor``, newest first."""
+        return self.filter(older_than(cursor), room=room).order_by("-timestamp", "-pk")[:limit]
+
+    def after(self, room, cursor, limit=MESSAGE_PAGE_SIZE):
+        """Up to ``limit`` messages in ``room`` newer than ``cursor``, oldest first."""
+        return self.filter(newer_than(cursor), room=room).order_by("timestamp", "pk")[:limit]
 
 
 class Message(models.Model):
@@ -138,8 +365,12 @@ class Message(models.Model):
         indexes = [
             models.Index(fields=["-timestamp"], name="timestamp_desc_idx"),
             models.Index(fields=["read_at"], name="read_at_idx"),
+            # Per-room history in (timestamp, id) keyset order
+            models.Index(fields=["room", "-timestamp", "-id"], name="room_timestamp_id_idx"),
         ]
 
+    objects = MessageQuerySet.as_manager()
+
     def __str__(self):
         return f"Message by {self.user.username} in {self.room.name} at {self.timestamp}: {self._get_content_preview()}"
 
@@ -154,3 +385,90 @@ class Message(models.Model):
         return Truncator(self.content).chars(
             MESSAGE_CONTENT_PREVIEW_LENGTH, truncate="..."
         )
+
+    def delete(self, using=None, keep_parents=False):
+        """Delete through ``MessageQuerySet.delete``, which takes the message out of its room."""
+        using = using or router.db_for_write(Message, instance=self)
+        deleted = Message.objects.using(using).filter(pk=self.pk).delete()
+        self.pk = None
+        return deleted
+
+    def mark_as_read(self, read_at=None):
+        """Record a read receipt without rewriting the other columns."""
+        self.read_at = read_at or timezone.now()
+        Message.objects.filter(pk=self.pk).update(read_at=self.read_at)
+
+    async def amark_as_read(self, read_at=None):
+        self.read_at = read_at or timezone.now()
+        await Message.objects.filter(pk=self.pk).aupdate(read_at=self.read_at)
+
+
+class ReadCursorQuerySet(models.QuerySet):
+    def advance(self, user, room, message_id):
+        """
+        Move the user's cursor in ``room`` forward to ``message_id``.
+        Cursors never move backwards, so late or duplicate receipts are no-ops.
+        """
+        updated = self.filter(user=user, room=room, last_read_id__lt=message_id).update(
+            last_read_id=message_id, updated_at=timezone.now()
+        )
+        if not updated:
+            self.get_or_create(user=user, room=room, defaults={"last_read_id": message_id})
+
+    async def aadvance(self, user, room, message_id):
+        updated = await self.filter(user=user, room=room, last_read_id__lt=message_id).aupdate(
+            last_read_id=message_id, updated_at=timezone.now()
+        )
+        if not updated:
+            await self.aget_or_create(user=user, room=room, defaults={"last_read_id": message_id})
+
+    def unread_count(self, user, room):
+        """Messages in ``room`` after the user's cursor, counted from the room's rows only."""
+        cursor, message_count = Room.objects.filter(pk=room.pk).values_list(
+            Subquery(self.filter(user=user, room=OuterRef("pk")).values("last_read_id")[:1]), "message_count"
+        ).get()
+        if not cursor:
+            # Nothing read yet: the whole room is unread
+            return message_count
+        return Message.objects.filter(room=room, pk__gt=cursor).count()
+
+
+class ReadCursor(models.Model):
+    """The last message a user has read in a room."""
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="read_cursors",
+        verbose_name="User",
+        help_text="The user this cursor belongs to.",
+    )
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.CASCADE,
+        related_name="read_cursors",
+        verbose_name="Room",
+        help_text="The room this cursor tracks.",
+    )
+    last_read_id = models.BigIntegerField(
+        default=0,
+        verbose_name="Last Read Message",
+        help_text="ID of the newest message the user has read in the room.",
+    )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name="Last Updated",
+        help_text="The time this cursor last moved.",
+    )
+
+    objects = ReadCursorQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = READ_CURSOR_VERBOSE_NAME
+        verbose_name_plural = READ_CURSOR_VERBOSE_NAME_PLURAL
+        constraints = [
+            models.UniqueConstraint(fields=["user", "room"], name="unique_read_cursor"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} read {self.room.name} up to {self.last_read_id}"
@@ -0,0 +1,69 @@
+"""Keyset (cursor) pagination over messages ordered by ``(timestamp, id)``."""
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_cursor(message):
+    """Return an opaque cursor pointing at ``message``."""
+    micros = (message.timestamp - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{message.pk}"
+
+
+def decode_cursor(cursor):
+    """Return the ``(timestamp, id)`` pair encoded in ``cursor``; raises ValueError if malformed."""
+    micros, _, pk = cursor.partition("-")
+    try:
+        timestamp = EPOCH + timedelta(microseconds=int(micros))
+    except OverflowError:
+        # Digits beyond the range of a datetime
+        raise ValueError(f"Cursor out of range: {cursor!r}")
+    return timestamp, decode_id(pk)
+
+
+def decode_id(value):
+    """Return the message id in ``value``; raises ValueError unless it fits a BIGINT column."""
+    pk = int(value)
+    if not 0 <= pk < 2 ** 63:
+        raise ValueError(f"Message id out of range: {value!r}")
+    return pk
+
+
+def _key(cursor):
+    """Normalise a cursor string, Message or ``(timestamp, id)`` pair to a pair."""
+    if isinstance(cursor, str):
+        return decode_cursor(cursor)
+    if hasattr(cursor, "timestamp"):
+        return cursor.timestamp, cursor.pk
+    return cursor
+
+
+def older_than(cursor):
+    """Filter for messages strictly before ``cursor`` in ``(timestamp, id)`` order."""
+    timestamp, pk = _key(cursor)
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk)
+
+
+def newer_than(cursor):
+    """Filter for messages strictly after ``cursor`` in ``(timestamp, id)`` order."""
+    timestamp, pk = _key(cursor)
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk)
+
+
+def page_before(queryset, cursor=None, limit=50):
+    """
+    Return up to ``limit`` messages older than ``cursor`` (the newest ones
+    when no cursor is given) in chronological order, along with the cursor
+    for the next older page or None when there is nothing left.
+    """
+    if cursor:
+        queryset = queryset.filter(older_than(cursor))
+    window = list(queryset.order_by("-timestamp", "-pk")[: limit + 1])
+    has_older = len(window) > limit
+    window = window[:limit]
+    window.reverse()
+    next_cursor = encode_cursor(window[0]) if has_older else None
+    return window, next_cursor
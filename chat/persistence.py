@@ -0,0 +1,191 @@
+"""Write-behind persistence for chat messages and read receipts."""
+
+import asyncio
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .constants import (
+    WRITE_BEHIND_BATCH_SIZE,
+    WRITE_BEHIND_FLUSH_INTERVAL,
+    WRITE_BEHIND_MAX_PENDING,
+)
+from . import metrics
+from .history import room_history
+from .models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Collects Message inserts and read receipts from every consumer in the
+    process and writes them in batches: one ``bulk_create`` for the inserts
+    and one ``UPDATE ... WHERE id IN (...)`` for the receipts. A batch is
+    flushed when it reaches ``batch_size`` or after ``flush_interval``
+    seconds, whichever comes first. Callers block once ``max_pending``
+    writes, inserts or receipts, are queued or being written, so a slow
+    database pushes back on the consumers instead of piling up batches
+    without bound.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, max_pending=None):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._inserts = []
+        self._reads = set()
+        self._in_flight = set()
+        self._writing = 0
+        self._space_waiters = []
+        self._timer = None
+
+    def _setting(self, value, name, default):
+        if value is not None:
+            return value
+        return getattr(settings, name, default)
+
+    @property
+    def batch_size(self):
+        return self._setting(self._batch_size, "CHAT_WRITE_BEHIND_BATCH_SIZE", WRITE_BEHIND_BATCH_SIZE)
+
+    @property
+    def flush_interval(self):
+        return self._setting(
+            self._flush_interval, "CHAT_WRITE_BEHIND_FLUSH_INTERVAL", WRITE_BEHIND_FLUSH_INTERVAL
+        )
+
+    @property
+    def max_pending(self):
+        return self._setting(self._max_pending, "CHAT_WRITE_BEHIND_MAX_PENDING", WRITE_BEHIND_MAX_PENDING)
+
+    @property
+    def queued(self):
+        """Number of writes waiting for the next batch."""
+        return len(self._inserts) + len(self._reads)
+
+    @property
+    def pending(self):
+        """Number of writes queued or in a batch that is being written."""
+        return self.queued + self._writing
+
+    async def _wait_for_space(self):
+        while self.pending >= self.max_pending:
+            waiter = asyncio.get_running_loop().create_future()
+            self._space_waiters.append(waiter)
+            if self.queued:
+                self._start_flush()
+            # Otherwise the batches being written wake us when they finish
+            await waiter
+
+    async def save(self, message):
+        """Queue ``message`` for insertion and return it once it has a primary key."""
+        await self._wait_for_space()
+        future = asyncio.get_running_loop().create_future()
+        self._inserts.append((message, future))
+        self._schedule()
+        return await future
+
+    async def mark_read(self, message, read_at=None):
+        """Queue a read receipt for ``message``, waiting like ``save`` when the buffer is full."""
+        if message.pk is None:
+            # Not inserted yet, the receipt rides along with the insert
+            message.read_at = read_at or timezone.now()
+            return
+        if message.pk in self._reads:
+            return
+        await self._wait_for_space()
+        self._reads.add(message.pk)
+        self._schedule()
+
+    def _schedule(self):
+        if self.queued >= self.batch_size:
+            self._start_flush()
+            return
+        loop = asyncio.get_running_loop()
+        if self._timer is None or self._timer.done() or self._timer.get_loop() is not loop:
+            self._timer = self._track(loop.create_task(self._flush_later()))
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None
+        await self.flush()
+
+    def _start_flush(self):
+        self._track(asyncio.get_running_loop().create_task(self.flush()))
+
+    def _track(self, task):
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+        return task
+
+    async def flush(self):
+        """Write everything queued so far."""
+        inserts, self._inserts = self._inserts, []
+        reads, self._reads = self._reads, set()
+        # Skip messages whose sender gave up waiting (e.g. a cancelled bot reply)
+        inserts = [(message, future) for message, future in inserts if not future.cancelled()]
+        if not inserts and not reads:
+            self._wake_waiters()
+            return
+
+        start = time.perf_counter()
+        size = len(inserts) + len(reads)
+        self._writing += size
+        try:
+            await sync_to_async(self._write)([message for message, _ in inserts], reads)
+            if metrics.enabled():
+                metrics.db_seconds.observe(time.perf_counter() - start, operation="flush")
+                metrics.db_batch_size.observe(size)
+        except Exception as exc:
+            for _, future in inserts:
+                if not future.done():
+                    future.set_exception(exc)
+            if reads:
+                # Nobody awaits a receipt; retrying could fail forever, so drop them loudly
+                logger.exception("Dropped %d read receipts after a failed write", len(reads))
+        else:
+            for message, future in inserts:
+                room_history.add(message.room_id, message)
+                if not future.done():
+                    future.set_result(message)
+        finally:
+            self._writing -= size
+            self._wake_waiters()
+
+    def _write(self, messages, read_ids):
+        with transaction.atomic():
+            if messages:
+                Message.objects.bulk_create(messages)
+                # bulk_create sends no post_save, so the batch counts itself
+                Room.objects.record_messages(messages)
+            if read_ids:
+                Message.objects.filter(pk__in=read_ids).mark_read()
+
+    def _wake_waiters(self):
+        waiters, self._space_waiters = self._space_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def drain(self):
+        """Flush every queued write and wait for in-flight batches, inserts before receipts."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.flush()
+            in_flight = [task for task in self._in_flight if task.get_loop() is loop]
+            if not in_flight:
+                break
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+write_buffer = WriteBehindBuffer()
+
+metrics.registry.register(metrics.Gauge(
+    "chat_write_buffer_pending", "Writes queued or being written by the write-behind buffer.",
+    function=lambda: write_buffer.pending,
+))
@@ -0,0 +1,193 @@
+"""
+Who is online in each room, and the heartbeat that keeps the answer true.
+
+Every socket this process serves is registered with ``presence`` while it
+is open, and its room membership is recorded on the room's owner (see
+``chat.cluster``). Rooms map to their online users and users to their
+sockets, so ``presence.online(room_id)`` costs the size of that room,
+not a scan of every connection. Each inbound frame marks its socket as
+seen. A socket
+that has been silent for ``CHAT_HEARTBEAT_INTERVAL`` seconds is sent a
+``ping``, and one silent for ``CHAT_IDLE_TIMEOUT`` seconds is closed, so
+clients that vanish without closing do not keep their consumer, queues
+and room membership alive. Only sockets whose client answers pings are
+reaped; others still get the WebSocket-level pings of the server (daphne
+closes connections that miss them). The deadlines live on one
+``TimerWheel`` read lazily: seeing a socket only stores a timestamp.
+"""
+
+import asyncio
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from .constants import HEARTBEAT_INTERVAL, IDLE_TIMEOUT, PRESENCE_TICK
+from .timers import TimerWheel
+from . import metrics
+
+
+class SocketState:
+    __slots__ = ("consumer", "last_seen", "pinged")
+
+    def __init__(self, consumer, now):
+        self.consumer = consumer
+        self.last_seen = now
+        self.pinged = False
+
+
+class Presence:
+    """
+    Sockets of this process by channel name, and the online users of the
+    rooms this node owns. Consumers provide ``channel_name``, ``room``,
+    ``user``, ``heartbeat`` (whether the client answers pings), ``ping()``
+    and ``async reap()``.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._sockets = {}
+        # room id -> {user id: (username, set of channel names)}
+        self._rooms = {}
+        self._wheel = None
+        self._reaper = None
+        self.stats = Counter()
+
+    @property
+    def heartbeat_interval(self):
+        return getattr(settings, "CHAT_HEARTBEAT_INTERVAL", HEARTBEAT_INTERVAL)
+
+    @property
+    def idle_timeout(self):
+        return getattr(settings, "CHAT_IDLE_TIMEOUT", IDLE_TIMEOUT)
+
+    @property
+    def wheel(self):
+        if self._wheel is None:
+            self._wheel = TimerWheel(getattr(settings, "CHAT_PRESENCE_TICK", PRESENCE_TICK), self._clock())
+        return self._wheel
+
+    def __len__(self):
+        return len(self._sockets)
+
+    # Sockets of this process
+
+    def register(self, consumer):
+        """Start watching an accepted socket for silence."""
+        now = self._clock()
+        self._sockets[consumer.channel_name] = SocketState(consumer, now)
+        if consumer.heartbeat:
+            self._schedule(consumer.channel_name, now)
+            self._start_reaper()
+
+    def unregister(self, consumer):
+        """Forget a socket; returns False if it was not registered."""
+        if self._sockets.pop(consumer.channel_name, None) is None:
+            return False
+        self.wheel.cancel(consumer.channel_name)
+        return True
+
+    def local_online(self, room_id):
+        """Users of this process's own sockets in ``room_id``; scans every local socket."""
+        return {
+            state.consumer.user.pk: state.consumer.user.username
+            for state in self._sockets.values() if state.consumer.room.pk == room_id
+        }
+
+    # Room membership, kept by the room's owner
+
+    def add_member(self, room_id, user_id, username, channel_name):
+        """Record a socket in a room; returns True when its user just came online there."""
+        users = self._rooms.setdefault(room_id, {})
+        first = user_id not in users
+        if first:
+            users[user_id] = (username, set())
+        users[user_id][1].add(channel_name)
+        return first
+
+    def remove_member(self, room_id, user_id, channel_name):
+        """Remove a socket from a room; returns True when it was its user's last one there."""
+        users = self._rooms.get(room_id, {})
+        channels = users.get(user_id, (None, set()))[1]
+        if channel_name not in channels:
+            return False
+        channels.discard(channel_name)
+        if channels:
+            return False
+        del users[user_id]
+        if not users:
+            del self._rooms[room_id]
+        return True
+
+    def seen(self, channel_name):
+        """Note a frame from the socket; its deadlines are pushed back when they come round."""
+        state = self._sockets.get(channel_name)
+        if state is not None:
+            state.last_seen = self._clock()
+            state.pinged = False
+
+    def online(self, room_id):
+        """The users with a socket in ``room_id``, as ``{user id: username}`` (on the room's owner)."""
+        return {user_id: username for user_id, (username, _) in self._rooms.get(room_id, {}).items()}
+
+    @property
+    def users(self):
+        return sum(len(users) for users in self._rooms.values())
+
+    def _schedule(self, channel_name, now):
+        state = self._sockets[channel_name]
+        # A pinged socket has until the idle timeout to answer
+        wait = self.idle_timeout if state.pinged else self.heartbeat_interval
+        self.wheel.schedule(channel_name, max(state.last_seen + wait, now))
+
+    async def check(self, channel_name):
+        """Ping or close a socket whose deadline came round, or push the deadline back."""
+        state = self._sockets.get(channel_name)
+        if state is None:
+            return
+        now = self._clock()
+        idle = now - state.last_seen
+        if idle >= self.idle_timeout:
+            self.stats["reaped"] += 1
+            await state.consumer.reap()
+            # The consumer normally unregisters as it closes; make sure the socket is gone either way
+            self.unregister(state.consumer)
+            return
+        if not state.pinged and idle >= self.heartbeat_interval:
+            state.pinged = True
+            self.stats["pings"] += 1
+            state.consumer.ping()
+        self._schedule(channel_name, now)
+
+    async def tick(self):
+        for channel_name in self.wheel.advance(self._clock()):
+            await self.check(channel_name)
+
+    def _start_reaper(self):
+        loop = asyncio.get_running_loop()
+        if self._reaper is None or self._reaper.done() or self._reaper.get_loop() is not loop:
+            self._reaper = loop.create_task(self._reap())
+
+    async def _reap(self):
+        # Runs while any socket has a deadline
+        while len(self.wheel):
+            await asyncio.sleep(self.wheel.resolution)
+            await self.tick()
+
+    def clear(self):
+        self._sockets.clear()
+        self._rooms.clear()
+        self._wheel = None
+        self.stats.clear()
+
+
+presence = Presence()
+
+metrics.registry.register(metrics.Counter(
+    "chat_heartbeat_total", "Pings sent to silent sockets and idle sockets closed.", ["outcome"],
+    function=lambda: {(outcome,): count for outcome, count in presence.stats.items()},
+))
+metrics.registry.register(metrics.Gauge(
+    "chat_online_users", "Users with an open socket, counted once per room.",
+    function=lambda: presence.users,
+))
@@ -0,0 +1,87 @@
+"""
+Versioned frame protocol spoken over chat sockets.
+
+Version 1 frames are objects carrying ``"v": 1`` and a ``type``:
+
+=========  ================  ==============================================
+type       direction         fields
+=========  ================  ==============================================
+chat       client -> server  ``message``, optional ``ref`` echoed in the ack
+chat       server -> client  ``id``, ``kind``, ``user``, ``message``, ``ts``
+typing     both              ``active`` (and ``user`` from the server)
+read       both              ``last_id`` (and ``user`` from the server)
+ack        server -> client  ``ref``, ``id``: a chat frame has been stored
+resume     client -> server  ``last_id``
+resumed    server -> client  see ``ChatConsumer.resume``
+presence   server -> client  ``user``, ``online``: a user's first socket
+                             joined the room or their last one left
+ping       both              answered with ``pong``; the server pings
+                             sockets that stay silent (see chat.presence)
+pong       both              no fields
+error      server -> client  ``code`` and optional details
+=========  ================  ==============================================
+
+Frames are JSON text, or msgpack sent as binary frames when the client
+negotiates the ``msgpack`` format. Clients choose a format with the
+``chat.v1.json`` or ``chat.v1.msgpack`` WebSocket subprotocol, or with
+``?format=``. Clients that negotiate nothing keep the original unversioned
+frames: ``{"message": ...}`` in, ``{"type": "user", ...}`` out.
+"""
+
+import json
+from urllib.parse import parse_qs
+
+from .frames import PROTOCOL_VERSION, TYPED_FORMATS, dumps, encode, msgpack
+
+SUBPROTOCOLS = {"chat.v1.json": "v1", "chat.v1.msgpack": "msgpack"}
+FORMATS = ("json", "html") + TYPED_FORMATS
+CLIENT_TYPES = ("chat", "typing", "read", "resume", "ping", "pong")
+
+
+class ProtocolError(ValueError):
+    """A client frame that cannot be handled; ``code`` goes into the error frame."""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+def negotiate(scope, default):
+    """Return the ``(frame format, accepted subprotocol)`` for a connecting socket."""
+    for subprotocol in scope.get("subprotocols", ()):
+        frame_format = SUBPROTOCOLS.get(subprotocol)
+        if frame_format in FORMATS:
+            return frame_format, subprotocol
+    query = parse_qs(scope.get("query_string", b"").decode())
+    frame_format = query.get("format", [default])[0]
+    return (frame_format if frame_format in FORMATS else default), None
+
+
+def decode(text_data=None, bytes_data=None):
+    """Parse a client frame into a dict with a known ``type``; raises ProtocolError."""
+    try:
+        if bytes_data is not None:
+            if msgpack is None:
+                raise ProtocolError("bad_frame")
+            data = msgpack.unpackb(bytes_data)
+        else:
+            data = json.loads(text_data)
+    except (ValueError, TypeError):
+        raise ProtocolError("bad_frame")
+    if not isinstance(data, dict):
+        raise ProtocolError("bad_frame")
+    if data.get("v", PROTOCOL_VERSION) != PROTOCOL_VERSION:
+        raise ProtocolError("unsupported_version")
+    # Unversioned clients send {"message": ...}, optionally with "type": "user"
+    if data.get("type") in (None, "user"):
+        data["type"] = "chat"
+    if data["type"] not in CLIENT_TYPES:
+        raise ProtocolError("unknown_type")
+    return data
+
+
+def control_frame(payload, frame_format):
+    """Encode a server frame other than a chat message (ack, resumed, ping, pong, error)."""
+    if frame_format in TYPED_FORMATS:
+        return encode(payload, frame_format)
+    return dumps(payload)
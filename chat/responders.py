@@ -0,0 +1,40 @@
+"""Pluggable bot backends used by the chat consumer."""
+
+import asyncio
+import random
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .constants import BOT_RESPONDER, BOT_RESPONSE, BOT_REPLY_DELAY
+
+
+class BaseResponder:
+    """
+    Interface for bot backends.
+    ``respond`` runs in a background task on the event loop, so
+    implementations must await any I/O rather than block on it.
+    """
+
+    async def respond(self, message):
+        """Return the reply text for the given user ``Message``."""
+        raise NotImplementedError("Subclasses must implement respond().")
+
+
+class RandomResponder(BaseResponder):
+    """Picks a canned reply after a short simulated typing delay."""
+
+    def __init__(self, responses=None, delay=None):
+        self.responses = responses or BOT_RESPONSE
+        if delay is None:
+            delay = getattr(settings, "CHAT_BOT_REPLY_DELAY", BOT_REPLY_DELAY)
+        self.delay = delay
+
+    async def respond(self, message):
+        await asyncio.sleep(self.delay)
+        return random.choice(self.responses)
+
+
+def get_responder():
+    """Instantiate the responder configured by ``CHAT_BOT_RESPONDER``."""
+    return import_string(getattr(settings, "CHAT_BOT_RESPONDER", BOT_RESPONDER))()
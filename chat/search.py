@@ -0,0 +1,104 @@
+"""
+Full-text search over message content.
+
+On SQLite, matches come from ``chat_message_fts``, an FTS5 index over
+``chat_message(content, room_id)`` that triggers keep in step with every
+insert, update and delete (migration 0005). On PostgreSQL they come from
+a GIN index on ``to_tsvector(SEARCH_CONFIG, content)``, which the
+database maintains itself. Other databases, and SQLite builds without
+FTS5, fall back to a case-insensitive scan.
+
+A query is split into words and every word must match, stemmed alike on
+both databases (Porter stemming, the english configuration). Results
+are newest first and paged by message id.
+"""
+
+import re
+
+from django.db import connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+from .constants import SEARCH_CONFIG, SEARCH_MAX_TERMS, SEARCH_PAGE_SIZE
+from .models import Message
+
+WORD = re.compile(r"\w+")
+
+_backends = {}
+
+
+def terms(query):
+    """The words of ``query`` that a message must all contain."""
+    return WORD.findall(query.lower())[:SEARCH_MAX_TERMS]
+
+
+def backend(using="default"):
+    """``"fts5"``, ``"postgres"`` or None (no index) for the database ``using``."""
+    if using not in _backends:
+        connection = connections[using]
+        kind = None
+        if connection.vendor == "postgresql":
+            kind = "postgres"
+        elif connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                if "chat_message_fts" in connection.introspection.table_names(cursor):
+                    kind = "fts5"
+        _backends[using] = kind
+    return _backends[using]
+
+
+def _match_expression(words, room_id=None):
+    # Quoted words are plain phrases, so user input cannot form FTS5 syntax
+    match = "content : (%s)" % " ".join(f'"{word}"' for word in words)
+    if room_id is not None:
+        match = f'room_id : "{room_id}" AND {match}'
+    return match
+
+
+def matching(queryset, query, room=None, before=None, limit=None):
+    """
+    Filter a queryset of messages to those containing every word of
+    ``query``, optionally only in ``room`` and with ids below ``before``.
+    ``limit`` lets the index stop after that many matches, newest first;
+    order the queryset by ``-pk`` to page through them.
+    """
+    words = terms(query)
+    if not words:
+        return queryset.none()
+    if room is not None:
+        queryset = queryset.filter(room=room)
+    if before is not None:
+        queryset = queryset.filter(pk__lt=before)
+
+    kind = backend(queryset.db)
+    if kind == "fts5":
+        # The room id is indexed too, so a room's matches come straight from the index
+        sql = "SELECT rowid FROM chat_message_fts WHERE chat_message_fts MATCH %s"
+        params = [_match_expression(words, room.pk if room is not None else None)]
+        if before is not None:
+            sql += " AND rowid < %s"
+            params.append(before)
+        if limit is not None:
+            sql += " ORDER BY rowid DESC LIMIT %s"
+            params.append(limit)
+        return queryset.filter(pk__in=RawSQL(sql, params))
+    if kind == "postgres":
+        # Must match the indexed expression exactly for the GIN index to be used
+        sql = (f"to_tsvector('{SEARCH_CONFIG}', \"chat_message\".\"content\") "
+               f"@@ plainto_tsquery('{SEARCH_CONFIG}', %s)")
+        return queryset.filter(RawSQL(sql, [" ".join(words)], output_field=BooleanField()))
+    for word in words:
+        queryset = queryset.filter(content__icontains=word)
+    return queryset
+
+
+def search(query, room=None, before=None, limit=SEARCH_PAGE_SIZE):
+    """
+    Up to ``limit`` messages matching ``query``, newest first, and the
+    ``before`` cursor of the next page, or None when there is nothing left.
+    """
+    messages = matching(Message.objects.select_related("user", "room"), query, room=room, before=before,
+                        limit=limit + 1)
+    window = list(messages.order_by("-pk")[: limit + 1])
+    next_cursor = window[limit - 1].pk if len(window) > limit else None
+    return window[:limit], next_cursor
@@ -0,0 +1,97 @@
+"""
+Room ownership across the nodes of a deployment.
+
+Any node accepts sockets for any room and the channel layer carries each
+room's broadcasts to every node with a member, so no load balancer
+stickiness is needed. State that must be kept in one place per room, the
+history ring buffer and the room's presence set, lives on the room's
+owner, picked by consistent hashing of the room id over ``CHAT_NODES``.
+Adding or removing a node only moves the rooms on the ring segments it
+takes or gives up. With the default single node every room is local.
+"""
+
+import bisect
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .constants import SHARD_REPLICAS
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring with ``replicas`` virtual points per node."""
+
+    def __init__(self, nodes, replicas=SHARD_REPLICAS):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node.")
+        self.nodes = tuple(nodes)
+        points = sorted((_hash(f"{node}#{replica}"), node) for node in self.nodes for replica in range(replicas))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+def process_name():
+    """``CHAT_NODE_ID``, or a name derived from the host and pid."""
+    return getattr(settings, "CHAT_NODE_ID", None) or f"{os.uname().nodename}-{os.getpid()}"
+
+
+def node_id():
+    """This process's node name, which must be one of ``CHAT_NODES`` when that is set."""
+    node = process_name()
+    members = getattr(settings, "CHAT_NODES", None)
+    if members and node not in members:
+        # Otherwise this node would own no room, and the rooms it should own no node at all
+        raise ImproperlyConfigured(
+            f"CHAT_NODE_ID must be one of CHAT_NODES ({', '.join(members)}), not {node!r}."
+        )
+    return node
+
+
+def nodes():
+    return tuple(getattr(settings, "CHAT_NODES", None) or (node_id(),))
+
+
+_rings = {}
+
+
+def ring():
+    members = nodes()
+    if members not in _rings:
+        _rings.clear()
+        _rings[members] = HashRing(members)
+    return _rings[members]
+
+
+def owner(room_id):
+    """The node that holds ``room_id``'s history buffer and presence set."""
+    return ring().node_for(room_id)
+
+
+def is_owner(room_id):
+    return local_layer() or owner(room_id) == node_id()
+
+
+def node_channel(node):
+    """The channel a node's ``chat.cluster`` service listens on."""
+    return f"chat.node.{node}"
+
+
+def room_group(room_id):
+    """The channel layer group of a room's sockets."""
+    return f"chat.room.{room_id}"
+
+
+def local_layer():
+    """Whether the channel layer only spans this process, making it the one and only node."""
+    backend = settings.CHANNEL_LAYERS.get("default", {}).get("BACKEND", "")
+    return backend.endswith("InMemoryChannelLayer")
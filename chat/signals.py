@@ -0,0 +1,42 @@
+"""Signal handlers for the chat application."""
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import room_cache
+from .history import room_history
+from .models import Message, Room
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def invalidate_room_cache(sender, instance, **kwargs):
+    """Keep the consumers' room cache consistent with the database."""
+    room_cache.invalidate(instance)
+
+
+@receiver(post_delete, sender=Room)
+def discard_room_history(sender, instance, **kwargs):
+    room_history.discard(instance.pk)
+
+
+@receiver(post_save, sender=Message)
+def update_room_history(sender, instance, created=False, **kwargs):
+    """
+    Keep buffered room history consistent with messages saved one at a time
+    (e.g. from the admin). Batched writes of the consumers go through
+    ``chat.persistence``, which updates the buffers itself. Deletes are
+    handled by ``MessageQuerySet.delete``, with no per-row signal that
+    would keep Django from deleting in one statement.
+    """
+    if created:
+        room_history.add(instance.room_id, instance)
+    else:
+        room_history.discard(instance.room_id)
+
+
+@receiver(post_save, sender=Message)
+def count_message(sender, instance, created, **kwargs):
+    """Keep the room's activity fields up to date; ``chat.persistence`` does this for its batches."""
+    if created:
+        Room.objects.record_messages([instance])
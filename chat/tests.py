@@ -1,11 +1,46 @@
-from django.test import TestCase, Client
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.test import TestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.urls import reverse
 from django.contrib.auth.models import User
 from django.utils import timezone
-from .models import Room, Message
+from asgiref.sync import async_to_sync, sync_to_async
+from . import archive, consumers, metrics, search, transfer
+from .cache import RoomCache, room_cache
+from .cluster import cluster
+from .constants import MESSAGE_PAGE_SIZE, ROOM_NAME_MAX_LENGTH
+from . import frames
+from .frames import FrameCache, frame_cache, message_fragment, message_frame
+from .history import HistoryCache, HistoryEntry, RoomHistory, room_history
+from .models import Room, Message, ReadCursor, generate_unique_slug
+from .pagination import encode_cursor, page_before
+from .persistence import WriteBehindBuffer
+from .broker import Broker
+from .layers import BrokerChannelLayer
+from .presence import Presence, presence
+from .responders import BaseResponder
+from . import sharding
+from .sharding import HashRing
+from .throttle import OutboundQueue, TokenBucket, counters, user_buckets
+from .timers import TimerWheel
+from .typing_status import TypingTracker, typing_tracker
 from channels.testing import WebsocketCommunicator
 from websocket_demo.asgi import application
 import asyncio
+from datetime import timedelta
+import gzip
+import io
+import json
+import tempfile
+import time
+from unittest import mock, skipUnless
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
 
 
 class RoomModelTest(TestCase):
@@ -24,6 +59,42 @@ class RoomModelTest(TestCase):
         )
 
 
+class RoomSlugTest(TestCase):
+    def setUp(self):
+        Room.objects.bulk_create(
+            [Room(name="Busy", slug="busy")] + [Room(name=f"Busy {i}", slug=f"busy-{i}") for i in range(1, 6)]
+        )
+
+    def test_collisions_are_resolved_with_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(generate_unique_slug(Room(name="busy!")), "busy-6")
+
+    def test_long_names_are_truncated_before_the_suffix(self):
+        name = "x" * (ROOM_NAME_MAX_LENGTH - 1)
+        first = Room.objects.create(name=name + "a")
+        second = Room.objects.create(name=name + "A")
+        self.assertEqual(first.slug, name + "a")
+        self.assertEqual(second.slug, name[:-1] + "-1")
+
+    def test_names_without_slug_characters_fall_back_to_room(self):
+        self.assertEqual(Room.objects.create(name="聊天").slug, "room")
+        self.assertEqual(Room.objects.create(name="!!!").slug, "room-1")
+
+    def test_loaded_rooms_keep_their_slug(self):
+        room = Room.objects.get(slug="busy-3")
+        room.description = "Updated"
+        with self.assertNumQueries(1):
+            room.save()
+        self.assertEqual(Room.objects.get(pk=room.pk).slug, "busy-3")
+
+    def test_concurrently_taken_slug_is_retried(self):
+        # Another process took the first pick between generating and inserting
+        with mock.patch("chat.models.generate_unique_slug", side_effect=["busy-1", "busy-6"]) as generate:
+            room = Room.objects.create(name="busy!")
+        self.assertEqual(room.slug, "busy-6")
+        self.assertEqual(generate.call_count, 2)
+
+
 class MessageModelTest(TestCase):
     def setUp(self):
         self.room = Room.objects.create(name="Test Room")
@@ -77,18 +148,63 @@ class MessageModelTest(TestCase):
 
 class IndexViewTest(TestCase):
     def setUp(self):
+        room_history.clear()
         self.client = Client()
         self.room = Room.objects.create(name="Test Room")
-        Message.objects.create(room=self.room, content="Hello, world!")
+        self.user = User.objects.create_user(username="testuser")
+        Message.objects.create(room=self.room, user=self.user, content="Hello, world!")
 
     def test_index_view(self):
         response = self.client.get(reverse("index"))
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "Hello, world!")
 
+    def _create_messages(self, count):
+        Message.objects.bulk_create(
+            Message(room=self.room, user=self.user, content=f"Message {i}") for i in range(count)
+        )
+
+    def test_index_renders_latest_window_without_n_plus_one(self):
+        self._create_messages(MESSAGE_PAGE_SIZE + 10)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("index"))
+        self.assertLessEqual(len(ctx.captured_queries), 2)
+        self.assertEqual(len(response.context["messages"]), MESSAGE_PAGE_SIZE)
+        self.assertContains(response, f"Message {MESSAGE_PAGE_SIZE + 9}")
+        self.assertNotContains(response, "Hello, world!")
+        self.assertIsNotNone(response.context["next_cursor"])
 
+    def test_load_older_walks_back_to_first_message(self):
+        self._create_messages(MESSAGE_PAGE_SIZE * 2)
+        seen = []
+        cursor = self.client.get(reverse("index")).context["next_cursor"]
+        while cursor:
+            response = self.client.get(reverse("older_messages"), {"before": cursor})
+            self.assertEqual(response.status_code, 200)
+            seen = list(response.context["messages"]) + seen
+            cursor = response.context["next_cursor"]
+        self.assertEqual(seen[0].content, "Hello, world!")
+        self.assertEqual(len(seen), MESSAGE_PAGE_SIZE + 1)
+
+    def test_load_older_scoped_to_room(self):
+        other = Room.objects.create(name="Other Room")
+        Message.objects.create(room=other, user=self.user, content="Other room message")
+        response = self.client.get(reverse("index"), {"room": "test-room"})
+        self.assertContains(response, "Hello, world!")
+        self.assertNotContains(response, "Other room message")
+
+    def test_load_older_requires_cursor(self):
+        self.assertEqual(self.client.get(reverse("older_messages")).status_code, 400)
+        self.assertEqual(self.client.get(reverse("older_messages"), {"before": "nope"}).status_code, 400)
+        for cursor in ("99999999999999999999-1", "1-99999999999999999999"):
+            self.assertEqual(self.client.get(reverse("older_messages"), {"before": cursor}).status_code, 400)
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0.1)
 class ChatConsumerTest(TestCase):
     def setUp(self):
+        room_cache.clear()
+        room_history.clear()
         self.user = User.objects.create_user(username="demo_user", email="demo@example.com")
         self.room = Room.objects.create(name="General Chat", description="General discussion room")
 
@@ -150,3 +266,1753 @@ class ChatConsumerTest(TestCase):
         self.assertEqual(final_count, initial_count)  # No new messages
 
         await communicator.disconnect()
+
+
+class RoomCacheTest(TestCase):
+    def setUp(self):
+        self.cache = RoomCache(ttl=60)
+
+    def test_hit_avoids_query(self):
+        room = async_to_sync(self.cache.aget_or_create)("Cached Room")
+        with self.assertNumQueries(0):
+            cached = async_to_sync(self.cache.aget_or_create)("Cached Room")
+        self.assertEqual(cached.pk, room.pk)
+
+    def test_lookup_by_slug(self):
+        room = Room.objects.create(name="Slug Room")
+        self.assertEqual(async_to_sync(self.cache.aget)("slug-room").pk, room.pk)
+        with self.assertNumQueries(0):
+            async_to_sync(self.cache.aget)("slug-room")
+
+    def test_expired_entry_is_refetched(self):
+        self.cache = RoomCache(ttl=0)
+        async_to_sync(self.cache.aget_or_create)("Cached Room")
+        with self.assertNumQueries(1):
+            async_to_sync(self.cache.aget_or_create)("Cached Room")
+
+    def test_room_save_invalidates(self):
+        room = async_to_sync(room_cache.aget_or_create)("Renamed Room")
+        room.name = "Other Name"
+        room.save()
+        self.assertEqual(len(room_cache), 0)
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0)
+class ChatConsumerQueryCountTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        User.objects.create_user(username="demo_user", email="demo@example.com")
+        Room.objects.create(name="General Chat")
+
+    async def _chat(self, count):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        for i in range(count):
+            await communicator.send_json_to({"message": f"Message {i}"})
+            await communicator.receive_json_from(timeout=5)
+            await communicator.receive_json_from(timeout=5)
+        await communicator.disconnect()
+
+    def _lookups(self, count):
+        room_cache.clear()
+        room_history.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            async_to_sync(self._chat)(count)
+        return [
+            q["sql"] for q in ctx.captured_queries
+            if q["sql"].startswith("SELECT") and ('FROM "chat_room"' in q["sql"] or 'FROM "auth_user"' in q["sql"])
+        ]
+
+    def test_lookups_do_not_grow_with_message_count(self):
+        """User and room are resolved once per connection, not once per message"""
+        self.assertEqual(len(self._lookups(1)), len(self._lookups(3)))
+
+
+class EchoResponder(BaseResponder):
+    async def respond(self, message):
+        return f"echo: {message.content}"
+
+
+class FailingResponder(BaseResponder):
+    async def respond(self, message):
+        raise RuntimeError("bot is down")
+
+
+class BotReplyPipelineTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        User.objects.create_user(username="demo_user", email="demo@example.com")
+
+    @override_settings(CHAT_BOT_REPLY_DELAY=0.5)
+    async def test_echoes_are_not_delayed_by_bot_replies(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        await communicator.connect()
+        for i in range(3):
+            await communicator.send_json_to({"message": f"Message {i}"})
+
+        echoes = [await communicator.receive_json_from(timeout=0.4) for _ in range(3)]
+        self.assertEqual([e["type"] for e in echoes], ["user"] * 3)
+
+        replies = [await communicator.receive_json_from(timeout=2) for _ in range(3)]
+        self.assertEqual([r["type"] for r in replies], ["bot"] * 3)
+        await communicator.disconnect()
+
+    @override_settings(CHAT_BOT_REPLY_DELAY=10)
+    async def test_disconnect_cancels_pending_replies(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        await communicator.connect()
+        await communicator.send_json_to({"message": "Anyone there?"})
+        await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(await Message.objects.acount(), 1)
+
+    @override_settings(CHAT_BOT_RESPONDER="chat.tests.EchoResponder")
+    async def test_custom_responder(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        await communicator.connect()
+        await communicator.send_json_to({"message": "ping"})
+        await communicator.receive_json_from()
+
+        reply = await communicator.receive_json_from()
+        self.assertEqual(reply["message"], "echo: ping")
+        await communicator.disconnect()
+
+    @override_settings(CHAT_BOT_RESPONDER="chat.tests.FailingResponder", CHAT_BOT_MAX_PENDING_REPLIES=1)
+    async def test_failed_reply_is_logged_and_cleared(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        await communicator.connect()
+        with self.assertLogs("chat.consumers", "ERROR") as logs:
+            for i in range(2):
+                await communicator.send_json_to({"message": f"Message {i}"})
+                echo = await communicator.receive_json_from()
+                self.assertEqual(echo["message"], f"Message {i}")
+                self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+        # Each failure freed its slot, so the second message was given a reply too
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("RuntimeError: bot is down", logs.output[0])
+        await communicator.disconnect()
+
+
+class WriteBehindBufferTest(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="Test Room")
+        self.user = User.objects.create_user(username="testuser")
+        self.buffer = WriteBehindBuffer(batch_size=100, flush_interval=0.01, max_pending=100)
+
+    def _message(self, i):
+        return Message(room=self.room, user=self.user, content=f"Message {i}")
+
+    def _writes(self, ctx):
+        return [q["sql"] for q in ctx.captured_queries if q["sql"].startswith(("INSERT", "UPDATE"))]
+
+    def test_concurrent_inserts_share_one_batch(self):
+        async def save_all():
+            return await asyncio.gather(*(self.buffer.save(self._message(i)) for i in range(20)))
+
+        with CaptureQueriesContext(connection) as ctx:
+            saved = async_to_sync(save_all)()
+        writes = self._writes(ctx)
+        # One INSERT for the batch and one UPDATE of the room's activity fields
+        self.assertEqual(len(writes), 2)
+        self.assertTrue(writes[1].startswith('UPDATE "chat_room"'))
+        self.assertTrue(all(message.pk for message in saved))
+        self.assertEqual(Message.objects.count(), 20)
+
+    def test_read_receipts_are_one_update(self):
+        messages = [Message.objects.create(room=self.room, user=self.user, content="Hi") for _ in range(5)]
+
+        async def mark_all():
+            for message in messages:
+                await self.buffer.mark_read(message)
+            await self.buffer.drain()
+
+        with CaptureQueriesContext(connection) as ctx:
+            async_to_sync(mark_all)()
+        self.assertEqual(len(self._writes(ctx)), 1)
+        self.assertFalse(Message.objects.filter(read_at__isnull=True).exists())
+
+    def test_receipt_for_unsaved_message_rides_with_insert(self):
+        message = self._message(0)
+        async_to_sync(self.buffer.mark_read)(message)
+        with CaptureQueriesContext(connection) as ctx:
+            async_to_sync(self.buffer.save)(message)
+        self.assertEqual(len(self._writes(ctx)), 2)
+        message.refresh_from_db()
+        self.assertIsNotNone(message.read_at)
+
+    def test_backpressure_when_full(self):
+        self.buffer = WriteBehindBuffer(batch_size=100, flush_interval=0.05, max_pending=2)
+        peak = 0
+
+        async def save(i):
+            nonlocal peak
+            message = await self.buffer.save(self._message(i))
+            peak = max(peak, self.buffer.pending)
+            return message
+
+        async def save_all():
+            return await asyncio.wait_for(asyncio.gather(*(save(i) for i in range(5))), timeout=2)
+
+        saved = async_to_sync(save_all)()
+        self.assertEqual(len(saved), 5)
+        self.assertLessEqual(peak, 2)
+        self.assertEqual(Message.objects.count(), 5)
+
+    def test_backpressure_counts_batches_being_written(self):
+        # Batches fill long before the buffer does, as with the default settings
+        self.buffer = WriteBehindBuffer(batch_size=2, flush_interval=0.01, max_pending=20)
+        write = self.buffer._write
+        schedule = self.buffer._schedule
+        wake_waiters = self.buffer._wake_waiters
+        peak = waiting = 0
+
+        def slow_write(messages, read_ids):
+            time.sleep(0.005)
+            write(messages, read_ids)
+
+        # Measured on the loop, the only thread that moves writes and waiters around
+        def measure_schedule():
+            nonlocal peak
+            peak = max(peak, self.buffer.pending)
+            schedule()
+
+        def measure_wake_waiters():
+            nonlocal waiting
+            waiting = max(waiting, len(self.buffer._space_waiters))
+            wake_waiters()
+
+        async def save_all():
+            return await asyncio.wait_for(
+                asyncio.gather(*(self.buffer.save(self._message(i)) for i in range(100))), timeout=10
+            )
+
+        with mock.patch.multiple(
+            self.buffer, _write=slow_write, _schedule=measure_schedule, _wake_waiters=measure_wake_waiters
+        ):
+            saved = async_to_sync(save_all)()
+        self.assertEqual(len(saved), 100)
+        # Senders waited for the batches in flight instead of queueing more behind them
+        self.assertGreater(waiting, 0)
+        self.assertLessEqual(peak, 20)
+        self.assertEqual(self.buffer.pending, 0)
+
+    def test_read_receipts_wait_when_full(self):
+        messages = [Message.objects.create(room=self.room, user=self.user, content="Hi") for _ in range(5)]
+        self.buffer = WriteBehindBuffer(batch_size=100, flush_interval=0.05, max_pending=2)
+        schedule = self.buffer._schedule
+        peak = 0
+
+        def measure_schedule():
+            nonlocal peak
+            peak = max(peak, self.buffer.pending)
+            schedule()
+
+        async def mark_all():
+            await asyncio.wait_for(asyncio.gather(*(self.buffer.mark_read(m) for m in messages * 2)), timeout=2)
+            await self.buffer.drain()
+
+        with mock.patch.object(self.buffer, "_schedule", measure_schedule):
+            async_to_sync(mark_all)()
+        self.assertLessEqual(peak, 2)
+        self.assertFalse(Message.objects.filter(read_at__isnull=True).exists())
+        self.assertEqual(self.buffer.pending, 0)
+
+    def test_failed_read_receipts_are_logged_and_dropped(self):
+        message = Message.objects.create(room=self.room, user=self.user, content="Hi")
+
+        async def mark():
+            await self.buffer.mark_read(message)
+            await self.buffer.drain()
+
+        with mock.patch.object(self.buffer, "_write", side_effect=RuntimeError("database is down")):
+            with self.assertLogs("chat.persistence", "ERROR") as logs:
+                async_to_sync(mark)()
+        self.assertIn("Dropped 1 read receipts", logs.output[0])
+        self.assertEqual(self.buffer.pending, 0)
+
+    def test_cancelled_insert_is_dropped(self):
+        async def save_and_cancel():
+            task = asyncio.ensure_future(self.buffer.save(self._message(0)))
+            await asyncio.sleep(0)
+            task.cancel()
+            await self.buffer.drain()
+
+        async_to_sync(save_and_cancel)()
+        self.assertEqual(Message.objects.count(), 0)
+
+
+class ReadReceiptTest(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="Test Room")
+        self.other_room = Room.objects.create(name="Other Room")
+        self.user = User.objects.create_user(username="testuser")
+        self.messages = [
+            Message.objects.create(room=self.room, user=self.user, content=f"Message {i}") for i in range(5)
+        ]
+        Message.objects.create(room=self.other_room, user=self.user, content="Elsewhere")
+
+    def test_mark_as_read_updates_only_read_at(self):
+        message = self.messages[0]
+        with CaptureQueriesContext(connection) as ctx:
+            message.mark_as_read()
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertNotIn("content", ctx.captured_queries[0]["sql"])
+        message.refresh_from_db()
+        self.assertIsNotNone(message.read_at)
+
+    def test_mark_range_read_in_one_update(self):
+        with self.assertNumQueries(1):
+            updated = Message.objects.up_to(self.room, self.messages[2].pk).mark_read()
+        self.assertEqual(updated, 3)
+        self.assertEqual(Message.objects.unread_count(room=self.room), 2)
+        self.assertEqual(Message.objects.unread_count(), 3)
+
+    def test_already_read_messages_keep_their_receipt(self):
+        self.messages[0].mark_as_read()
+        first_read_at = Message.objects.get(pk=self.messages[0].pk).read_at
+        Message.objects.up_to(self.room, self.messages[4].pk).mark_read()
+        self.assertEqual(Message.objects.get(pk=self.messages[0].pk).read_at, first_read_at)
+
+    def test_read_cursor_only_moves_forward(self):
+        self.assertEqual(ReadCursor.objects.unread_count(self.user, self.room), 5)
+        ReadCursor.objects.advance(self.user, self.room, self.messages[3].pk)
+        ReadCursor.objects.advance(self.user, self.room, self.messages[1].pk)
+        self.assertEqual(ReadCursor.objects.get(user=self.user, room=self.room).last_read_id, self.messages[3].pk)
+        self.assertEqual(ReadCursor.objects.unread_count(self.user, self.room), 1)
+
+
+class RoomActivityTest(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="Test Room")
+        self.other_room = Room.objects.create(name="Other Room")
+        self.quiet_room = Room.objects.create(name="Quiet Room")
+        self.user = User.objects.create_user(username="testuser")
+        self.messages = [
+            Message.objects.create(room=self.room, user=self.user, content=f"Message {i}") for i in range(3)
+        ]
+
+    def _activity(self, room):
+        room = Room.objects.get(pk=room.pk)
+        return room.message_count, room.last_message_id
+
+    def test_saves_and_deletes_update_the_room(self):
+        self.assertEqual(self._activity(self.room), (3, self.messages[2].pk))
+        self.assertEqual(Room.objects.get(pk=self.room.pk).last_message_at, self.messages[2].timestamp)
+        self.messages[2].delete()
+        self.assertEqual(self._activity(self.room), (2, self.messages[1].pk))
+        self.messages[0].delete()
+        self.assertEqual(self._activity(self.room), (1, self.messages[1].pk))
+        self.messages[1].delete()
+        self.assertEqual(self._activity(self.room), (0, None))
+
+    def test_bulk_deletes_do_not_load_the_rows(self):
+        latest = Message.objects.create(room=self.other_room, user=self.user, content="Elsewhere")
+        Message.objects.create(room=self.other_room, user=self.user, content="Gone")
+        room_history.get(self.room)
+        with CaptureQueriesContext(connection) as ctx:
+            Message.objects.exclude(pk=latest.pk).delete()
+            self.room.delete()
+        self.assertFalse([q for q in ctx.captured_queries if '"chat_message"."content"' in q["sql"]])
+        self.assertEqual(self._activity(self.other_room), (1, latest.pk))
+        self.assertEqual(len(room_history), 0)
+
+    def test_write_behind_batch_counts_each_room_once(self):
+        buffer = WriteBehindBuffer(batch_size=100, flush_interval=0.01, max_pending=100)
+
+        async def save_all():
+            return await asyncio.gather(*(
+                buffer.save(Message(room=room, user=self.user, content="Hi"))
+                for room in [self.room, self.other_room] * 3
+            ))
+
+        saved = async_to_sync(save_all)()
+        self.assertEqual(self._activity(self.room), (6, saved[4].pk))
+        self.assertEqual(self._activity(self.other_room), (3, saved[5].pk))
+
+    def test_saving_a_stale_room_keeps_its_activity(self):
+        stale = Room.objects.get(pk=self.room.pk)
+        Message.objects.create(room=self.room, user=self.user, content="Newer")
+        stale.description = "Edited"
+        stale.save()
+        self.assertEqual(self._activity(self.room)[0], 4)
+        self.assertEqual(Room.objects.get(pk=self.room.pk).description, "Edited")
+
+    def test_rooms_by_activity(self):
+        Message.objects.create(room=self.other_room, user=self.user, content="Latest")
+        self.assertEqual(list(Room.objects.by_activity()), [self.other_room, self.room])
+        with self.assertNumQueries(1):
+            body = self.client.get(reverse("rooms")).json()
+        self.assertEqual([(room["slug"], room["message_count"]) for room in body["rooms"]],
+                         [("other-room", 1), ("test-room", 3)])
+
+    @skipUnless(connection.vendor == "sqlite", "Query plan text is backend specific")
+    def test_activity_order_uses_index(self):
+        self.assertIn("room_activity_idx", Room.objects.by_activity().explain())
+
+    def test_unread_count_without_cursor_is_the_message_count(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(ReadCursor.objects.unread_count(self.user, self.room), 3)
+
+    def test_repair_command(self):
+        Room.objects.filter(pk=self.room.pk).update(message_count=99, last_message_id=None)
+        out = io.StringIO()
+        call_command("repairroomactivity", dry_run=True, stdout=out)
+        self.assertIn("1 room(s) to repair", out.getvalue())
+        self.assertEqual(self._activity(self.room), (99, None))
+
+        call_command("repairroomactivity", stdout=out)
+        self.assertEqual(self._activity(self.room), (3, self.messages[2].pk))
+        self.assertEqual(self._activity(self.quiet_room), (0, None))
+        self.assertFalse(Room.objects.stale_activity().exists())
+
+        call_command("repairroomactivity", "test-room", all=True, stdout=out)
+        self.assertIn("Repaired 1 room(s).", out.getvalue())
+
+
+class RoomHistoryQueryTest(TestCase):
+    def setUp(self):
+        room_history.clear()
+        self.room = Room.objects.create(name="Test Room")
+        self.other_room = Room.objects.create(name="Other Room")
+        self.user = User.objects.create_user(username="testuser")
+        self.messages = [
+            Message.objects.create(room=self.room, user=self.user, content=f"Message {i}") for i in range(6)
+        ]
+        Message.objects.create(room=self.other_room, user=self.user, content="Elsewhere")
+
+    def test_recent_is_room_scoped_newest_first(self):
+        recent = list(Message.objects.recent(self.room, limit=3))
+        self.assertEqual(recent, self.messages[:-4:-1])
+        self.assertEqual(list(self.room.get_recent_messages(limit=3)), recent)
+
+    def test_before_and_after_cursor(self):
+        cursor = self.messages[3]
+        self.assertEqual(list(Message.objects.before(self.room, cursor, limit=2)), [self.messages[2], self.messages[1]])
+        self.assertEqual(list(Message.objects.after(self.room, cursor)), self.messages[4:])
+
+    def test_cursor_string_and_timestamp_ties(self):
+        Message.objects.filter(room=self.room).update(timestamp=self.messages[0].timestamp)
+        cursor = encode_cursor(Message.objects.get(pk=self.messages[3].pk))
+        self.assertEqual(list(Message.objects.after(self.room, cursor)), self.messages[4:])
+        self.assertEqual(len(Message.objects.before(self.room, cursor)), 3)
+
+    @skipUnless(connection.vendor == "sqlite", "Query plan text is backend specific")
+    def test_history_uses_composite_index(self):
+        plan = Message.objects.before(self.room, self.messages[3]).explain()
+        self.assertIn("room_timestamp_id_idx", plan)
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0)
+class RoomBroadcastTest(TestCase):
+    """Runs against whichever channel layer is configured (CHANNEL_LAYER_URL)."""
+
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        User.objects.create_user(username="demo_user", email="demo@example.com")
+        Room.objects.create(name="Lobby")
+        Room.objects.create(name="Side Room")
+
+    async def _connect(self, path):
+        communicator = WebsocketCommunicator(application, path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_message_reaches_every_member_of_the_room(self):
+        alice = await self._connect("/ws/chat/lobby/")
+        bob = await self._connect("/ws/chat/lobby/")
+        carol = await self._connect("/ws/chat/side-room/")
+
+        await alice.send_json_to({"message": "Hello lobby"})
+        for member in (alice, bob):
+            frame = await member.receive_json_from()
+            self.assertEqual((frame["type"], frame["message"]), ("user", "Hello lobby"))
+            self.assertEqual((await member.receive_json_from())["type"], "bot")
+        self.assertTrue(await carol.receive_nothing())
+
+        for communicator in (alice, bob, carol):
+            await communicator.disconnect()
+
+    async def test_each_broadcast_is_serialized_once(self):
+        members = [await self._connect("/ws/chat/lobby/") for _ in range(3)]
+        with mock.patch.object(consumers, "message_frame", wraps=consumers.message_frame) as frame:
+            await members[0].send_json_to({"message": "Hi all"})
+            for member in members:
+                await member.receive_json_from()
+                await member.receive_json_from()
+        self.assertEqual(frame.call_count, 2)  # user message + bot reply
+        for member in members:
+            await member.disconnect()
+
+    async def test_unknown_room_is_rejected(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/no-such-room/")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class MessageFrameTest(TestCase):
+    def setUp(self):
+        frame_cache.clear()
+        self.message = Message(id=7, content="Héllo", timestamp=timezone.now())
+
+    def test_frame_is_encoded_once(self):
+        frame = message_frame(self.message, "user")
+        self.assertIs(message_frame(self.message, "user"), frame)
+        self.assertEqual(frame_cache.hits, 1)
+        self.assertEqual(
+            json.loads(frame),
+            {"type": "user", "message": "Héllo", "id": 7, "timestamp": self.message.timestamp.isoformat()},
+        )
+
+    @override_settings(CHAT_FAST_JSON=False)
+    def test_stdlib_backend_produces_same_payload(self):
+        frame = message_frame(self.message, "bot")
+        self.assertEqual(json.loads(frame)["type"], "bot")
+        self.assertEqual(json.loads(frame)["message"], "Héllo")
+
+    def test_lru_evicts_oldest(self):
+        cache = FrameCache(maxsize=2)
+        cache.put(1, "a")
+        cache.put(2, "b")
+        cache.get(1)
+        cache.put(3, "c")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), "a")
+        self.assertEqual(len(cache), 2)
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0)
+class HtmlFragmentFrameTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        frame_cache.clear()
+        User.objects.create_user(username="demo_user", email="demo@example.com")
+        Room.objects.create(name="Lobby")
+
+    def test_fragment_is_escaped_and_memoized(self):
+        message = Message(id=3, content="<b>hi</b>", timestamp=timezone.now())
+        fragment = message_fragment(message, "user")
+        self.assertTrue(fragment.startswith('<div hx-swap-oob="beforeend:#chat-messages">'))
+        self.assertIn("&lt;b&gt;hi&lt;/b&gt;", fragment)
+        self.assertIn("justify-end", fragment)
+        self.assertIs(message_fragment(message, "user"), fragment)
+
+    async def test_html_clients_receive_fragments_rendered_once(self):
+        members = []
+        for _ in range(3):
+            communicator = WebsocketCommunicator(application, "/ws/chat/lobby/?format=html")
+            await communicator.connect()
+            members.append(communicator)
+        json_member = WebsocketCommunicator(application, "/ws/chat/lobby/")
+        await json_member.connect()
+
+        with mock.patch.object(frames, "render_fragment", wraps=frames.render_fragment) as render:
+            await members[0].send_json_to({"message": "Hello"})
+            for member in members:
+                frame = await member.receive_from()
+                self.assertIn('id="message-', frame)
+                self.assertIn("Hello", frame)
+                await member.receive_from()
+            self.assertEqual((await json_member.receive_json_from())["message"], "Hello")
+            await json_member.receive_json_from()
+        self.assertEqual(render.call_count, 2)  # user message + bot reply
+
+        for communicator in members + [json_member]:
+            await communicator.disconnect()
+
+
+class ThrottleTest(TestCase):
+    def setUp(self):
+        counters.clear()
+
+    def test_token_bucket_allows_burst_then_throttles(self):
+        bucket = TokenBucket(rate=1, burst=3)
+        self.assertEqual([bucket.consume() for _ in range(4)], [True, True, True, False])
+        self.assertGreater(bucket.retry_after(), 0)
+
+    def _drive_queue(self, policy, puts):
+        sent = []
+
+        async def run():
+            release = asyncio.Event()
+
+            async def slow_send(frame):
+                await release.wait()
+                sent.append(frame)
+
+            queue = OutboundQueue(slow_send, maxsize=2, policy=policy)
+            for frame, key in puts:
+                queue.put(frame, key=key)
+                # Let the writer pick up the first frame and block on the slow socket
+                await asyncio.sleep(0)
+            release.set()
+            await asyncio.sleep(0.01)
+            await queue.close()
+
+        async_to_sync(run)()
+        return sent
+
+    def test_drop_policy_discards_oldest(self):
+        sent = self._drive_queue("drop", [("a", None), ("b", None), ("c", None), ("d", None)])
+        # "a" is already being written when the queue fills up
+        self.assertEqual(sent, ["a", "c", "d"])
+        self.assertEqual(counters["dropped"], 1)
+
+    def test_coalesce_policy_replaces_pending_frame(self):
+        sent = self._drive_queue("coalesce", [("a", None), ("t1", "typing"), ("t2", "typing"), ("b", None)])
+        self.assertEqual(sent, ["a", "t2", "b"])
+        self.assertEqual(counters["coalesced"], 1)
+        self.assertEqual(counters["dropped"], 0)
+
+    def test_failed_send_closes_the_queue(self):
+        async def broken_send(frame):
+            raise ConnectionResetError("gone")
+
+        async def run():
+            queue = OutboundQueue(broken_send)
+            queue.put("a")
+            queue.put("b")
+            await asyncio.wait_for(queue.join(), timeout=1)
+            queue.put("c")
+            closed = queue.closed, len(queue)
+            await queue.close()
+            return closed
+
+        with self.assertLogs("chat.throttle", "ERROR"):
+            self.assertEqual(async_to_sync(run)(), (True, 0))
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0, CHAT_CONNECTION_RATE_LIMIT=(0.1, 2))
+class ConsumerRateLimitTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        user_buckets.clear()
+        counters.clear()
+        User.objects.create_user(username="demo_user", email="demo@example.com")
+
+    async def test_flood_is_throttled_with_error_frame(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        await communicator.connect()
+        for i in range(3):
+            await communicator.send_json_to({"message": f"Message {i}"})
+
+        frames = [await communicator.receive_json_from() for _ in range(5)]
+        errors = [frame for frame in frames if frame["type"] == "error"]
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]["code"], "rate_limited")
+        self.assertGreater(errors[0]["retry_after"], 0)
+        self.assertEqual(counters["throttled"], 1)
+        await communicator.disconnect()
+        self.assertEqual(await Message.objects.acount(), 4)  # two messages and their bot replies
+
+
+class RoomHistoryTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        self.user = User.objects.create_user(username="testuser")
+        self.room = Room.objects.create(name="Lobby")
+
+    def _messages(self, room, count):
+        return [Message.objects.create(room=room, user=self.user, content=f"Message {i}") for i in range(count)]
+
+    def test_buffer_overflow_raises_floor(self):
+        buffer = RoomHistory(floor=None, maxlen=3)
+        messages = self._messages(self.room, 4)
+        for message in (messages[0], messages[2], messages[1], messages[1]):
+            buffer.add(HistoryEntry(message))
+        self.assertEqual([entry.message for entry in buffer.since(0)], messages[:3])
+        buffer.add(HistoryEntry(messages[3]))
+        self.assertEqual(buffer.floor, (messages[1].timestamp, messages[1].pk))
+        self.assertEqual(buffer.id_floor, messages[0].pk)
+        self.assertEqual([entry.message for entry in buffer.since(messages[1].pk)], messages[2:])
+        self.assertIsNone(buffer.since(0))
+        self.assertIsNone(buffer.page(limit=3))  # older messages are only in the database
+        self.assertEqual(buffer.page(limit=2), (messages[2:], encode_cursor(messages[2])))
+
+    def test_history_is_served_from_memory_after_warming(self):
+        messages = self._messages(self.room, 5)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.room.get_recent_messages(limit=3), messages[:-4:-1])
+        latest = Message.objects.create(room=self.room, user=self.user, content="Latest")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.room.get_recent_messages(limit=2), [latest, messages[-1]])
+        self.assertEqual((room_history.stats["hits"], room_history.stats["warmed"]), (2, 1))
+
+    def test_room_pages_skip_the_database(self):
+        self._messages(self.room, MESSAGE_PAGE_SIZE + 5)
+        first = self.client.get(reverse("index"), {"room": "lobby"})
+        with CaptureQueriesContext(connection) as ctx:
+            second = self.client.get(reverse("index"), {"room": "lobby"})
+            older = self.client.get(reverse("older_messages"), {"before": second.context["next_cursor"], "room": "lobby"})
+        self.assertFalse([q for q in ctx.captured_queries if 'FROM "chat_message"' in q["sql"]])
+        self.assertEqual(list(second.context["messages"]), list(first.context["messages"]))
+        self.assertEqual(len(older.context["messages"]), 5)
+        self.assertIsNone(older.context["next_cursor"])
+
+    def test_buffers_follow_timestamps_when_ids_disagree(self):
+        cache = HistoryCache(room_size=3)
+        current = self._messages(self.room, 3)
+        # Imported rows: a year old, with higher ids
+        imported = self._messages(self.room, 3)
+        Message.objects.filter(pk__in=[message.pk for message in imported]).update(
+            timestamp=timezone.now() - timedelta(days=365)
+        )
+        self.assertEqual(cache.page(self.room, limit=2), (current[1:], encode_cursor(current[1])))
+        # Anything older than the oldest buffered message is left to the database
+        self.assertIsNone(cache.page(self.room, cursor=encode_cursor(current[1]), limit=2))
+        self.assertIsNone(cache.page(self.room, cursor=encode_cursor(current[0]), limit=2))
+        # So are replays from before an imported id the buffer does not hold
+        buffer = cache.get(self.room)
+        self.assertEqual(buffer.id_floor, imported[-1].pk)
+        self.assertIsNone(buffer.since(current[-1].pk))
+
+    def test_buffers_expire_after_the_ttl(self):
+        messages = self._messages(self.room, 2)
+        self.assertEqual(room_history.recent(self.room)[0].content, "Message 1")
+        # A write this process never sees, as from another server or raw SQL
+        Message.objects.filter(pk=messages[1].pk).update(content="Edited")
+        self.assertEqual(room_history.recent(self.room)[0].content, "Message 1")
+        later = time.monotonic() + room_history.ttl
+        with mock.patch("chat.history.time.monotonic", return_value=later):
+            self.assertEqual(room_history.recent(self.room)[0].content, "Edited")
+        self.assertEqual(room_history.stats["expired"], 1)
+
+    def test_repairing_rooms_discards_their_buffers(self):
+        self._messages(self.room, 2)
+        room_history.get(self.room)
+        call_command("repairroomactivity", "lobby", all=True, stdout=io.StringIO())
+        self.assertEqual(len(room_history), 0)
+
+    @override_settings(CHAT_BOT_REPLY_DELAY=0)
+    async def test_discard_broadcasts_reach_the_room_sockets(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/lobby/")
+        await communicator.connect()
+        self.assertEqual(len(room_history), 1)
+        with mock.patch.object(room_history, "discard", wraps=room_history.discard) as discard:
+            await cluster.discard_history([self.room.pk])
+            await asyncio.sleep(0.05)
+        await communicator.disconnect()
+        # Once by the caller, once by the socket's handler
+        self.assertEqual(discard.call_count, 2)
+        self.assertEqual(len(room_history), 0)
+
+    def test_idle_rooms_are_evicted_under_the_memory_cap(self):
+        cache = HistoryCache(max_bytes=10000, room_size=10)
+        other = Room.objects.create(name="Other")
+        self._messages(self.room, 10)
+        self._messages(other, 10)
+        cache.get(self.room)
+        cache.get(other)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats["evicted"], 1)
+        self.assertLessEqual(cache.size, 10000)
+        # The running total follows adds, frames attached later and discards
+        latest = Message.objects.create(room=other, user=self.user, content="Latest")
+        cache.add(other.pk, latest)
+        cache.attach(other.pk, latest.pk, "message", {"json": "x" * 100})
+        self.assertEqual(cache.size, cache.get(other).size)
+        cache.discard(other.pk)
+        self.assertEqual(cache.size, 0)
+        self.assertIsNotNone(cache.page(other, limit=5))
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels_redis.core.RedisChannelLayer"}})
+    def test_rooms_without_local_sockets_are_not_buffered_on_shared_layers(self):
+        self._messages(self.room, 3)
+        self.assertIsNone(room_history.recent(self.room))
+        self.assertEqual(len(room_history), 0)
+        self.assertIsInstance(self.room.get_recent_messages(), list)
+        room_history.join(self.room)
+        self.assertEqual(len(room_history.recent(self.room)), 3)
+        room_history.leave(self.room)
+        self.assertEqual(len(room_history), 0)
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0)
+class ResumeTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        self.user = User.objects.create_user(username="demo_user", email="demo@example.com")
+        self.room = Room.objects.create(name="General Chat")
+
+    async def _connect(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def _replay(self, communicator, last_id):
+        await communicator.send_json_to({"type": "resume", "last_id": last_id})
+        frames = []
+        while True:
+            frame = await communicator.receive_json_from()
+            if frame["type"] == "resumed":
+                return frames, frame
+            frames.append(frame)
+
+    async def test_small_gap_is_replayed_from_memory(self):
+        alice = await self._connect()
+        ids = []
+        for text in ("one", "two"):
+            await alice.send_json_to({"message": text})
+            ids += [(await alice.receive_json_from())["id"], (await alice.receive_json_from())["id"]]
+
+        bob = await self._connect()
+        frames, resumed = await self._replay(bob, ids[0])
+        self.assertEqual([frame["id"] for frame in frames], ids[1:])
+        self.assertEqual([frame["type"] for frame in frames], ["bot", "user", "bot"])
+        self.assertEqual(resumed, {"type": "resumed", "last_id": ids[-1], "source": "memory", "complete": True})
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    @override_settings(CHAT_RESUME_CHUNK_SIZE=2, CHAT_RESUME_MAX_MESSAGES=3, CHAT_HISTORY_ROOM_SIZE=2)
+    async def test_large_gap_is_read_in_chunks_and_capped(self):
+        ids = []
+        for i in range(5):
+            message = await Message.objects.acreate(room=self.room, user=self.user, content=f"Missed {i}")
+            ids.append(message.pk)
+
+        communicator = await self._connect()
+        frames, resumed = await self._replay(communicator, 0)
+        self.assertEqual([frame["id"] for frame in frames], ids[:3])
+        self.assertEqual(resumed["source"], "database")
+        self.assertFalse(resumed["complete"])
+        self.assertEqual(resumed["last_id"], ids[2])
+
+        frames, resumed = await self._replay(communicator, resumed["last_id"])
+        self.assertEqual([frame["id"] for frame in frames], ids[3:])
+        self.assertTrue(resumed["complete"])
+        await communicator.disconnect()
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0)
+class TypedProtocolTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        user_buckets.clear()
+        typing_tracker.clear()
+        presence.clear()
+        self.user = User.objects.create_user(username="demo_user", email="demo@example.com")
+        self.room = Room.objects.create(name="General Chat")
+
+    async def _connect(self, subprotocols=None, path="/ws/chat/"):
+        communicator = WebsocketCommunicator(application, path, subprotocols=subprotocols)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def _receive(self, communicator):
+        frame = await communicator.receive_from()
+        return msgpack.unpackb(frame) if isinstance(frame, bytes) else json.loads(frame)
+
+    async def test_json_subprotocol_acks_and_types_chat_frames(self):
+        communicator, subprotocol = await self._connect(["chat.v2.json", "chat.v1.json"])
+        self.assertEqual(subprotocol, "chat.v1.json")
+        await communicator.send_json_to({"v": 1, "type": "chat", "message": "Hi", "ref": "c1"})
+        frames = [await self._receive(communicator) for _ in range(3)]
+        ack = next(frame for frame in frames if frame["type"] == "ack")
+        chats = [frame for frame in frames if frame["type"] == "chat"]
+        self.assertEqual(ack["ref"], "c1")
+        self.assertEqual([(frame["v"], frame["kind"]) for frame in chats], [(1, "user"), (1, "bot")])
+        self.assertEqual(chats[0]["id"], ack["id"])
+        self.assertEqual((chats[0]["message"], chats[0]["user"]), ("Hi", self.user.pk))
+        await communicator.disconnect()
+
+    @skipUnless(frames.msgpack is not None, "msgpack is not installed")
+    async def test_msgpack_frames_travel_as_bytes(self):
+        communicator, subprotocol = await self._connect(["chat.v1.msgpack"])
+        self.assertEqual(subprotocol, "chat.v1.msgpack")
+        await communicator.send_to(bytes_data=msgpack.packb({"v": 1, "type": "chat", "message": "Hi"}))
+        output = await communicator.receive_output()
+        self.assertIn("bytes", output)
+        self.assertEqual(msgpack.unpackb(output["bytes"])["type"], "ack")
+        await communicator.disconnect()
+
+    async def test_typing_and_read_reach_other_typed_sockets_only(self):
+        alice, _ = await self._connect(["chat.v1.json"])
+        bob, _ = await self._connect(path="/ws/chat/?format=v1")
+        legacy, _ = await self._connect()
+
+        await alice.send_json_to({"v": 1, "type": "typing", "active": True})
+        self.assertEqual(await self._receive(bob), {"v": 1, "type": "typing", "user": self.user.pk, "active": True})
+        message = await Message.objects.acreate(room=self.room, user=self.user, content="Hi")
+        await alice.send_json_to({"v": 1, "type": "read", "last_id": message.pk})
+        self.assertEqual(
+            await self._receive(bob), {"v": 1, "type": "read", "user": self.user.pk, "last_id": message.pk}
+        )
+        self.assertTrue(await alice.receive_nothing())
+        self.assertTrue(await legacy.receive_nothing())
+        cursor = await ReadCursor.objects.aget(user=self.user, room=self.room)
+        self.assertEqual(cursor.last_read_id, message.pk)
+        for communicator in (alice, bob, legacy):
+            await communicator.disconnect()
+
+    async def test_read_of_a_message_outside_the_room_is_ignored(self):
+        other_room = await Room.objects.acreate(name="Other")
+        elsewhere = await Message.objects.acreate(room=other_room, user=self.user, content="Hi")
+        alice, _ = await self._connect(["chat.v1.json"])
+        bob, _ = await self._connect(["chat.v1.json"])
+        for last_id in (elsewhere.pk, elsewhere.pk + 1000, 2 ** 64, -1, True):
+            await alice.send_json_to({"v": 1, "type": "read", "last_id": last_id})
+        self.assertTrue(await bob.receive_nothing())
+        self.assertFalse(await ReadCursor.objects.filter(user=self.user).aexists())
+        # The socket survived the out-of-range id
+        await alice.send_json_to({"v": 1, "type": "ping"})
+        self.assertEqual((await self._receive(alice))["type"], "pong")
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    async def test_bad_frames_get_error_codes(self):
+        communicator, _ = await self._connect(["chat.v1.json"])
+        for text, code in (("not json", "bad_frame"), ('{"v": 2, "type": "chat"}', "unsupported_version"),
+                           ('{"type": "shout"}', "unknown_type")):
+            await communicator.send_to(text_data=text)
+            self.assertEqual(await self._receive(communicator), {"v": 1, "type": "error", "code": code})
+        await communicator.disconnect()
+
+    def test_deflate_offer_is_accepted(self):
+        from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+        from websocket_demo.server import accept_deflate
+
+        self.assertIsInstance(accept_deflate([PerMessageDeflateOffer()]), PerMessageDeflateOfferAccept)
+        with override_settings(WEBSOCKET_DEFLATE=False):
+            self.assertIsNone(accept_deflate([PerMessageDeflateOffer()]))
+
+    def test_benchprotocol_reports_every_format(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as fh:
+            call_command("benchprotocol", messages=20, json_path=fh.name, stdout=io.StringIO())
+            results = json.load(fh)["results"]
+        for frame_format in ("json", "html") + frames.TYPED_FORMATS:
+            self.assertGreater(results[frame_format]["bytes"], results[frame_format]["deflated_bytes"])
+        self.assertIsNone(results["html"]["decode_us"])
+
+
+class TimerWheelTest(TestCase):
+    def test_keys_fire_once_when_due(self):
+        wheel = TimerWheel(0.1, now=0, slots=8)
+        wheel.schedule("a", 0.25)
+        wheel.schedule("b", 0.5)
+        wheel.schedule("c", 0.5)
+        wheel.cancel("c")
+        self.assertEqual(wheel.advance(0.25), [])
+        self.assertEqual(wheel.advance(0.35), ["a"])
+        # Rescheduling moves the deadline rather than adding one
+        wheel.schedule("b", 0.7)
+        self.assertEqual(wheel.advance(0.65), [])
+        self.assertEqual(wheel.advance(0.75), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_deadlines_beyond_one_turn_and_long_stalls(self):
+        wheel = TimerWheel(0.1, now=0, slots=8)
+        wheel.schedule("later", 1.05)
+        wheel.schedule("soon", 0.3)
+        # 0.8 s is a full turn: "later" shares a bucket with an earlier tick
+        self.assertEqual(wheel.advance(0.45), ["soon"])
+        self.assertEqual(wheel.advance(1.05), [])
+        self.assertEqual(wheel.advance(1.15), ["later"])
+        wheel.schedule("stalled", 1.2)
+        self.assertEqual(wheel.advance(60), ["stalled"])
+
+
+class TypingTrackerTest(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.sent = []
+
+        async def send(group, event):
+            self.sent.append((group, event["sender"], json.loads(event["frames"]["v1"])["active"]))
+
+        self.tracker = TypingTracker(send=send, clock=lambda: self.now)
+
+    def _run(self, *calls):
+        async def run():
+            for method, *args in calls:
+                await getattr(self.tracker, method)(*args)
+        async_to_sync(run)()
+
+    @override_settings(CHAT_TYPING_INTERVAL=1.0, CHAT_TYPING_TIMEOUT=5.0)
+    def test_keystrokes_are_coalesced_into_state_changes(self):
+        self._run(*[("update", "room", 1, "alice", True)] * 20)
+        self.assertEqual(self.sent, [("room", "alice", True)])
+        self.assertEqual(self.tracker.stats["coalesced"], 19)
+
+        # A stop and restart inside the interval never reaches the room
+        self.now += 0.5
+        self._run(("update", "room", 1, "alice", False), ("update", "room", 1, "alice", True))
+        self.now += 1
+        self._run(("tick",))
+        self.assertEqual(len(self.sent), 1)
+
+        # A stop is held back until the interval since the last broadcast has passed
+        self._run(("update", "room", 1, "alice", False))
+        self.assertEqual(self.sent[-1], ("room", "alice", False))
+        self.now += 0.2
+        self._run(("update", "room", 1, "alice", True))
+        self.assertEqual(len(self.sent), 2)
+        self.now += 0.8
+        self._run(("tick",))
+        self.assertEqual(self.sent[-1], ("room", "alice", True))
+        self.assertTrue(self.tracker.typing("room", 1))
+
+    @override_settings(CHAT_TYPING_INTERVAL=1.0, CHAT_TYPING_TIMEOUT=5.0)
+    def test_idle_typists_expire_and_are_forgotten(self):
+        self._run(("update", "room", 1, "alice", True), ("update", "room", 2, "bob", True))
+        self.now += 3
+        self._run(("update", "room", 2, "bob", True))
+        self.now += 2.1
+        self._run(("tick",))
+        self.assertEqual(self.sent[-1], ("room", "alice", False))
+        self.assertTrue(self.tracker.typing("room", 2))
+        self.assertEqual(self.tracker.stats["expired"], 1)
+
+        self.now += 1
+        self._run(("tick",), ("leave", "room", 2, "bob"))
+        self.now += 1
+        self._run(("tick",))
+        self.assertEqual(self.sent[-1], ("room", "bob", False))
+        self.now += 1
+        self._run(("tick",))
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(len(self.tracker.wheel), 0)
+
+    def test_leave_keeps_a_state_taken_over_by_another_socket(self):
+        self._run(("update", "room", 1, "tab-1", True), ("update", "room", 1, "tab-2", True),
+                  ("leave", "room", 1, "tab-1"))
+        self.assertTrue(self.tracker.typing("room", 1))
+        self.assertTrue(self.tracker._states["room", 1].active)
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0, CHAT_TYPING_INTERVAL=0)
+class TypingIndicatorConsumerTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        user_buckets.clear()
+        typing_tracker.clear()
+        presence.clear()
+        User.objects.create_user(username="demo_user", email="demo@example.com")
+        Room.objects.create(name="General Chat")
+
+    async def test_typing_is_broadcast_once_and_ends_with_the_message(self):
+        alice = WebsocketCommunicator(application, "/ws/chat/", subprotocols=["chat.v1.json"])
+        bob = WebsocketCommunicator(application, "/ws/chat/?format=v1")
+        page = WebsocketCommunicator(application, "/ws/chat/?format=html")
+        for communicator in (alice, bob, page):
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+        for _ in range(5):
+            await alice.send_json_to({"v": 1, "type": "typing", "active": True})
+        self.assertTrue((await bob.receive_json_from())["active"])
+        self.assertIn('id="typing-indicator"', await page.receive_from())
+        self.assertTrue(await bob.receive_nothing())
+
+        await alice.send_json_to({"v": 1, "type": "chat", "message": "Hi"})
+        stopped = await bob.receive_json_from()
+        self.assertEqual((stopped["type"], stopped["active"]), ("typing", False))
+        self.assertEqual((await bob.receive_json_from())["type"], "chat")
+        self.assertIn("hidden", await page.receive_from())
+        for communicator in (alice, bob, page):
+            await communicator.disconnect()
+
+
+class FakeSocket:
+    def __init__(self, channel_name, room_id, user_id, heartbeat=True):
+        self.channel_name = channel_name
+        self.room = Room(pk=room_id, name=f"room {room_id}")
+        self.user = User(pk=user_id, username=f"user{user_id}")
+        self.heartbeat = heartbeat
+        self.pings = 0
+        self.reaped = False
+
+    def ping(self):
+        self.pings += 1
+
+    async def reap(self):
+        self.reaped = True
+
+
+@override_settings(CHAT_HEARTBEAT_INTERVAL=25, CHAT_IDLE_TIMEOUT=60, CHAT_PRESENCE_TICK=1)
+class PresenceTest(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.presence = Presence(clock=lambda: self.now)
+
+    def _tick(self, seconds):
+        self.now += seconds
+        async_to_sync(self.presence.tick)()
+
+    def test_online_users_by_room(self):
+        members = [(1, 10, "a1"), (1, 10, "a2"), (1, 20, "b"), (2, 10, "c")]
+        self.assertEqual(
+            [self.presence.add_member(room_id, user_id, f"user{user_id}", channel) for room_id, user_id, channel in members],
+            [True, False, True, True],
+        )
+        self.assertEqual(self.presence.online(1), {10: "user10", 20: "user20"})
+        self.assertEqual(self.presence.online(2), {10: "user10"})
+        self.assertEqual(self.presence.online(3), {})
+        self.assertEqual(self.presence.users, 3)
+
+        # The user stays online in room 1 until their last socket there leaves
+        self.assertFalse(self.presence.remove_member(1, 10, "a1"))
+        self.assertTrue(self.presence.remove_member(1, 10, "a2"))
+        self.assertFalse(self.presence.remove_member(1, 10, "a2"))
+        self.assertEqual(self.presence.online(1), {20: "user20"})
+
+    def test_silent_sockets_are_pinged_then_reaped(self):
+        chatty, silent, legacy = FakeSocket("chatty", 1, 10), FakeSocket("silent", 1, 20), FakeSocket("legacy", 1, 30, False)
+
+        async def register():
+            for socket in (chatty, silent, legacy):
+                self.presence.register(socket)
+
+        async_to_sync(register)()
+        self._tick(20)
+        self.presence.seen("chatty")
+        self._tick(6)
+        self.assertEqual((chatty.pings, silent.pings), (0, 1))
+
+        # An answer to the ping counts like any other frame
+        self._tick(20)
+        self.presence.seen("chatty")
+        self.assertEqual(chatty.pings, 1)
+        self._tick(15)
+        self.assertTrue(silent.reaped)
+        self.assertFalse(chatty.reaped)
+        self.assertEqual(self.presence.local_online(1), {10: "user10", 30: "user30"})
+        self.assertEqual(self.presence.stats, {"pings": 2, "reaped": 1})
+
+        # Sockets that cannot answer pings are never reaped
+        self._tick(600)
+        self.assertFalse(legacy.reaped)
+        self.assertEqual(len(self.presence.wheel), 0)
+
+    def test_online_view(self):
+        presence.clear()
+        room = Room.objects.create(name="Lobby")
+        presence.add_member(room.pk, 10, "alice", "a")
+        try:
+            response = self.client.get(reverse("online", args=[room.slug]))
+        finally:
+            presence.clear()
+        self.assertEqual(response.json(), {"room": "lobby", "count": 1, "users": [{"id": 10, "username": "alice"}]})
+        self.assertEqual(self.client.get(reverse("online", args=["nowhere"])).status_code, 404)
+
+
+@override_settings(CHAT_BOT_REPLY_DELAY=0, CHAT_HEARTBEAT_INTERVAL=0.05, CHAT_IDLE_TIMEOUT=0.3, CHAT_PRESENCE_TICK=0.01)
+class HeartbeatConsumerTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        user_buckets.clear()
+        typing_tracker.clear()
+        presence.clear()
+        self.user = User.objects.create_user(username="demo_user", email="demo@example.com")
+        self.room = Room.objects.create(name="General Chat")
+
+    async def test_pinged_socket_that_answers_stays_and_a_silent_one_is_closed(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/", subprotocols=["chat.v1.json"])
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(presence.online(self.room.pk), {self.user.pk: "demo_user"})
+
+        self.assertEqual(await communicator.receive_json_from(timeout=1), {"v": 1, "type": "ping"})
+        await communicator.send_json_to({"v": 1, "type": "pong"})
+        self.assertEqual(await communicator.receive_json_from(timeout=1), {"v": 1, "type": "ping"})
+        # No answer this time
+        output = await communicator.receive_output(timeout=1)
+        self.assertEqual(output, {"type": "websocket.close", "code": 4008})
+        self.assertEqual(presence.online(self.room.pk), {})
+        await communicator.disconnect()
+
+    async def test_client_ping_gets_a_pong(self):
+        communicator = WebsocketCommunicator(application, "/ws/chat/", subprotocols=["chat.v1.json"])
+        await communicator.connect()
+        await communicator.send_json_to({"v": 1, "type": "ping"})
+        self.assertEqual(await communicator.receive_json_from(), {"v": 1, "type": "pong"})
+        await communicator.disconnect()
+
+
+BROKER_LAYERS = {"default": {"BACKEND": "chat.layers.BrokerChannelLayer"}}
+
+
+class ClusterTest(TestCase):
+    def setUp(self):
+        room_history.clear()
+
+    def test_hash_ring_balances_and_moves_few_keys(self):
+        ring = HashRing(["a", "b", "c"])
+        owners = [ring.node_for(room_id) for room_id in range(3000)]
+        for node in "abc":
+            self.assertAlmostEqual(owners.count(node) / 3000, 1 / 3, delta=0.06)
+        # A fourth node only takes rooms, it never moves them between the others
+        grown = HashRing(["a", "b", "c", "d"])
+        moved = [room_id for room_id in range(3000) if grown.node_for(room_id) != owners[room_id]]
+        self.assertTrue(all(grown.node_for(room_id) == "d" for room_id in moved))
+        self.assertLess(len(moved) / 3000, 0.35)
+
+    async def test_broker_layer_links_nodes(self):
+        server = await Broker().serve("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        a = BrokerChannelLayer(port=port, node="a")
+        b = BrokerChannelLayer(port=port, node="b")
+        try:
+            on_a, on_b, also_on_b = await a.new_channel(), await b.new_channel(), await b.new_channel()
+            for layer, channel in ((a, on_a), (b, on_b), (b, also_on_b)):
+                await layer.group_add("chat.room.1", channel)
+            await asyncio.sleep(0.05)
+
+            await a.group_send("chat.room.1", {"type": "chat.message", "id": 1})
+            for layer, channel in ((a, on_a), (b, on_b), (b, also_on_b)):
+                self.assertEqual(await asyncio.wait_for(layer.receive(channel), 1), {"type": "chat.message", "id": 1})
+
+            # Specific channels are routed to their node
+            await a.send(on_b, {"type": "direct"})
+            self.assertEqual(await asyncio.wait_for(b.receive(on_b), 1), {"type": "direct"})
+
+            # Normal channels reach whichever node receives on them
+            receiving = asyncio.create_task(b.receive("chat.node.b"))
+            await asyncio.sleep(0.05)
+            await a.send("chat.node.b", {"type": "presence.join"})
+            self.assertEqual(await asyncio.wait_for(receiving, 1), {"type": "presence.join"})
+        finally:
+            await a.close()
+            await b.close()
+            # Let the broker see both connections end before the loop goes away
+            await asyncio.sleep(0.05)
+            server.close()
+            await server.wait_closed()
+
+    def test_node_id_must_be_one_of_the_nodes(self):
+        for node_id in (None, "c"):
+            with self.subTest(node_id=node_id), override_settings(CHAT_NODES=["a", "b"], CHAT_NODE_ID=node_id):
+                with self.assertRaises(ImproperlyConfigured):
+                    sharding.node_id()
+        with override_settings(CHAT_NODES=["a", "b"], CHAT_NODE_ID="b"):
+            self.assertEqual(sharding.node_id(), "b")
+
+    @override_settings(CHAT_NODES=["a", "b"], CHAT_NODE_ID="a", CHANNEL_LAYERS=BROKER_LAYERS)
+    def test_only_the_owner_buffers_a_room(self):
+        ring = HashRing(["a", "b"])
+        rooms = [Room.objects.create(name=f"Room {i}") for i in range(8)]
+        owned = next(room for room in rooms if ring.node_for(room.pk) == "a")
+        elsewhere = next(room for room in rooms if ring.node_for(room.pk) == "b")
+
+        # Nothing guarantees this node sees every message until a socket joins or the service watches
+        self.assertIsNone(room_history.get(owned))
+        room_history.watch(owned.pk)
+        self.assertIsNotNone(room_history.get(owned))
+        room_history.unwatch(owned.pk)
+        self.assertEqual(len(room_history), 0)
+
+        # Another node's rooms are read from the database
+        room_history.join(elsewhere)
+        self.assertIsNone(room_history.get(elsewhere))
+        room_history.leave(elsewhere)
+
+    def test_benchcluster_delivers_every_broadcast(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as fh:
+            call_command(
+                "benchcluster", workers="1,2", rooms=4, subscribers=8, messages=20, timeout=10,
+                json_path=fh.name, stdout=io.StringIO(),
+            )
+            results = json.load(fh)["results"]
+        self.assertEqual([run["workers"] for run in results["runs"]], [1, 2])
+        for run in results["runs"]:
+            self.assertEqual(run["lost"], 0)
+            self.assertEqual(sum(run["owned"]), 4)
+        # Each of the 16 sockets sees its room's share of both workers' broadcasts
+        self.assertEqual(results["runs"][1]["delivered"], 16 * (2 * 20 // 4))
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        self.room = Room.objects.create(name="Ops")
+        self.other_room = Room.objects.create(name="Random")
+        self.user = User.objects.create_user(username="alice")
+        self.deploy = Message.objects.create(room=self.room, user=self.user, content="Deploying the API on Friday")
+        self.rollback = Message.objects.create(room=self.room, user=self.user, content="Rolled back the deploy")
+        self.elsewhere = Message.objects.create(room=self.other_room, user=self.user, content="Deploy the blog")
+
+    def _search(self, query, **kwargs):
+        return search.search(query, **kwargs)[0]
+
+    def test_every_word_must_match_and_words_are_stemmed(self):
+        self.assertEqual(self._search("deploys"), [self.elsewhere, self.rollback, self.deploy])
+        self.assertEqual(self._search("DEPLOY friday"), [self.deploy])
+        self.assertEqual(self._search("deploy", room=self.room), [self.rollback, self.deploy])
+        self.assertEqual(self._search("?!"), [])
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.assertEqual(self._search('blog" OR "api'), [])
+        self.assertEqual(self._search("(deploy* api:"), [self.deploy])
+
+    def test_index_follows_writes(self):
+        Message.objects.filter(pk=self.rollback.pk).update(content="Reverted it")
+        self.elsewhere.delete()
+        Message.objects.bulk_create([Message(room=self.room, user=self.user, content="Friday deploy went fine")])
+        self.assertEqual([m.content for m in self._search("deploy")], ["Friday deploy went fine", self.deploy.content])
+        self.assertEqual(self._search("reverted"), [Message.objects.get(pk=self.rollback.pk)])
+
+    def test_pages_by_message_id(self):
+        page, cursor = search.search("deploy", limit=2)
+        self.assertEqual((page, cursor), ([self.elsewhere, self.rollback], self.rollback.pk))
+        self.assertEqual(search.search("deploy", before=cursor, limit=2), ([self.deploy], None))
+
+    @skipUnless(connection.vendor == "sqlite", "Query plan text is backend specific")
+    def test_uses_the_full_text_index(self):
+        self.assertEqual(search.backend(), "fts5")
+        plan = search.matching(Message.objects.all(), "deploy", room=self.room).explain()
+        self.assertIn("chat_message_fts", plan)
+
+    def test_search_view(self):
+        url = reverse("search_messages", args=[self.room.slug])
+        with self.assertNumQueries(2):  # the room, then the page
+            response = self.client.get(url, {"q": "deploy"})
+        body = response.json()
+        self.assertEqual((body["room"], body["query"], body["next"]), ("ops", "deploy", None))
+        self.assertEqual(body["results"][0], {
+            "id": self.rollback.pk,
+            "user": "alice",
+            "content": "Rolled back the deploy",
+            "timestamp": self.rollback.timestamp.isoformat(),
+        })
+        self.assertEqual(len(body["results"]), 2)
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {"q": "deploy", "before": "x"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"q": "deploy", "before": "9" * 20}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("search_messages", args=["nowhere"]), {"q": "a"}).status_code, 404)
+
+    def test_admin_search(self):
+        admin_user = User.objects.create_superuser(username="admin", email="admin@example.com", password="pw")
+        self.client.force_login(admin_user)
+        response = self.client.get(reverse("admin:chat_message_changelist"), {"q": "rolled"})
+        self.assertEqual(list(response.context["cl"].result_list), [self.rollback])
+
+    def test_benchsearch_command(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as fh:
+            call_command("benchsearch", sizes="200", rooms=2, samples=2, json_path=fh.name, stdout=io.StringIO())
+            results = json.load(fh)["results"]
+        self.assertEqual(results["runs"][0]["messages"], 200)
+        self.assertIn("speedup", results["runs"][0]["rare"]["admin"])
+        self.assertFalse(Message.objects.filter(room__name__startswith="bench-").exists())
+
+
+class MessageAdminTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        self.room = Room.objects.create(name="Ops")
+        self.other_room = Room.objects.create(name="Random")
+        self.user = User.objects.create_user(username="alice")
+        self.messages = Message.objects.bulk_create([
+            Message(room=self.room if i % 2 else self.other_room, user=self.user,
+                    content=f"Message {i} " + "x" * 100)
+            for i in range(7)
+        ])
+        Room.objects.record_messages(self.messages)
+        admin_user = User.objects.create_superuser(username="admin", email="admin@example.com", password="pw")
+        self.client.force_login(admin_user)
+        self.url = reverse("admin:chat_message_changelist")
+
+    def _changelist(self, params=None, per_page=3):
+        with mock.patch("chat.admin.MessageAdmin.list_per_page", per_page):
+            response = self.client.get(self.url + (params or ""))
+        self.assertEqual(response.status_code, 200)
+        return response.context["cl"]
+
+    def _ids(self, cl):
+        return [message.pk for message in cl.result_list]
+
+    def test_pages_by_cursor_newest_first(self):
+        newest_first = [message.pk for message in reversed(self.messages)]
+        cl = self._changelist()
+        self.assertEqual(cl.keyset, "timestamp")
+        self.assertEqual(self._ids(cl), newest_first[:3])
+        self.assertIsNone(cl.newest_url)
+        cl = self._changelist(cl.older_url)
+        self.assertEqual(self._ids(cl), newest_first[3:6])
+        self.assertEqual(cl.newest_url, "?")
+        cl = self._changelist(cl.older_url)
+        self.assertEqual(self._ids(cl), newest_first[6:])
+        self.assertIsNone(cl.older_url)
+        for cursor in ("garbage", "99999999999999999999-1"):
+            response = self.client.get(self.url, {"cursor": cursor})
+            self.assertRedirects(response, self.url + "?e=1", fetch_redirect_response=False)
+
+    def test_changelist_queries_are_bounded(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._changelist(per_page=50)
+        page = next(q["sql"] for q in queries if 'FROM "chat_message"' in q["sql"] and "LIMIT" in q["sql"])
+        # One page query with its rooms and users joined, and the preview cut in SQL
+        self.assertIn('"chat_room"', page)
+        self.assertIn("SUBSTR", page.upper())
+        self.assertEqual(page.count('"chat_message"."content"'), 1)
+        self.assertFalse([q for q in queries if "COUNT(" in q["sql"].upper() and "chat_message" in q["sql"]])
+        self.assertEqual(len([q for q in queries if "chat_message" in q["sql"]]), 2)  # the page and the estimate
+
+    def test_preview_and_estimated_count(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, "Message 6 " + "x" * 37 + "...")
+        self.assertContains(response, "About 7 Messages")
+        self.assertEqual(response.context["cl"].result_count, 7)
+
+    def test_room_filter_counts_exactly_and_keeps_the_keyset(self):
+        cl = self._changelist(f"?room__id__exact={self.room.pk}", per_page=2)
+        self.assertEqual(self._ids(cl), [self.messages[5].pk, self.messages[3].pk])
+        self.assertEqual((cl.result_count, cl.count_estimated), (3, False))
+        self.assertIn(f"room__id__exact={self.room.pk}", cl.older_url)
+        cl = self._changelist(cl.older_url, per_page=2)
+        self.assertEqual(self._ids(cl), [self.messages[1].pk])
+        for room_id in ("abc", "9" * 20):
+            response = self.client.get(self.url, {"room__id__exact": room_id})
+            self.assertRedirects(response, self.url + "?e=1", fetch_redirect_response=False)
+
+    def test_search_pages_by_id(self):
+        cl = self._changelist("?q=message", per_page=4)
+        self.assertEqual(cl.keyset, "id")
+        self.assertEqual(cl.older_url, f"?cursor={self.messages[3].pk}&q=message")
+        cl = self._changelist(cl.older_url, per_page=4)
+        self.assertEqual(self._ids(cl), [message.pk for message in reversed(self.messages[:3])])
+        response = self.client.get(self.url, {"q": "message", "cursor": "9" * 20})
+        self.assertRedirects(response, self.url + "?e=1", fetch_redirect_response=False)
+
+    def test_other_orderings_use_numbered_pages(self):
+        cl = self._changelist("?o=1&p=2")
+        self.assertIsNone(cl.keyset)
+        self.assertEqual(self._ids(cl), [message.pk for message in self.messages[3:6]])
+        self.assertTrue(cl.multi_page)
+
+    def test_room_activity_filter(self):
+        quiet = Room.objects.create(name="Quiet")
+        Room.objects.filter(pk=self.other_room.pk).update(last_message_at=timezone.now() - timedelta(days=3))
+        url = reverse("admin:chat_room_changelist")
+
+        def rooms(active):
+            return {room.name for room in self.client.get(url, {"active": active}).context["cl"].result_list}
+
+        self.assertEqual(rooms("day"), {"Ops"})
+        self.assertEqual(rooms("week"), {"Ops", "Random"})
+        self.assertEqual(rooms("never"), {quiet.name})
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        archive.archive_index.clear()
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.archive_dir.cleanup)
+        settings_override = override_settings(CHAT_ARCHIVE_DIR=self.archive_dir.name, CHAT_RETENTION_DAYS=None)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.room = Room.objects.create(name="Ops", retention_days=30)
+        self.other_room = Room.objects.create(name="Random")
+        self.user = User.objects.create_user(username="alice")
+        now = timezone.now()
+        # Two messages a month for four months, oldest first, then two recent ones
+        self.old = []
+        for age in (130, 125, 100, 95, 70, 65, 40, 35):
+            message = Message.objects.create(room=self.room, user=self.user, content=f"{age} days ago")
+            Message.objects.filter(pk=message.pk).update(timestamp=now - timedelta(days=age))
+            self.old.append(Message.objects.get(pk=message.pk))
+        self.recent = [Message.objects.create(room=self.room, user=self.user, content=f"Recent {i}") for i in range(2)]
+        self.elsewhere = Message.objects.create(room=self.other_room, user=self.user, content="Elsewhere")
+        Message.objects.filter(pk=self.elsewhere.pk).update(timestamp=now - timedelta(days=400))
+        Room.objects.rebuild_activity()
+        self.cutoff = now - timedelta(days=30)
+
+    def test_moves_old_messages_to_monthly_files(self):
+        self.assertEqual(archive.archive_room(self.room, self.cutoff, batch_size=3), 8)
+        self.assertEqual(list(Message.objects.filter(room=self.room)), self.recent[::-1])
+        room = Room.objects.get(pk=self.room.pk)
+        self.assertEqual((room.message_count, room.last_message_id), (2, self.recent[1].pk))
+        files = sorted(path.name for path in (archive.archive_dir() / str(self.room.pk)).iterdir())
+        months = {archive._month_name(archive._month(message.timestamp)) for message in self.old}
+        self.assertEqual(files, sorted(f"{month}{suffix}" for month in months for suffix in (".index.jsonl", ".jsonl.gz")))
+        self.assertEqual(search.search("days"), ([], None))
+        # Nothing left to archive; a second run appends nothing
+        self.assertEqual(archive.archive_room(self.room, self.cutoff), 0)
+
+    def test_archiving_every_message_empties_the_room(self):
+        archive.archive_room(self.room, timezone.now() + timedelta(seconds=1), batch_size=4)
+        room = Room.objects.get(pk=self.room.pk)
+        self.assertEqual((room.message_count, room.last_message_at, room.last_message_id), (0, None, None))
+        self.assertEqual(Room.objects.stale_activity().count(), 0)
+
+    def test_archived_pages_match_the_live_ones(self):
+        expected = [page_before(Message.objects.filter(room=self.room), cursor, limit=3)
+                    for cursor in (None, encode_cursor(self.old[6]), encode_cursor(self.old[3]))]
+        archive.archive_room(self.room, self.cutoff)
+        cursors = (None, encode_cursor(self.old[6]), encode_cursor(self.old[3]))
+        for cursor, (messages, next_cursor) in zip(cursors, expected):
+            live = page_before(Message.objects.filter(room=self.room), cursor, limit=3)
+            page = archive.extend_page(live, self.room.pk, cursor=cursor, limit=3)
+            self.assertEqual([(m.pk, m.content, m.user.username) for m in page[0]],
+                             [(m.pk, m.content, m.user.username) for m in messages])
+            self.assertEqual(page[1], next_cursor)
+
+    def test_history_view_reads_through_to_the_archive(self):
+        archive.archive_room(self.room, self.cutoff)
+        archive.archive_room(self.other_room, self.cutoff)
+        url = reverse("older_messages")
+        response = self.client.get(url, {"room": self.room.slug, "before": encode_cursor(self.recent[0])})
+        self.assertEqual([m.pk for m in response.context["messages"]], [m.pk for m in self.old])
+        self.assertContains(response, "35 days ago")
+        self.assertIsNone(response.context["next_cursor"])
+        # Across rooms, the other room's archive is merged in
+        response = self.client.get(url, {"before": encode_cursor(self.old[0])})
+        self.assertEqual([m.pk for m in response.context["messages"]], [self.elsewhere.pk])
+
+    def test_a_batch_archived_twice_is_read_once(self):
+        messages = self.old[:2]
+        month = archive._month_name(archive._month(messages[0].timestamp))
+        path = archive.archive_dir() / str(self.room.pk) / f"{month}.jsonl.gz"
+        archive._append(path, [archive.message_row(m) for m in messages])
+        archive._append(path, [archive.message_row(m) for m in messages])
+        self.assertEqual([m.pk for m in archive.page_before(self.room.pk)[0]], [m.pk for m in messages])
+
+    def test_pages_only_read_the_members_they_need(self):
+        archive.archive_room(self.room, self.cutoff, batch_size=1)
+        with mock.patch.object(archive, "_read", wraps=archive._read) as read:
+            messages, next_cursor = archive.page_before(self.room.pk, limit=1)
+        self.assertEqual(messages, [self.old[-1]])
+        self.assertEqual(next_cursor, encode_cursor(self.old[-1]))
+        # Of eight one-message members: the page's, and the next to tell whether there is more
+        self.assertEqual(read.call_count, 2)
+
+    def test_the_directory_listing_is_cached_until_the_next_archive_run(self):
+        archive.archive_room(self.room, self.cutoff)
+        with mock.patch.object(archive, "_list", wraps=archive._list) as listing:
+            for _ in range(3):
+                archive.page_before(cursor=encode_cursor(self.recent[0]))
+            self.assertEqual(listing.call_count, 1)
+            archive.archive_room(self.other_room, self.cutoff)
+            messages, _ = archive.page_before(cursor=encode_cursor(self.old[0]))
+            self.assertEqual(listing.call_count, 2)
+        self.assertEqual(messages, [self.elsewhere])
+
+    def test_archiving_tells_the_servers_to_drop_the_rooms_history(self):
+        with mock.patch.object(cluster, "discard_history", new_callable=mock.AsyncMock) as discard:
+            archive.archive_room(self.room, self.cutoff)
+        discard.assert_awaited_once_with([self.room.pk])
+
+    def test_archivemessages_command(self):
+        out = io.StringIO()
+        call_command("archivemessages", dry_run=True, stdout=out)
+        self.assertIn("8 message(s) to archive.", out.getvalue())
+        self.assertEqual(Message.objects.count(), 11)
+        # Rooms without retention keep their messages unless a default is set
+        with override_settings(CHAT_RETENTION_DAYS=365):
+            call_command("archivemessages", stdout=io.StringIO())
+        self.assertEqual(Message.objects.count(), 2)
+        self.assertEqual(Room.objects.get(pk=self.other_room.pk).message_count, 0)
+        call_command("archivemessages", self.room.slug, older_than=0, stdout=io.StringIO())
+        self.assertEqual(Message.objects.count(), 0)
+
+
+class TransferCommandTest(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="Ops", description="Operations", retention_days=90)
+        self.other_room = Room.objects.create(name="Random")
+        self.alice = User.objects.create_user(username="alice")
+        self.bob = User.objects.create_user(username="bob")
+        self.messages = [
+            Message.objects.create(room=room, user=user, content=f"Message {i} ✓")
+            for i, (room, user) in enumerate([(self.room, self.alice), (self.other_room, self.bob), (self.room, self.bob)])
+        ]
+        Message.objects.filter(pk=self.messages[0].pk).update(timestamp=timezone.now() - timedelta(days=3))
+        Message.objects.filter(pk=self.messages[1].pk).mark_read()
+        self.expected = self._snapshot()
+        self.dump = tempfile.NamedTemporaryFile(suffix=".jsonl.gz")
+        self.addCleanup(self.dump.close)
+
+    def _snapshot(self):
+        return list(Message.objects.order_by("timestamp", "pk").values_list(
+            "room__slug", "user__username", "content", "timestamp", "read_at"
+        ))
+
+    def _export(self, *slugs):
+        call_command("exportmessages", *slugs, output=self.dump.name, chunk_size=2, stdout=io.StringIO())
+
+    def _import(self, **options):
+        out = io.StringIO()
+        call_command("importmessages", self.dump.name, stdout=out, **options)
+        return out.getvalue()
+
+    def test_round_trip_into_an_empty_database(self):
+        self._export()
+        Room.objects.all().delete()
+        User.objects.all().delete()
+        with self.assertNumQueries(11):  # two rooms, the users, then one transaction for the messages and room counters
+            output = self._import(batch_size=10)
+        self.assertIn("Imported 3 message(s), created 2 room(s) and 2 user(s).", output)
+        self.assertEqual(self._snapshot(), self.expected)
+        room = Room.objects.get(slug="ops")
+        self.assertEqual((room.description, room.retention_days, room.message_count), ("Operations", 90, 2))
+        self.assertEqual(Room.objects.stale_activity().count(), 0)
+        self.assertFalse(User.objects.get(username="alice").has_usable_password())
+        self.assertEqual(len(search.search("message")[0]), 3)
+
+    def test_import_matches_existing_rooms_and_users(self):
+        self._export(self.room.slug)
+        self.assertIn("Imported 2 message(s), created 0 room(s) and 0 user(s).", self._import(batch_size=1))
+        self.assertEqual(Message.objects.filter(room=self.room, user=self.alice).count(), 2)
+        self.assertEqual(Room.objects.get(pk=self.room.pk).message_count, 4)
+
+    def test_keep_ids_skips_messages_already_present(self):
+        self._export()
+        deleted = self.messages[2].pk
+        self.messages[2].delete()
+        room_history.clear()
+        room_history.get(self.room)
+        self.assertIn("Imported 1 message(s)", self._import(keep_ids=True))
+        self.assertEqual(self._snapshot(), self.expected)
+        # The buffer no longer holds every message of the room
+        self.assertEqual(len(room_history), 0)
+        self.assertTrue(Message.objects.filter(pk=deleted).exists())
+        self.assertEqual(Room.objects.stale_activity().count(), 0)
+
+    def test_export_leaves_out_rooms_created_while_it_runs(self):
+        rows = transfer.export_rows()
+        rooms = [next(rows), next(rows)]
+        late = Room.objects.create(name="Late")
+        Message.objects.create(room=late, user=self.alice, content="Too late")
+        messages = [row for row in rows if row["type"] == "message"]
+        self.assertEqual(len(messages), 3)
+        self.assertEqual({row["room"] for row in messages}, {row["id"] for row in rooms})
+
+    def test_rejects_malformed_lines(self):
+        with gzip.open(self.dump.name, "wt") as fh:
+            fh.write(json.dumps({"type": "message", "id": 1, "room": 99}) + "\n")
+        with self.assertRaisesMessage(CommandError, "Line 1:"):
+            self._import()
+        self._export()
+        with gzip.open(self.dump.name, "rt") as fh:
+            lines = fh.readlines()
+        row = json.loads(lines[3])
+        row["timestamp"] = "yesterday"
+        lines[3] = json.dumps(row) + "\n"
+        with gzip.open(self.dump.name, "wt") as fh:
+            fh.writelines(lines)
+        with self.assertRaisesMessage(CommandError, "Line 4: ValueError(\"timestamp 'yesterday' is not a date"):
+            self._import(batch_size=1)
+        with self.assertRaisesMessage(CommandError, "No such room(s): nowhere"):
+            self._export("nowhere")
+
+
+class LoadTestCommandTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        User.objects.create_user(username="demo_user", email="demo@example.com")
+
+    def test_reports_latency_throughput_and_queries(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as fh:
+            call_command(
+                "loadtest", connections=3, rate=10, duration=0.3, drain_timeout=0.3,
+                json_path=fh.name, stdout=io.StringIO(),
+            )
+            results = json.load(fh)["results"]
+        self.assertEqual(results["connections"], 3)
+        self.assertGreater(results["sent"], 0)
+        self.assertEqual(results["lost"], 0)
+        self.assertEqual(results["latency"]["count"], results["sent"])
+        self.assertGreater(results["db_queries"], 0)
+        self.assertEqual(Message.objects.count(), 0)  # rolled back
+
+    def test_rejects_a_zero_rate_or_no_connections(self):
+        with self.assertRaisesMessage(CommandError, "--rate must be greater than 0."):
+            call_command("loadtest", rate=0, stdout=io.StringIO())
+        with self.assertRaisesMessage(CommandError, "--connections must be at least 1."):
+            call_command("loadtest", connections=0, stdout=io.StringIO())
+
+
+class BenchWritesCommandTest(TestCase):
+    def test_reports_buffered_throughput_and_cleans_up(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as fh:
+            call_command(
+                "benchwrites", consumers=3, messages=2, mode="buffered", json_path=fh.name, stdout=io.StringIO(),
+            )
+            results = json.load(fh)["results"]
+        self.assertEqual(results["profile"]["vendor"], connection.vendor)
+        self.assertEqual((results["buffered"]["messages"], results["buffered"]["errors"]), (6, 0))
+        self.assertGreater(results["buffered"]["messages_per_s"], 0)
+        self.assertNotIn("direct", results)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        room_cache.clear()
+        room_history.clear()
+        metrics.registry.clear()
+        User.objects.create_user(username="demo_user", email="demo@example.com")
+
+    def test_histogram_exposition(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", ["op"], buckets=(0.1, 1))
+        histogram.observe(0.05, op="a")
+        histogram.observe(0.5, op="a")
+        rendered = histogram.render()
+        self.assertIn('test_seconds_bucket{op="a",le="0.1"} 1', rendered)
+        self.assertIn('test_seconds_bucket{op="a",le="+Inf"} 2', rendered)
+        self.assertIn('test_seconds_count{op="a"} 2', rendered)
+
+    def test_label_cardinality_is_capped(self):
+        counter = metrics.Counter("test_total", "Test.", ["room"], max_series=2)
+        for room in ("a", "b", "c", "d"):
+            counter.inc(room=room)
+        rendered = counter.render()
+        self.assertIn('test_total{room="other"} 2', rendered)
+        self.assertEqual(rendered.count("test_total{"), 3)
+
+    @override_settings(CHAT_METRICS_ENABLED=False)
+    def test_instrument_is_a_no_op_when_disabled(self):
+        async def handler():
+            pass
+
+        self.assertIs(metrics.instrument(metrics.consumer_seconds)(handler), handler)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+    @override_settings(CHAT_METRICS_TOKEN="s3cret", CHAT_METRICS_ALLOWED_IPS=["10.0.0.5"])
+    def test_scrapes_need_staff_the_token_or_an_allowed_address(self):
+        url = reverse("metrics")
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer wrong"}).status_code, 403)
+        self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer s3cret"}).status_code, 200)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR="10.0.0.5").status_code, 200)
+        self.client.force_login(User.objects.create_user(username="ops", is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    @override_settings(CHAT_BOT_REPLY_DELAY=0, CHAT_METRICS_TOKEN="s3cret")
+    async def test_consumer_lifecycle_is_exposed(self):
+        @sync_to_async
+        def scrape():
+            return self.client.get(reverse("metrics"), headers={"Authorization": "Bearer s3cret"}).content.decode()
+
+        communicator = WebsocketCommunicator(application, "/ws/chat/")
+        await communicator.connect()
+        await communicator.send_json_to({"message": "Hi"})
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        body = await scrape()
+        self.assertIn('chat_connections_total{room="general-chat"} 1', body)
+        self.assertIn('chat_active_sockets{room="general-chat"} 1', body)
+        self.assertIn('chat_messages_received_total{room="general-chat"} 1', body)
+        self.assertIn('chat_db_seconds_count{operation="save_message"} 2', body)
+        self.assertIn("chat_send_queue_depth", body)
+
+        await communicator.disconnect()
+        body = await scrape()
+        self.assertIn('chat_disconnections_total{room="general-chat"} 1', body)
+        self.assertIn('chat_active_sockets{room="general-chat"} 0', body)
@@ -0,0 +1,182 @@
+"""Rate limiting and outbound flow control for chat sockets."""
+
+import asyncio
+import logging
+import time
+import weakref
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+from .constants import (
+    CONNECTION_RATE_LIMIT,
+    USER_RATE_LIMIT,
+    USER_BUCKETS_MAX,
+    SEND_QUEUE_SIZE,
+    SEND_QUEUE_POLICY,
+)
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Process-wide counters, e.g. {"throttled": 12, "dropped": 3, "coalesced": 40}
+counters = Counter()
+
+# Open send queues, for the queue depth gauge
+open_queues = weakref.WeakSet()
+
+metrics.registry.register(metrics.Counter(
+    "chat_frames_total", "Frames throttled, dropped or coalesced by flow control.", ["outcome"],
+    function=lambda: {(outcome,): count for outcome, count in counters.items()},
+))
+metrics.registry.register(metrics.Gauge(
+    "chat_send_queue_depth", "Frames waiting in send queues across all sockets.",
+    function=lambda: sum(len(queue) for queue in open_queues),
+))
+metrics.registry.register(metrics.Gauge(
+    "chat_send_queue_max_depth", "Deepest send queue of any socket.",
+    function=lambda: max((len(queue) for queue in open_queues), default=0),
+))
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second with bursts of up to ``burst`` events."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, tokens=1):
+        """Take ``tokens`` from the bucket and return whether there were enough."""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    def retry_after(self, tokens=1):
+        """Seconds until ``tokens`` will be available."""
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class UserBuckets:
+    """Token buckets shared by every connection of the same user in this process."""
+
+    def __init__(self, max_users=None):
+        self._max_users = max_users
+        self._buckets = OrderedDict()
+
+    def get(self, user_id):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            rate, burst = getattr(settings, "CHAT_USER_RATE_LIMIT", USER_RATE_LIMIT)
+            bucket = self._buckets[user_id] = TokenBucket(rate, burst)
+            self._prune()
+        self._buckets.move_to_end(user_id)
+        return bucket
+
+    def _prune(self):
+        max_users = self._max_users or getattr(settings, "CHAT_USER_BUCKETS_MAX", USER_BUCKETS_MAX)
+        if len(self._buckets) <= max_users:
+            return
+        # Refilled buckets carry no state worth keeping
+        for user_id, bucket in list(self._buckets.items()):
+            if bucket.idle:
+                del self._buckets[user_id]
+        while len(self._buckets) > max_users:
+            self._buckets.popitem(last=False)
+
+    def clear(self):
+        self._buckets.clear()
+
+
+user_buckets = UserBuckets()
+
+
+def connection_bucket():
+    rate, burst = getattr(settings, "CHAT_CONNECTION_RATE_LIMIT", CONNECTION_RATE_LIMIT)
+    return TokenBucket(rate, burst)
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written to one socket.
+    When it is full, the ``"drop"`` policy discards the oldest frame; the
+    ``"coalesce"`` policy first tries to replace a pending frame sharing the
+    new frame's key (e.g. successive typing states of the same user) and
+    drops the oldest frame only when there is none. If a write fails the
+    queue closes: pending frames are discarded and later ones ignored.
+    """
+
+    def __init__(self, send, maxsize=None, policy=None):
+        self._send = send
+        self.maxsize = maxsize or getattr(settings, "CHAT_SEND_QUEUE_SIZE", SEND_QUEUE_SIZE)
+        self.policy = policy or getattr(settings, "CHAT_SEND_QUEUE_POLICY", SEND_QUEUE_POLICY)
+        self._frames = OrderedDict()
+        self._sequence = 0
+        self._ready = asyncio.Event()
+        self._empty = asyncio.Event()
+        self._empty.set()
+        self.closed = False
+        self._writer = asyncio.create_task(self._write())
+        open_queues.add(self)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, key=None):
+        """Queue ``frame``; frames sharing a non-None ``key`` may be coalesced."""
+        if self.closed:
+            return
+        if self.policy != "coalesce":
+            key = None
+        elif key in self._frames:
+            self._frames[key] = frame
+            counters["coalesced"] += 1
+            return
+        if len(self._frames) >= self.maxsize:
+            self._frames.popitem(last=False)
+            counters["dropped"] += 1
+        if key is None:
+            self._sequence += 1
+            key = ("frame", self._sequence)
+        self._frames[key] = frame
+        self._empty.clear()
+        self._ready.set()
+
+    async def _write(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._frames:
+                    _, frame = self._frames.popitem(last=False)
+                    await self._send(frame)
+                self._ready.clear()
+                self._empty.set()
+        except Exception:
+            # The socket is unusable; release join() rather than leave it waiting forever
+            logger.exception("Send queue closed after a failed write")
+            self.closed = True
+            self._frames.clear()
+            self._empty.set()
+
+    async def join(self):
+        """Wait until every queued frame has been written."""
+        await self._empty.wait()
+
+    async def close(self):
+        self._writer.cancel()
+        await asyncio.gather(self._writer, return_exceptions=True)
@@ -0,0 +1,61 @@
+"""Timer wheel for the many short-lived deadlines of per-user socket state."""
+
+import math
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: deadlines are rounded up to ``resolution`` seconds
+    and kept in ``slots`` buckets, so scheduling, rescheduling and expiring
+    are O(1) per key and a single ticker serves every key instead of one
+    sleeping task each. Deadlines further away than a full turn of the wheel
+    stay in their bucket until the turn they are due in.
+    """
+
+    def __init__(self, resolution, now, slots=64):
+        self.resolution = resolution
+        self._slots = [set() for _ in range(slots)]
+        # Tick each key is due at; entries left behind in other buckets by a
+        # reschedule or cancel are dropped when their bucket comes round
+        self._due = {}
+        self._tick = math.floor(now / resolution)
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def schedule(self, key, deadline):
+        """Fire ``key`` at ``deadline``, replacing any deadline it had."""
+        tick = max(math.ceil(deadline / self.resolution), self._tick + 1)
+        self._due[key] = tick
+        self._slots[tick % len(self._slots)].add(key)
+
+    def cancel(self, key):
+        self._due.pop(key, None)
+
+    def advance(self, now):
+        """Move the wheel to ``now`` and return the keys that fell due, oldest tick first."""
+        target = math.floor(now / self.resolution)
+        slot_count = len(self._slots)
+        fired = []
+        # After a long stall every bucket is visited once
+        for tick in range(max(self._tick + 1, target - slot_count + 1), target + 1):
+            index = tick % slot_count
+            bucket = self._slots[index]
+            for key in list(bucket):
+                due = self._due.get(key)
+                if due is None or due % slot_count != index:
+                    bucket.discard(key)
+                elif due <= target:
+                    bucket.discard(key)
+                    del self._due[key]
+                    fired.append(key)
+        self._tick = max(self._tick, target)
+        return fired
+
+    def clear(self):
+        for bucket in self._slots:
+            bucket.clear()
+        self._due.clear()
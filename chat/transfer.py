@@ -0,0 +1,232 @@
+"""
+Streaming export and import of rooms and messages as JSON Lines.
+
+An export holds one ``{"type": "room", ...}`` line per room, then one
+``{"type": "message", ...}`` line per message in id order. Messages are
+read ``TRANSFER_CHUNK_SIZE`` rows at a time as plain tuples, and imported
+``IMPORT_BATCH_SIZE`` rows per ``bulk_create``, so memory stays flat
+whatever the size of the dump. Rooms are matched by slug or name and
+users by username; users that do not exist yet are created without a usable
+password.
+"""
+
+import gzip
+import json
+import sys
+from contextlib import contextmanager
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .cluster import cluster
+from .constants import IMPORT_BATCH_SIZE, TRANSFER_CHUNK_SIZE
+from .models import Message, Room
+
+ROOM_FIELDS = ("id", "name", "slug", "description", "retention_days")
+
+
+class TransferError(Exception):
+    """Raised for a line that cannot be imported."""
+
+
+@contextmanager
+def open_dump(path, mode):
+    """Open ``path`` for text I/O, gzipped when it ends in ``.gz``; ``-`` is stdin or stdout."""
+    if path == "-":
+        yield sys.stdout if "w" in mode else sys.stdin
+        return
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, f"{mode}t", encoding="utf-8") as fh:
+        yield fh
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def export_rows(rooms=None, chunk_size=None):
+    """Yield the export lines of ``rooms`` (default: every room) and their messages, as dicts."""
+    chunk_size = chunk_size or TRANSFER_CHUNK_SIZE
+    messages = Message.objects.all()
+    if rooms is None:
+        rooms = Room.objects.all()
+    else:
+        messages = messages.filter(room__in=rooms.values("pk"))
+    last_room = None
+    for values in rooms.order_by("pk").values_list(*ROOM_FIELDS):
+        last_room = values[0]
+        yield {"type": "room", **dict(zip(ROOM_FIELDS, values))}
+    if last_room is None:
+        return
+    # Rooms created since the first query are not in the dump, so neither are their messages
+    messages = messages.filter(room_id__lte=last_room).order_by("pk").values_list(
+        "id", "room_id", "user_id", "user__username", "content", "timestamp", "read_at"
+    )
+    for pk, room_id, user_id, username, content, timestamp, read_at in messages.iterator(chunk_size=chunk_size):
+        yield {
+            "type": "message",
+            "id": pk,
+            "room": room_id,
+            "user": user_id,
+            "username": username,
+            "content": content,
+            "timestamp": timestamp.isoformat(),
+            "read_at": _isoformat(read_at),
+        }
+
+
+def _datetime(value, field):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"{field} {value!r} is not a date and time")
+    return parsed
+
+
+def export_messages(fh, rooms=None, chunk_size=None):
+    """Write the export of ``rooms`` to ``fh``; returns ``(rooms, messages)`` written."""
+    counts = {"room": 0, "message": 0}
+    for row in export_rows(rooms, chunk_size):
+        fh.write(json.dumps(row, ensure_ascii=False) + "\n")
+        counts[row["type"]] += 1
+    return counts["room"], counts["message"]
+
+
+@contextmanager
+def original_timestamps():
+    """
+    Let ``bulk_create`` keep the messages' timestamps instead of stamping
+    them with the current time. This changes the field for the whole
+    process, so it is only meant for the import command.
+    """
+    field = Message._meta.get_field("timestamp")
+    field.auto_now_add = False
+    try:
+        yield
+    finally:
+        field.auto_now_add = True
+
+
+class Importer:
+    """
+    Imports export lines in batches. Rooms and users are looked up once
+    and cached by their id in the dump, so a batch costs one query for
+    its unknown users and one ``bulk_create``.
+    """
+
+    def __init__(self, batch_size=None, keep_ids=False, using=None):
+        self.batch_size = batch_size or IMPORT_BATCH_SIZE
+        self.keep_ids = keep_ids
+        self.using = using or router.db_for_write(Message)
+        self.rooms = {}
+        self.users = {}
+        self.touched = set()
+        self.counts = {"rooms": 0, "users": 0, "messages": 0}
+        self._batch = []
+
+    def run(self, lines):
+        """Import every line of ``lines``; returns the counts of rooms, users and messages created."""
+        try:
+            with original_timestamps():
+                for number, line in enumerate(lines, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        self.add(json.loads(line))
+                    except (KeyError, TypeError, ValueError) as exc:
+                        raise TransferError(f"Line {number}: {exc!r}") from exc
+                self.flush()
+        finally:
+            # Batches written before a bad line stay, so their rooms are settled either way
+            self.finish()
+        return self.counts
+
+    def add(self, row):
+        if row["type"] == "room":
+            self.add_room(row)
+        elif row["type"] == "message":
+            if row["room"] not in self.rooms:
+                raise ValueError(f"message {row['id']} is in room {row['room']}, which has no room line before it")
+            # Parsed here so a bad value is reported with its line, not as a failed batch
+            row["timestamp"] = _datetime(row["timestamp"], "timestamp")
+            row["read_at"] = _datetime(row["read_at"], "read_at") if row["read_at"] else None
+            self._batch.append(row)
+            if len(self._batch) >= self.batch_size:
+                self.flush()
+        else:
+            raise ValueError(f"unknown type {row['type']!r}")
+
+    def add_room(self, row):
+        room = Room.objects.using(self.using).filter(Q(slug=row["slug"]) | Q(name=row["name"])).first()
+        if room is None:
+            room = Room(**{field: row[field] for field in ROOM_FIELDS if field != "id"})
+            # Neither the slug nor the name is taken, so keep the slug rather than derive a new one
+            room._original_name = room.name
+            room.save(using=self.using)
+            self.counts["rooms"] += 1
+        self.rooms[row["id"]] = room.pk
+
+    def _resolve_users(self, rows):
+        wanted = {row["user"]: row["username"] for row in rows if row["user"] not in self.users}
+        if not wanted:
+            return
+        existing = dict(
+            User.objects.using(self.using).filter(username__in=wanted.values()).values_list("username", "pk")
+        )
+        missing = [
+            User(username=username, password=make_password(None))
+            for username in set(wanted.values()) - existing.keys()
+        ]
+        for user in User.objects.using(self.using).bulk_create(missing):
+            existing[user.username] = user.pk
+        self.counts["users"] += len(missing)
+        for user_id, username in wanted.items():
+            self.users[user_id] = existing[username]
+
+    def flush(self):
+        rows, self._batch = self._batch, []
+        if not rows:
+            return
+        self._resolve_users(rows)
+        messages = [
+            Message(
+                pk=row["id"] if self.keep_ids else None,
+                room_id=self.rooms[row["room"]],
+                user_id=self.users[row["user"]],
+                content=row["content"],
+                timestamp=row["timestamp"],
+                read_at=row["read_at"],
+            )
+            for row in rows
+        ]
+        with transaction.atomic(using=self.using):
+            if self.keep_ids:
+                # Rows already present are skipped and not counted; the rooms are recounted at the end
+                present = set(
+                    Message.objects.using(self.using)
+                    .filter(pk__in=[message.pk for message in messages]).values_list("pk", flat=True)
+                )
+                messages = [message for message in messages if message.pk not in present]
+                Message.objects.using(self.using).bulk_create(messages, ignore_conflicts=True)
+            else:
+                Message.objects.using(self.using).bulk_create(messages)
+                Room.objects.using(self.using).record_messages(messages)
+        self.touched.update(message.room_id for message in messages)
+        self.counts["messages"] += len(messages)
+
+    def finish(self):
+        if self.keep_ids:
+            Room.objects.using(self.using).filter(pk__in=self.touched).rebuild_activity()
+            connection = connections[self.using]
+            # Explicit ids leave PostgreSQL's sequence behind, as loaddata does
+            statements = connection.ops.sequence_reset_sql(no_style(), [Message])
+            if statements:
+                with connection.cursor() as cursor:
+                    for statement in statements:
+                        cursor.execute(statement)
+        # Imported messages keep their timestamps, so they can land anywhere in a buffered history
+        async_to_sync(cluster.discard_history)(sorted(self.touched))
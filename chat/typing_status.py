@@ -0,0 +1,193 @@
+"""
+Server-side typing indicators, coalesced per user per room.
+
+Clients may send a ``typing`` frame on every keystroke. The tracker keeps
+one state per user and room and broadcasts only its changes, at most one
+every ``CHAT_TYPING_INTERVAL`` seconds; changes in between are folded
+into the next broadcast, so a burst of start/stop toggles costs nothing.
+A user who stops sending typing frames is marked idle after
+``CHAT_TYPING_TIMEOUT`` seconds. Deadlines live on one ``TimerWheel``
+served by a single ticker task, and nothing here touches the database.
+"""
+
+import asyncio
+import time
+from collections import Counter
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.template.loader import get_template
+
+from .constants import TYPING_INTERVAL, TYPING_TICK, TYPING_TIMEOUT
+from .frames import TYPED_FORMATS, encode
+from .timers import TimerWheel
+from . import metrics
+
+
+class TypingState:
+    __slots__ = ("channel", "active", "expires_at", "sent", "sent_at")
+
+    def __init__(self, channel):
+        # The socket that last reported the state, and that it is relayed as
+        self.channel = channel
+        self.active = False
+        self.expires_at = 0.0
+        # Last state broadcast to the room, and when
+        self.sent = False
+        self.sent_at = float("-inf")
+
+
+def typing_frames(user_id, active):
+    """The typing frame of ``user_id`` in every format that carries one."""
+    payload = {"type": "typing", "user": user_id, "active": active}
+    frames = {frame_format: encode(payload, frame_format) for frame_format in TYPED_FORMATS}
+    # The htmx page swaps its indicator out of band
+    frames["html"] = get_template("chat/partials/typing_oob.html").render({"active": active})
+    return frames
+
+
+class TypingTracker:
+    """Typing states of the users of this process's sockets, keyed by ``(room group, user id)``."""
+
+    def __init__(self, send=None, clock=time.monotonic):
+        self._send = send
+        self._clock = clock
+        self._states = {}
+        self._wheel = None
+        self._ticker = None
+        self.stats = Counter()
+
+    @property
+    def interval(self):
+        return getattr(settings, "CHAT_TYPING_INTERVAL", TYPING_INTERVAL)
+
+    @property
+    def timeout(self):
+        return getattr(settings, "CHAT_TYPING_TIMEOUT", TYPING_TIMEOUT)
+
+    @property
+    def wheel(self):
+        if self._wheel is None:
+            self._wheel = TimerWheel(getattr(settings, "CHAT_TYPING_TICK", TYPING_TICK), self._clock())
+        return self._wheel
+
+    def __len__(self):
+        return len(self._states)
+
+    def typing(self, group, user_id):
+        """Whether ``user_id`` is currently shown as typing in ``group``."""
+        state = self._states.get((group, user_id))
+        return state is not None and state.sent
+
+    async def update(self, group, user_id, channel, active):
+        """Record a typing frame from ``channel``; broadcasts the change now if the interval allows."""
+        self.stats["received"] += 1
+        key = (group, user_id)
+        state = self._states.get(key)
+        if state is None:
+            if not active:
+                return
+            state = self._states[key] = TypingState(channel)
+        state.channel = channel
+        state.active = active
+        if active:
+            state.expires_at = self._clock() + self.timeout
+        if not await self._flush([key]):
+            # Folded into the state the room already has, or into the next broadcast
+            self.stats["coalesced"] += 1
+
+    async def leave(self, group, user_id, channel):
+        """Clear the state a closing socket reported, unless another socket of the user took it over."""
+        state = self._states.get((group, user_id))
+        if state is not None and state.channel == channel and state.active:
+            state.active = False
+            await self._flush([(group, user_id)])
+
+    def _settle(self, key, now):
+        """Apply expiry and the broadcast interval to one state; returns the event to send, if any."""
+        state = self._states[key]
+        if state.active and now >= state.expires_at:
+            state.active = False
+            self.stats["expired"] += 1
+        event = None
+        ready_at = state.sent_at + self.interval
+        if state.active != state.sent and now >= ready_at:
+            state.sent, state.sent_at = state.active, now
+            ready_at = now + self.interval
+            event = {
+                "type": "chat.signal",
+                "sender": state.channel,
+                "key": ("typing", key[1]),
+                "frames": typing_frames(key[1], state.active),
+            }
+            self.stats["broadcast"] += 1
+
+        if state.active:
+            # Due when it expires, or when a pending stop may be sent
+            deadline = state.expires_at if state.sent else ready_at
+        elif state.sent:
+            deadline = ready_at
+        elif now >= ready_at:
+            # Idle and the room knows it: nothing left to remember
+            del self._states[key]
+            self.wheel.cancel(key)
+            return event
+        else:
+            # Kept until the interval passes so a restart is still rate limited
+            deadline = ready_at
+        self.wheel.schedule(key, deadline)
+        return event
+
+    async def _flush(self, keys):
+        """Settle ``keys`` and send the resulting broadcasts; returns how many were sent."""
+        now = self._clock()
+        events = []
+        for key in keys:
+            if key in self._states:
+                event = self._settle(key, now)
+                if event is not None:
+                    events.append((key[0], event))
+        self._start_ticker()
+        for group, event in events:
+            await self._group_send(group, event)
+        return len(events)
+
+    async def _group_send(self, group, event):
+        if self._send is not None:
+            await self._send(group, event)
+        else:
+            await get_channel_layer().group_send(group, event)
+
+    def _start_ticker(self):
+        if not len(self.wheel):
+            return
+        loop = asyncio.get_running_loop()
+        if self._ticker is None or self._ticker.done() or self._ticker.get_loop() is not loop:
+            self._ticker = loop.create_task(self._tick())
+
+    async def _tick(self):
+        # Runs only while some state has a deadline
+        while len(self.wheel):
+            await asyncio.sleep(self.wheel.resolution)
+            await self.tick()
+
+    async def tick(self):
+        """Expire stale states and send changes whose interval has passed."""
+        await self._flush(self.wheel.advance(self._clock()))
+
+    def clear(self):
+        self._states.clear()
+        self._wheel = None
+        self.stats.clear()
+
+
+typing_tracker = TypingTracker()
+
+metrics.registry.register(metrics.Counter(
+    "chat_typing_total", "Typing frames received, coalesced, broadcast or expired.", ["outcome"],
+    function=lambda: {(outcome,): count for outcome, count in typing_tracker.stats.items()},
+))
+metrics.registry.register(metrics.Gauge(
+    "chat_typing_states", "Users with a tracked typing state.",
+    function=lambda: len(typing_tracker),
+))
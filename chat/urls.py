@@ -1,4 +1,10 @@
 from django.urls import path
 from . import views
 
-urlpatterns = [path("", views.index, name="index")]
+urlpatterns = [
+    path("", views.index, name="index"),
+    path("messages/older/", views.older_messages, name="older_messages"),
+    path("rooms/", views.rooms, name="rooms"),
+    path("rooms/<slug:room_slug>/online/", views.online, name="online"),
+    path("rooms/<slug:room_slug>/search/", views.search_messages, name="search_messages"),
+]
@@ -1,7 +1,117 @@
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
 from django.shortcuts import render
-from .models import Message
+from . import archive, search
+from . import metrics as chat_metrics
+from .cache import room_cache
+from .cluster import cluster
+from .constants import MESSAGE_PAGE_SIZE, ROOM_LIST_SIZE
+from .history import room_history
+from .models import Message, Room
+from .pagination import decode_id, page_before
+
+
+def _history(request, cursor=None):
+    """Context for one page of history, optionally scoped to ``?room=<slug>``."""
+    messages = Message.objects.select_related("user", "room")
+    room_slug = request.GET.get("room", "")
+    page = None
+    room = None
+    if room_slug:
+        messages = messages.filter(room__slug=room_slug)
+        try:
+            room = room_cache.get(room_slug)
+            # Pages inside the room's in-memory history need no query
+            page = room_history.page(room, cursor=cursor, limit=MESSAGE_PAGE_SIZE)
+        except Room.DoesNotExist:
+            pass
+    if page is None:
+        page = page_before(messages, cursor=cursor, limit=MESSAGE_PAGE_SIZE)
+    if room is not None or not room_slug:
+        # Older pages continue into the messages archived past the room's retention
+        page = archive.extend_page(page, room.pk if room else None, cursor=cursor, limit=MESSAGE_PAGE_SIZE)
+    messages, next_cursor = page
+    return {"messages": messages, "next_cursor": next_cursor, "room_slug": room_slug}
 
 
 def index(request):
-    messages = Message.objects.all().order_by("timestamp")
-    return render(request, "chat/index.html", {"messages": messages})
+    return render(request, "chat/index.html", _history(request))
+
+
+def older_messages(request):
+    """HTMX endpoint returning the page of messages before ``?before=<cursor>``."""
+    try:
+        context = _history(request, cursor=request.GET["before"])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest("A valid 'before' cursor is required.")
+    return render(request, "chat/partials/message_list.html", context)
+
+
+def rooms(request):
+    """The most recently active rooms, read from their activity fields rather than aggregated."""
+    active = Room.objects.by_activity()[:ROOM_LIST_SIZE]
+    return JsonResponse({
+        "rooms": [
+            {
+                "slug": room.slug,
+                "name": room.name,
+                "message_count": room.message_count,
+                "last_message_at": room.last_message_at.isoformat(),
+            }
+            for room in active
+        ],
+    })
+
+
+async def online(request, room_slug):
+    """The users with an open socket in a room, from the presence set on the room's owner."""
+    try:
+        room = await room_cache.aget(room_slug)
+    except Room.DoesNotExist:
+        raise Http404("No such room.")
+    users = await cluster.online(room.pk)
+    return JsonResponse({
+        "room": room.slug,
+        "count": len(users),
+        "users": [{"id": user_id, "username": username} for user_id, username in sorted(users.items())],
+    })
+
+
+def search_messages(request, room_slug):
+    """JSON page of a room's messages matching ``?q=``, newest first; pass ``next`` back as ``?before=``."""
+    try:
+        room = room_cache.get(room_slug)
+    except Room.DoesNotExist:
+        raise Http404("No such room.")
+    query = request.GET.get("q", "").strip()
+    if not query:
+        return HttpResponseBadRequest("A search query 'q' is required.")
+    try:
+        before = decode_id(request.GET["before"]) if "before" in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("'before' must be a message id.")
+    messages, next_cursor = search.search(query, room=room, before=before)
+    return JsonResponse({
+        "room": room.slug,
+        "query": query,
+        "results": [
+            {
+                "id": message.pk,
+                "user": message.user.username,
+                "content": message.content,
+                "timestamp": message.timestamp.isoformat(),
+            }
+            for message in messages
+        ],
+        "next": next_cursor,
+    })
+
+
+def metrics(request):
+    """Prometheus text exposition of the chat metrics."""
+    if not chat_metrics.enabled():
+        raise Http404("Metrics are disabled.")
+    if not chat_metrics.may_scrape(request):
+        return HttpResponseForbidden("Metrics need a staff login, the metrics token or an allowed address.")
+    return HttpResponse(
+        chat_metrics.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
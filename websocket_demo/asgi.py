@@ -9,11 +9,12 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "websocket_demo.settings")
 django_asgi_app = get_asgi_application()
 
 from channels.routing import ProtocolTypeRouter, URLRouter
+from chat.cluster import ClusterMiddleware
 from chat.routing import websocket_urlpatterns
 
-application = ProtocolTypeRouter(
+application = ClusterMiddleware(ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": URLRouter(websocket_urlpatterns),
     }
-)
+))
@@ -0,0 +1,57 @@
+"""
+Daphne with permessage-deflate (RFC 7692) enabled for WebSocket connections.
+
+Daphne does not expose autobahn's compression options, so this entry point
+wraps its server and command line. Use it in place of ``daphne``:
+
+    python -m websocket_demo.server -b 0.0.0.0 -p 8000 websocket_demo.asgi:application
+
+Compression is accepted whenever the client offers it, unless
+``WEBSOCKET_DEFLATE`` is off. Each compressed socket keeps zlib state
+for its lifetime, so the window and memory level are kept small (see
+``settings.WEBSOCKET_DEFLATE_WINDOW_BITS`` and ``WEBSOCKET_DEFLATE_MEM_LEVEL``).
+"""
+
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "websocket_demo.settings")
+
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept  # noqa: E402
+from daphne.cli import CommandLineInterface as DaphneCommandLineInterface  # noqa: E402
+from daphne.server import Server as DaphneServer  # noqa: E402
+from django.conf import settings  # noqa: E402
+from twisted.internet import reactor  # noqa: E402
+
+
+def accept_deflate(offers):
+    """Pick the client's permessage-deflate offer, if any."""
+    if not getattr(settings, "WEBSOCKET_DEFLATE", True):
+        return None
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            window_bits = getattr(settings, "WEBSOCKET_DEFLATE_WINDOW_BITS", None)
+            return PerMessageDeflateOfferAccept(
+                offer,
+                # The client must allow a smaller server window for this to apply
+                window_bits=window_bits if offer.accept_max_window_bits else None,
+                mem_level=getattr(settings, "WEBSOCKET_DEFLATE_MEM_LEVEL", None),
+            )
+    return None
+
+
+class Server(DaphneServer):
+    def run(self):
+        # The WebSocket factory is created inside run(), just before the reactor starts
+        reactor.callWhenRunning(self.enable_compression)
+        super().run()
+
+    def enable_compression(self):
+        self.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+
+
+class CommandLineInterface(DaphneCommandLineInterface):
+    server_class = Server
+
+
+if __name__ == "__main__":
+    CommandLineInterface.entrypoint()
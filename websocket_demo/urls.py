@@ -1,4 +1,9 @@
 from django.contrib import admin
 from django.urls import path, include
+from chat import views as chat_views
 
-urlpatterns = [path("admin/", admin.site.urls), path("", include("chat.urls"))]
+urlpatterns = [
+    path("admin/", admin.site.urls),
+    path("metrics", chat_views.metrics, name="metrics"),
+    path("", include("chat.urls")),
+]